@@ -1,163 +1,324 @@
-from flask import Flask, render_template, request, jsonify, Response
-import yt_dlp
+import time
+_import_started = time.perf_counter()
+from flask import Flask, render_template, request, jsonify, Response, send_file, send_from_directory
 import os
 import subprocess
-from selenium import webdriver
-import time
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from webdriver_manager  .chrome import ChromeDriverManager
 from threading import Lock
 import json
 import threading
+import copy
+import uuid
+from urllib.parse import quote
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.wsgi import ClosingIterator
+from lazy import lazy_import, load_times, preload
+from broker import BROKER_NODE_URL, make_broker
+from job_store import JobStore
+from jobs import CANCELLED, FAILED, FINAL_STATES, FINISHED, QUEUED, RUNNING, JobQueue, QueueFullError
+from extract_cache import BrokerCacheBackend, ExtractionCache, make_cache_key
+from browser_pool import browser_pool, playwright_pool
+from stream_discovery import classify_stream, discover_with_chrome, discover_with_playwright
+from stream_ranking import StreamRanker, looks_like_trailer
+from racing import race
+from fallbacks import Backend, live_process_count, run_fallbacks, run_process
+from segmented import UnsupportedStream, download_segmented
+from batch import BatchRunner
+from catalogue import FormatCatalogue, slim_info
+from download_store import DownloadIndex, DownloadStore, make_store_key
+from metrics import bytes_transferred, record_span, registry, span
+from postprocess import TRANSCODE, plan_for_url, plan_postprocessing
+from tuning import DownloadTuner
+from governor import SPECULATIVE, AdmissionError, Busy, Governor, estimate_bytes
+from speculation import Speculator
+from thumbnails import THUMB_DEFAULT_WIDTH, THUMB_MAX_AGE, ThumbnailCache, ThumbnailError
+from streaming import (AUDIO_BITRATES, AUDIO_FORMATS, DEFAULT_AUDIO_BITRATE, StreamNotSupported,
+                       audio_codec_args, audio_file_command, pipe_process, stream_command)
+
+# Imported on first use; gunicorn.conf.py preloads it in the master so workers share it
+yt_dlp = lazy_import("yt_dlp")
+requests = lazy_import("requests")
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
+# Reverse proxies in front of the app. Each appends one X-Forwarded-For entry, and only those are trusted (0: use the peer address)
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", "0"))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=0)
 
-DEFAULT_DOWNLOAD_FOLDER = "D:\\PythonURLDownloader"
+DEFAULT_DOWNLOAD_FOLDER = os.environ.get("DOWNLOAD_FOLDER", "D:\\PythonURLDownloader")
 COOKIES_FILE = "cookies.txt"
 progress_bars = {}
 progress_lock = Lock()
-# Dictionary to store progress
-progress_data = {"status": "Starting...", "progress": 0}
-
-if not os.path.exists(DEFAULT_DOWNLOAD_FOLDER):
-    os.makedirs(DEFAULT_DOWNLOAD_FOLDER)
-
-def get_chrome_driver():
-    chrome_options = Options()
-    chrome_options.add_argument("--headless")
-    chrome_options.add_argument("--no-sandbox")
-    chrome_options.add_argument("--disable-dev-shm-usage")
-    chrome_options.add_argument("--disable-gpu")
-    chrome_options.add_argument("--window-size=1920x1080")
-    chrome_options.add_argument("--disable-blink-features=AutomationControlled")
-
-    service = Service("/usr/local/bin/chromedriver")
-    driver = webdriver.Chrome(service=service, options=chrome_options)
-    return driver
-
-def playwright_extract_video_url(url):
+# Seconds between SSE keep-alive comments while a job is idle
+PROGRESS_KEEPALIVE = 15
+# Set on /files and /stream requests one node relays to another, so a stale broker entry can't bounce between them
+PROXY_HOP_HEADER = "X-Node-Proxied"
+PROXY_REQUEST_HEADERS = ("Range", "If-Range", "If-None-Match", "If-Modified-Since")
+PROXY_RESPONSE_HEADERS = ("Content-Type", "Content-Length", "Content-Range", "Accept-Ranges", "Content-Disposition",
+                          "ETag", "Last-Modified", "Cache-Control", "X-Accel-Buffering")
+# Relayed /stream bodies are passed on in chunks this small, so playback can start before a megabyte has arrived
+PROXY_STREAM_CHUNK = 64 * 1024
+# Warn when importing this module takes longer than this many seconds
+STARTUP_IMPORT_BUDGET = float(os.environ.get("STARTUP_IMPORT_BUDGET", "0.5"))
+# Modules preload_backends() imports ahead of the first request
+BACKEND_MODULES = ("yt_dlp", "requests", "selenium.webdriver", "selenium.common.exceptions")
+# SQLite file jobs are written through to, so a restarted worker can resume them ("" disables it)
+JOB_STORE_DB = os.environ.get("JOB_STORE_DB", os.path.join(DEFAULT_DOWNLOAD_FOLDER, "jobs.sqlite3"))
+
+# Job dispatch, progress and caches shared between nodes (None: everything stays in this process)
+broker = make_broker()
+# Downloads run on a bounded worker pool instead of inside the request thread
+job_queue = JobQueue(store=JobStore(JOB_STORE_DB) if JOB_STORE_DB else None, broker=broker)
+# Extraction results shared by /get_formats and the download jobs (and, with a broker, by every node)
+extraction_cache = ExtractionCache(backend=BrokerCacheBackend(broker) if broker else None)
+# Format catalogues for /get_formats, so repeat lookups never touch the full info dict
+catalogue_cache = ExtractionCache(db_path="")
+# Probes the streams a page requested and picks the main feature among them
+stream_ranker = StreamRanker()
+# Finished downloads, reused by later requests for the same video and format
+download_index = DownloadIndex(broker, DEFAULT_DOWNLOAD_FOLDER, BROKER_NODE_URL) if broker and BROKER_NODE_URL else None
+download_store = DownloadStore(os.path.join(DEFAULT_DOWNLOAD_FOLDER, "store"), index=download_index)
+# Connection counts and chunk sizes per host, learned from each yt-dlp download
+download_tuner = DownloadTuner()
+# Bandwidth, ffmpeg and disk shared out between concurrent jobs and users
+governor = Governor()
+# Thumbnails fetched from the origin once and served resized from disk
+thumbnail_cache = ThumbnailCache(os.path.join(DEFAULT_DOWNLOAD_FOLDER, "thumbs"), governor=governor)
+
+startup = {"import_seconds": None, "backends_ready": False, "browsers_ready": False, "warm_error": None}
+_background_started = False
+_background_lock = Lock()
+
+
+def ensure_download_folder():
+    """ Create DEFAULT_DOWNLOAD_FOLDER when something is about to write to it """
+    os.makedirs(DEFAULT_DOWNLOAD_FOLDER, exist_ok=True)
+    return DEFAULT_DOWNLOAD_FOLDER
+
+
+def preload_backends():
+    """ Import the lazily loaded backends now. Safe to call before fork: it starts no threads """
+    preload(*BACKEND_MODULES)
+    startup["backends_ready"] = True
+
+
+def warm_up():
     try:
-        from playwright.sync_api import sync_playwright
-        import re
+        # Pick up the downloads a dead worker left unfinished before anything else
+        job_queue.recover()
+    except Exception as e:
+        print(f"⚠️ Job recovery failed: {e}")
+    if broker is not None:
+        # Take jobs off the shared queue even before this node gets a request of its own
+        job_queue.start()
+    try:
+        preload_backends()
+        # Start the pooled browsers so the first /download does not pay for it
+        if os.environ.get("BROWSER_POOL_WARM", "1") == "1":
+            browser_pool.warm()
+        startup["browsers_ready"] = True
+    except Exception as e:
+        startup["warm_error"] = str(e)
+        print(f"⚠️ Warm-up failed: {e}")
 
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=True)
-            page = browser.new_page()
-            page.goto(url, wait_until="domcontentloaded")
-            html = page.content()
 
-            video_candidates = re.findall(r'https?://[^\s"\'<>]+?\.(?:m3u8|mp4)(?:\?[^"\'>]*)?', html)
-            filtered = [v for v in video_candidates if not any(x in v.lower() for x in ['trailer', 'preview', 'teaser', 'promo'])]
+def start_background():
+    """ Start the per-process warm-up once; gunicorn calls this after fork, otherwise the first request does """
+    global _background_started
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
 
-            if filtered:
-                return filtered[0]
-            elif video_candidates:
-                return video_candidates[0]
 
-            browser.close()
+@app.before_request
+def start_background_on_first_request():
+    if not _background_started:
+        start_background()
+
+def playwright_extract_video_urls(url, cancel=None):
+    try:
+        # Runs on the pool's Playwright thread; this thread only waits for the result
+        found = playwright_pool.run(lambda page: discover_with_playwright(page, url, cancel=cancel), cancel=cancel)
+        if found:
+            print(f"[PLAYWRIGHT] {len(found)} stream(s) seen on the network: {found[0]}")
+            return found
     except Exception as e:
         print(f"[PLAYWRIGHT ERROR] {e}")
-    return None
+    return []
 
 
-def smart_extract_real_video_url(url):
-    from selenium import webdriver
-    from selenium.webdriver.chrome.service import Service
-    from selenium.webdriver.chrome.options import Options
+def smart_extract_real_video_urls(url, cancel=None):
     from selenium.webdriver.common.by import By
     from selenium.webdriver.support.ui import WebDriverWait
     from selenium.webdriver.support import expected_conditions as EC
-    from webdriver_manager.chrome import ChromeDriverManager
-    import re
-
-    options = Options()
-    options.add_argument('--headless')
-    options.add_argument('--disable-gpu')
-    options.add_argument('--no-sandbox')
-    options.add_argument('--disable-dev-shm-usage')
-    options.page_load_strategy = 'eager'
-
-    service = Service(ChromeDriverManager().install())
-    driver = webdriver.Chrome(service=service, options=options)
 
     try:
-        driver.get(url)
-        wait = WebDriverWait(driver, 10)
-        html = driver.page_source
-
-        # Try <video> or <source> src from page source
-        video_candidates = re.findall(r'https?://[^\s"\'<>]+?\.(?:m3u8|mp4)(?:\?[^"\'>]*)?', html)
-        filtered = [v for v in video_candidates if not any(x in v.lower() for x in ['trailer', 'preview', 'teaser', 'promo'])]
-
-        if filtered:
-            return filtered[0]
-        elif video_candidates:
-            return video_candidates[0]
-
-        # Try <video> tag directly
-        try:
-            video = wait.until(EC.presence_of_element_located((By.TAG_NAME, "video")))
-            src = video.get_attribute("src")
-            if src and "blob:" not in src:
-                return src
+        with browser_pool.lease(cancel=cancel) as driver:
+            # Watch the network for manifest/media requests, including XHR and fetch traffic
+            found = discover_with_chrome(driver, url, cancel=cancel)
+            if found:
+                print(f"[SELENIUM] {len(found)} stream(s) seen on the network: {found[0]}")
+                return found
+            if cancel is not None and cancel.is_set():
+                return []
+
+            wait = WebDriverWait(driver, 10)
+
+            # Try <video> tag directly
             try:
-                source = video.find_element(By.TAG_NAME, "source")
-                src = source.get_attribute("src")
-                if src:
-                    return src
+                video = wait.until(EC.presence_of_element_located((By.TAG_NAME, "video")))
+                src = video.get_attribute("src")
+                if src and "blob:" not in src:
+                    return [src]
+                try:
+                    source = video.find_element(By.TAG_NAME, "source")
+                    src = source.get_attribute("src")
+                    if src:
+                        return [src]
+                except:
+                    pass
             except:
                 pass
-        except:
-            pass
 
-        # Check iframe sources
-        try:
-            iframes = driver.find_elements(By.TAG_NAME, "iframe")
-            for iframe in iframes:
-                src = iframe.get_attribute("src")
-                if src and any(ext in src for ext in [".mp4", ".m3u8", "stream", "embed"]):
-                    return src
-        except:
-            pass
-
-        # Regex fallback
-        m3u8_match = re.search(r'https?:\/\/[^\s"\']+\.m3u8', html)
-        mp4_match = re.search(r'https?:\/\/[^\s"\']+\.mp4', html)
-        if m3u8_match:
-            return m3u8_match.group(0)
-        if mp4_match:
-            return mp4_match.group(0)
+            # Check iframe sources
+            try:
+                iframes = driver.find_elements(By.TAG_NAME, "iframe")
+                for iframe in iframes:
+                    src = iframe.get_attribute("src")
+                    if src and any(ext in src for ext in [".mp4", ".m3u8", "stream", "embed"]):
+                        return [src]
+            except:
+                pass
 
     except Exception as e:
-        print(f"[SELENIUM ERROR] {e}")
-    finally:
-        driver.quit()
-
-    # ✅ Fallback to Playwright if nothing found
-    print("[FALLBACK] Using Playwright...")
-    return playwright_extract_video_url(url)
-
-
-def progress_hook(d):
-    """ Callback function to update download progress """
-    global progress_data
+        if cancel is None or not cancel.is_set():
+            print(f"[SELENIUM ERROR] {e}")
+
+    return []
+
+
+def race_extractors(url, cancel=None):
+    """ Resolve url with yt-dlp, Selenium and Playwright at once; the first usable info dict wins.
+
+    Returns (RaceResult, stream URLs the browsers discovered along the way).
+    """
+    discovered = []
+
+    def via_ytdlp(token):
+        return url, get_video_info(url)
+
+    def via_browser(name, find_streams):
+        def strategy(token):
+            with span("browser", name) as stage:
+                candidates = find_streams(url, cancel=token)
+                if token.is_set():
+                    stage["outcome"] = "cancelled"
+                elif not candidates:
+                    stage["outcome"] = "no_result"
+            if not candidates or token.is_set():
+                return None
+            discovered.extend(candidates)
+            # Pages request trailers, ads and previews too: probe them all and take the main feature
+            with span("ranking", name):
+                stream_url = stream_ranker.rank(candidates, cancel=token).best
+            if token.is_set():
+                return None
+            return stream_url, get_video_info(stream_url)
+        return strategy
+
+    def usable(value):
+        return value is not None and bool(value[1]) and not match_filter(value[1])
+
+    result = race([
+        ("yt-dlp", via_ytdlp),
+        ("selenium", via_browser("selenium", smart_extract_real_video_urls)),
+        ("playwright", via_browser("playwright", playwright_extract_video_urls)),
+    ], accept=usable, cancel=cancel, name="extract")
+    print(f"[RACE] {result.to_dict()}")
+    return result, discovered
+
+
+def progress_hook(job, d):
+    """ Publish yt-dlp's progress dict onto the job's progress channel """
     if d['status'] == 'downloading':
-        percent = d.get('_percent_str', '0%').strip()
-        progress_data = {"status": "Downloading...", "progress": percent}
+        downloaded = d.get('downloaded_bytes') or 0
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        percent = round(downloaded * 100 / total, 1) if total else 0.0
+        job.update_progress(
+            status="Downloading...",
+            percent=percent,
+            downloaded_bytes=downloaded,
+            total_bytes=total,
+            # Rounded so that jitter in the estimates does not count as a change
+            speed=int(d['speed']) if d.get('speed') else None,
+            eta=int(d['eta']) if d.get('eta') is not None else None,
+        )
     elif d['status'] == 'finished':
-        progress_data = {"status": "Download complete!", "progress": "100%"}
+        total = d.get('total_bytes') or d.get('downloaded_bytes')
+        bytes_transferred.inc(total or 0, path="download")
+        job.update_progress(status="Download complete!", percent=100.0,
+                            downloaded_bytes=total or 0, total_bytes=total, speed=None, eta=0)
+
+
+def make_progress_hook(job):
+    """ Progress hook that also aborts the download once the job is cancelled """
+    def hook(d):
+        if job.cancelled:
+            raise yt_dlp.utils.DownloadCancelled("Job cancelled by user")
+        progress_hook(job, d)
+    return hook
+
+def make_postprocessor_hook():
+    """ postprocessor_hooks entry that records each yt-dlp post-processor as a span """
+    started = {}
+
+    def hook(d):
+        name = d.get("postprocessor") or "postprocessor"
+        if d["status"] == "started":
+            started[name] = time.perf_counter()
+        elif d["status"] == "finished" and name in started:
+            record_span("postprocess", time.perf_counter() - started.pop(name), name)
+    return hook
 
 def match_filter(info_dict):
-    title = info_dict.get('title', '').lower()
-    if 'trailer' in title or 'teaser' in title or 'promo' in title:
+    # The title alone isn't enough: "Official Trailer Reaction" can be an hour long
+    if looks_like_trailer(info_dict.get('title'), info_dict.get('duration')):
         return "Filtered out trailer content."
     return None
 
 
-def get_video_formats(url):
-    """Fetch available video and audio formats."""
-    ydl_opts = {
+def extract_video_info(url, ydl_opts):
+    """ extract_info through the extraction cache. Returns a JSON-safe info dict or None. """
+    cache_key = make_cache_key(url, ydl_opts)
+    video_info = extraction_cache.get(cache_key)
+    if video_info is not None:
+        print(f"⚡ Extraction cache hit for {url}")
+        return video_info
+
+    with span("extraction", "yt-dlp"), yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        video_info = ydl.extract_info(url, download=False)
+        if video_info is None:
+            return None
+        video_info = slim_info(ydl.sanitize_info(video_info))
+
+    extraction_cache.set(cache_key, video_info)
+    # Usually done by the time the page asks for it
+    thumbnail_cache.prefetch(video_info.get("thumbnail"))
+    return video_info
+
+
+def download_with_info(ydl, url, video_info=None):
+    """ Download from an already-extracted info dict when we have one, skipping a second extraction """
+    if video_info and video_info.get("formats"):
+        ydl.process_ie_result(copy.deepcopy(video_info), download=True)
+    else:
+        ydl.download([url])
+
+
+def format_options(url):
+    """ yt-dlp options for extracting url's formats """
+    return {
         "quiet": True,
         "cookiefile": COOKIES_FILE,
         "nocheckcertificate": True,
@@ -169,59 +330,32 @@ def get_video_formats(url):
         "match_filter": match_filter,
     }
 
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            video_info = ydl.extract_info(url, download=False)
-            formats = {
-                "combined": [],
-                "video": [],
-                "audio": [],
-            }
-
-            best_audio = None
-            for fmt in video_info.get("formats", []):
-                if fmt.get("acodec", "none") != "none" and fmt.get("vcodec") == "none":
-                    if best_audio is None or fmt.get("abr", 0) > best_audio.get("abr", 0):
-                        best_audio = fmt
-
-            for fmt in video_info.get("formats", []):
-                format_id = fmt.get("format_id")
-                height = fmt.get("height")
-                width = fmt.get("width")
-                if height and width:
-                    resolution = f"{width}x{height}"
-                else:
-                    resolution = fmt.get("format_note", "Unknown")
-                filesize = fmt.get("filesize") or fmt.get("filesize_approx")
-                size_info = f"{filesize / (1024 * 1024):.2f} MB" if filesize else "Unknown size"
-                vcodec = fmt.get("vcodec", "none")
-                acodec = fmt.get("acodec", "none")
-
-                # Only add formats that are either:
-                # 1. Already combined (have both video and audio)
-                # 2. Video-only formats that can be merged with best audio
-                if vcodec != "none" and acodec != "none":
-                    formats["combined"].append({
-                        "format_id": format_id,
-                        "resolution": resolution,
-                        "size": size_info
-                    })
-                elif vcodec != "none" and best_audio:
-                    # For video-only formats, create a combined format ID
-                    combined_format_id = f"{format_id}+{best_audio['format_id']}"
-                    formats["video"].append({
-                        "format_id": combined_format_id,
-                        "resolution": resolution,
-                        "size": size_info
-                    })
-
-            thumbnail_url = video_info.get("thumbnail", "")
-
-            return formats, video_info, thumbnail_url
 
+def get_video_info(url):
+    """ Full info dict for url (through the extraction cache), or None """
+    try:
+        video_info = extract_video_info(url, format_options(url))
+        if video_info is None:
+            raise ValueError("No video information extracted")
+        return video_info
     except Exception as e:
-        print(f"❌ Error fetching video formats: {e}")
-        return {"combined": [], "video": [], "audio": []}, None, None
+        print(f"❌ Error fetching video info: {e}")
+        return None
+
+
+def get_video_formats(url):
+    """Fetch the format catalogue for url, or None if extraction failed."""
+    cache_key = make_cache_key(url, format_options(url))
+    catalogue = catalogue_cache.get(cache_key)
+    if catalogue is not None:
+        return catalogue
+
+    video_info = get_video_info(url)
+    if video_info is None:
+        return None
+    catalogue = FormatCatalogue.from_info(video_info)
+    catalogue_cache.set(cache_key, catalogue)
+    return catalogue
 
 
 @app.route("/")
@@ -233,29 +367,16 @@ def index():
 def get_formats():
     url = request.json.get("url")
 
-    try:
-        # try-except to catch errors from get_video_formats
-        formats, video_info, thumbnail_url = get_video_formats(url)
-    except Exception as e:
-        print(f"❌ Error in get_video_formats: {e}")
-        return jsonify({"error": "❌ Failed to extract video formats. The link may be invalid or unsupported."}), 400
-
-    # Check if formats is valid
-    if not formats or not isinstance(formats, dict):
-        return jsonify({"error": "❌ Invalid formats received."}), 400
+    catalogue = get_video_formats(url)
+    if catalogue is None:
+        print("⚠️ No video info found — possible unsupported URL or failed extraction.")
+        catalogue = FormatCatalogue()
 
-    # Ensure all keys exist in formats
-    if not formats.get("audio"):
-        formats["audio"] = []
-    if not formats.get("video"):
-        formats["video"] = []
-    if not formats.get("combined"):
-        formats["combined"] = []
+    formats = catalogue.page_formats()
 
     # Force download flag
-    force_download = False
-    if not formats["combined"] and not formats["video"] and not formats["audio"]:
-        force_download = True
+    force_download = catalogue.is_empty()
+    if force_download:
         print("⚡ Force download mode activated")
 
     if not formats["audio"]:
@@ -269,39 +390,59 @@ def get_formats():
     # Ensure the response includes the force_download flag if it's true
     response = {
         "video": formats,
-        "thumbnail": thumbnail_url,
+        "thumbnail": catalogue.thumbnail,
+        "thumbnail_proxy": thumbnail_cache.path_for(catalogue.thumbnail),
         "force_download": force_download
     }
-
-    # Check if video_info is not None before calling .get
-    if video_info:
-        duration = video_info.get("duration")
+    if request.json.get("detail"):
+        # Numeric fields and audio pairings for API clients; the page doesn't need them
+        response["catalogue"] = catalogue.to_dict()
+    if not force_download and formats["video"]:
+        # With SPECULATE=1, the format the page preselects starts downloading while the user chooses
+        speculation = speculator.start(client_id(), url, formats["video"][0]["format_id"])
+        if speculation:
+            response["speculation"] = speculation
+
+    duration = catalogue.duration
+    if duration:
         print(f"📺 Video Duration: {duration} seconds")
+        if looks_like_trailer(catalogue.title, duration):
+            print("⚠️ Detected trailer-like video. Consider forcing smart extraction or fallback.")
 
-        if duration and duration < 180:  # 3 minutes
-            print("⚠️ Detected short video (likely trailer). Consider forcing smart extraction or fallback.")
-    else:
-        print("⚠️ No video_info found — possible unsupported URL or failed extraction.")
-
-    # Debugging Output:
-    print(f"🔍 Formats Found: {formats}")
-    print(f"🖼️ Thumbnail URL: {thumbnail_url}")
+    print(f"🔍 {len(catalogue.formats)} formats, heights {catalogue.heights()[:6]}")
 
     return jsonify(response)
 
 
+def smart_fallback_download(url, output_path, cancel=None, on_progress=None):
+    """ Download a stream URL to output_path with the segmented engine, or ffmpeg. Returns (ok, path or error) """
+    if classify_stream(url) == "manifest":
+        try:
+            print(f"[FALLBACK] Segmented download to: {output_path}")
+            with span("fallback", "segmented"):
+                # Matroska instead of MP4 when the codecs call for it
+                path = download_segmented(url, output_path, cancel=cancel, on_progress=on_progress,
+                                          ffmpeg_slot=governor.ffmpeg)
+            return True, path
+        except UnsupportedStream as e:
+            print(f"[FALLBACK] Segmented engine can't handle this stream ({e}), using ffmpeg")
+        except Exception as e:
+            print(f"[FALLBACK ERROR] {e}")
+            return False, str(e)
 
-def smart_fallback_download(url):
     try:
-        output_path = os.path.join(DEFAULT_DOWNLOAD_FOLDER, f"stream_{int(time.time())}.mp4")
         print(f"[FALLBACK] Attempting direct download to: {output_path}")
 
-        subprocess.run([
-            "ffmpeg", "-y", "-i", url,
-            "-c", "copy",
-            "-bsf:a", "aac_adtstoasc",
-            output_path
-        ], check=True)
+        # Cancelling the job kills ffmpeg instead of leaving it running
+        with governor.ffmpeg(cancel), span("fallback", "ffmpeg-direct"):
+            returncode, _ = run_process([
+                "ffmpeg", "-y", "-i", url,
+                "-c", "copy",
+                "-bsf:a", "aac_adtstoasc",
+                output_path
+            ], cancel=cancel)
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, "ffmpeg")
 
         return True, output_path
     except Exception as e:
@@ -309,129 +450,599 @@ def smart_fallback_download(url):
         return False, str(e)
 
 
-@app.route("/download", methods=["POST"])
-def download():
-    global progress_data
-    data = request.json
-    url = data.get("url")
-    format_id = data.get("format_id")
-    force_download = data.get("force_download", False)  # Force fallback
-    output_template = os.path.join(DEFAULT_DOWNLOAD_FOLDER, "%(title)s.%(ext)s")
-
-    # Reset progress
-    progress_data = {"status": "Starting...", "progress": 0}
+def segment_progress(job, transfer):
+    """ on_progress callback for the segmented downloader; charges the bytes to transfer's bandwidth budget """
+    counted = [0]
+
+    def update(done, total, downloaded):
+        bytes_transferred.inc(downloaded - counted[0], path="segmented")
+        transfer.consume(downloaded - counted[0])
+        counted[0] = downloaded
+        job.update_progress(status="Downloading segments...", percent=round(done * 100 / total, 1),
+                            downloaded_bytes=downloaded, total_bytes=None)
+    return update
+
+
+def staged_file(path):
+    """ Result fields pointing the client at a file staged in DEFAULT_DOWNLOAD_FOLDER """
+    if not path:
+        return {}
+    name = os.path.relpath(path, DEFAULT_DOWNLOAD_FOLDER).replace(os.sep, "/")
+    if download_index is not None and os.path.exists(path):
+        # So that /files on the other nodes can relay it
+        download_index.add(path, size=os.path.getsize(path))
+    return {"file": name, "file_url": f"/files/{quote(name)}"}
+
+
+def follow_shared_download(job):
+    """ on_wait callback for the download store: mirror the producing job's progress """
+    def update(owner):
+        if owner is not None:
+            job.update_progress(**dict(owner.progress))
+    return update
+
+
+def stored_download(job, key, produce):
+    """ Fetch key through the download store. Returns (path, how) with how in 'hit', 'coalesced', 'downloaded'.
+
+    With a download index, how is 'remote' when another node already has it; /files relays that path.
+    """
+    if download_index is not None and not download_store.has(key):
+        remote = download_index.lookup(key)
+        if remote is not None:
+            print(f"⚡ Download store remote hit for {key[:12]} on {remote['node']}")
+            job.update_progress(status="Already downloaded!", percent=100.0, downloaded_bytes=remote["size"] or 0,
+                                total_bytes=remote["size"], speed=None, eta=0)
+            return os.path.join(DEFAULT_DOWNLOAD_FOLDER, remote["file"]), "remote"
+    entry, how = download_store.fetch(key, produce, cancel=job.cancel_event, context=job,
+                                      on_wait=follow_shared_download(job))
+    try:
+        if how != "downloaded":
+            print(f"⚡ Download store {how} for {key[:12]}")
+            job.update_progress(status="Already downloaded!", percent=100.0, downloaded_bytes=entry.size,
+                                total_bytes=entry.size, speed=None, eta=0)
+        return entry.path, how
+    finally:
+        download_store.release(entry)
 
-    # Safely attempt to smart-extract the real video URL (with timeout)
-    def try_smart_extract(original_url, result_container):
-        try:
-            result_container["url"] = smart_extract_real_video_url(original_url)
-        except Exception as e:
-            print(f"[SMART ERROR] {e}")
-            result_container["url"] = None
-
-    result = {}
-    thread = threading.Thread(target=try_smart_extract, args=(url, result))
-    thread.start()
-    thread.join(timeout=10)  # Timeout in seconds
-
-    real_url = result.get("url")
-    if real_url:
-        print(f"[SMART] Real stream URL found: {real_url}")
-        url = real_url
-    else:
-        print("[SMART] Timeout or no better stream URL found, using original.")
 
-    # Now, get video formats and ensure video_info is initialized
-    formats, video_info, thumbnail_url = get_video_formats(url)
+def stored_fallback_download(job, stream_url):
+    """ smart_fallback_download through the download store. Returns (ok, path or error)
 
-    # Check if video_info is None or if it's not valid
-    if not video_info:
-        return jsonify({"status": "error", "message": "❌ Unable to fetch video information."})
+    Jobs for the same stream share one download instead of writing the same
+    partial and resume files at once, and a retry resumes from the store directory.
+    """
+    def produce(workdir):
+        with governor.transfer(job.owner, "segmented", job.id, job.cancel_event) as transfer:
+            success, message = smart_fallback_download(stream_url, os.path.join(workdir, "stream.mp4"),
+                                                       cancel=job.cancel_event, on_progress=segment_progress(job, transfer))
+        if not success:
+            raise RuntimeError(message)
+        return message
 
-    # Access the video_info and its properties safely
-    duration = video_info.get("duration")
+    try:
+        path, _ = stored_download(job, make_store_key(None, "stream-fallback", url=stream_url), produce)
+    except RuntimeError as e:
+        return False, str(e)
+    return True, path
+
+
+@job_queue.resumable
+def run_download_job(job, url, format_id=None, force_download=False):
+    """ Worker-side body of /download. Returns a result dict for the job. """
+    job.update_progress(status="Resolving stream...")
+
+    # yt-dlp and the browser extractors race; the losers are cancelled
+    resolved, discovered = race_extractors(url, cancel=job.cancel_event)
+    job.check_cancelled()
+    # The best stream the browsers found, for the ffmpeg fallbacks; ranked only when one runs
+    real_url = None
+
+    if resolved.winner is None:
+        # Probes are cached, so re-ranking what both browsers found is cheap
+        if force_download:
+            real_url = stream_ranker.rank(discovered, cancel=job.cancel_event).best
+        if real_url:
+            print("🔁 No extractor produced usable info, trying ffmpeg with the discovered stream...")
+            success, message = stored_fallback_download(job, real_url)
+            job.check_cancelled()
+            if success:
+                return {"status": "success", "message": "✅ Smart fallback download complete!", **staged_file(message)}
+            return {"status": "error", "message": f"❌ Smart fallback failed: {message}"}
+        return {"status": "error", "message": "❌ Unable to fetch video information."}
+
+    url, video_info = resolved.value
+    job.record(resolved_url=url, extractor=resolved.winner)
+    if resolved.winner != "yt-dlp":
+        print(f"[SMART] Real stream URL found: {url}")
+    catalogue = FormatCatalogue.from_info(video_info)
+
+    duration = catalogue.duration
     print(f"📺 Video Duration: {duration} seconds")
 
-    if duration and duration < 180:  # 3 minutes
-        print("⚠️ Detected short video (likely trailer). Consider forcing smart extraction or fallback.")
+    if looks_like_trailer(catalogue.title, duration):
+        print("⚠️ Detected trailer-like video. Consider forcing smart extraction or fallback.")
 
-    # Check for trailer content
-    if video_info and match_filter(video_info):  # Check if the video is a trailer
-        return jsonify({"status": "error", "message": "❌ Trailer content detected. Try another video."})
+    print(f"🔍 {len(catalogue.formats)} formats, heights {catalogue.heights()[:6]}")
 
-    # Debugging Output:
-    print(f"🔍 Formats Found: {formats}")
-    print(f"🖼️ Thumbnail URL: {thumbnail_url}")
-
-    if not formats["combined"] and not formats["video"] and not formats["audio"]:
+    if catalogue.is_empty():
+        if job.kind == SPECULATIVE:
+            return {"status": "error", "message": "❌ Nothing to prefetch: no formats found."}
         print("⚡ No valid formats found. Attempting force download as fallback.")
         force_download = True  # Trigger force download mode
 
     # Basic config
     ydl_opts = {
         'format': format_id if format_id else 'bestvideo+bestaudio/best',
-        'progress_hooks': [progress_hook],
-        'outtmpl': output_template,
+        'progress_hooks': [make_progress_hook(job)],
         'socket_timeout': 10,
         'retries': 3,
-        'merge_output_format': 'mp4',
-        'postprocessors': [{
-            'key': 'FFmpegVideoConvertor',
-            'preferedformat': 'mp4'
-        }],
-        'postprocessor_args': [
-            '-c:v', 'copy',
-            '-c:a', 'aac',
-            '-strict', 'experimental'
-        ]
     }
+    plan = None
+    formats = []
+
+    def configure(format_spec):
+        """ Plan post-processing for format_spec from the codecs it selects """
+        nonlocal plan, formats
+        try:
+            formats = choose_formats(video_info, format_spec)[0]
+        except yt_dlp.utils.YoutubeDLError as e:
+            print(f"[POSTPROCESS] Couldn't select {format_spec}: {e}")
+            formats = []
+        plan = plan_postprocessing(formats)
+        print(f"[POSTPROCESS] {format_spec}: {plan.action} ({plan.reason})")
+        for key in ('merge_output_format', 'postprocessors', 'postprocessor_args'):
+            ydl_opts.pop(key, None)
+        ydl_opts.update(format=format_spec, **plan.ydl_options())
+        job.record(format=format_spec, postprocessing=plan.action)
+
+    def produce(workdir):
+        # Each store key downloads into its own directory, so an interrupted
+        # download leaves .part files there for the next attempt to resume
+        saved = []
+        job.record(output_dir=workdir)
+        ffmpeg_hook, release_ffmpeg = governor.postprocessor_hook(job.cancel_event)
+        # The download span includes post-processing, which also gets spans of its own
+        try:
+            with governor.admit(workdir, estimate_bytes(formats, duration)), \
+                    governor.transfer(job.owner, SPECULATIVE if job.kind == SPECULATIVE else "download", job.id,
+                                      job.cancel_event) as transfer, \
+                    span("download", "yt-dlp"), download_tuner.session(url) as tuning, yt_dlp.YoutubeDL(dict(
+                        ydl_opts, **tuning.ydl_options(), outtmpl=os.path.join(workdir, "%(title)s.%(ext)s"),
+                        progress_hooks=ydl_opts['progress_hooks'] + [tuning.hook, transfer.hook],
+                        post_hooks=[saved.append],
+                        postprocessor_hooks=[ffmpeg_hook, make_postprocessor_hook()])) as ydl:
+                # ratelimit follows this job's bandwidth share as other transfers come and go
+                transfer.attach(ydl.params)
+                download_with_info(ydl, url, video_info)
+        finally:
+            release_ffmpeg()
+        job.record(output_path=saved[-1] if saved else None)
+        return saved[-1] if saved else None
+
+    def store_key():
+        return make_store_key(video_info, ydl_opts['format'], plan.ydl_options(), url)
 
     # Try direct download
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
-        return jsonify({"message": "✅ Download Complete!"})
+        configure(ydl_opts['format'])
+        path, how = stored_download(job, store_key(), produce)
+        return {"status": "success", "message": "✅ Download Complete!", "store": how,
+                "postprocessing": plan.to_dict(), **staged_file(path)}
+    except AdmissionError as e:
+        return {"status": "error", "message": f"❌ {e}"}
     except Exception as e:
+        job.check_cancelled()
         print(f"[ERROR] {e}")
         if not force_download:
-            return jsonify({"message": f"Error: {str(e)}"})
+            return {"status": "error", "message": f"Error: {str(e)}"}
 
     # Fallbacks (only reached if exception occurs AND force_download is true)
     if force_download:
         try:
-            ydl_opts['format'] = 'best'
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-            return jsonify({"status": "success", "message": "✅ Forced default format download complete."})
+            configure('best')
+            path, how = stored_download(job, store_key(), produce)
+            return {"status": "success", "message": "✅ Forced default format download complete.", "store": how,
+                    "postprocessing": plan.to_dict(), **staged_file(path)}
+        except AdmissionError as e:
+            return {"status": "error", "message": f"❌ {e}"}
         except Exception as e:
+            job.check_cancelled()
             print(f"[FORCE ERROR] {e}")
             # Final Fallback using ffmpeg if smart URL exists
+            if real_url is None and discovered:
+                real_url = stream_ranker.rank(discovered, cancel=job.cancel_event).best
             if real_url:
                 print("🔁 Trying final ffmpeg fallback with real URL...")
-                success, message = smart_fallback_download(real_url)
+                success, message = stored_fallback_download(job, real_url)
                 if success:
-                    return jsonify({"status": "success", "message": "✅ Smart fallback download complete!"})
+                    return {"status": "success", "message": "✅ Smart fallback download complete!", **staged_file(message)}
                 else:
-                    return jsonify({"status": "error", "message": f"❌ Smart fallback failed: {message}"})
+                    return {"status": "error", "message": f"❌ Smart fallback failed: {message}"}
+
+            # Last resort: the external downloaders, probed and raced
+            fallback = try_alternative_downloads(url, cancel=job.cancel_event)
+            job.check_cancelled()
+            if fallback["success"]:
+                return {"status": "success", "message": f"✅ Downloaded using {fallback['backend']}.", "fallback": fallback,
+                        **staged_file(fallback["output_path"])}
+
+            return {"status": "error", "message": f"Force Download Failed: {str(e)}", "fallback": fallback}
+
+    return {"status": "error", "message": "❌ Download failed. Try a different format or force download."}
+
 
-            return jsonify({"status": "error", "message": f"Force Download Failed: {str(e)}"})
+def client_id():
+    """ Who is asking: the peer address, or the address TRUSTED_PROXIES proxies saw it come from """
+    return request.remote_addr or ""
 
-    return jsonify({"status": "error", "message": "❌ Download failed. Try a different format or force download."})
 
+def disk_full_response():
+    return jsonify({"status": "error", "message": "❌ The server is low on disk space. Try again later."}), 507
+
+
+def enqueue_job(kind, func, *args, **kwargs):
+    """ Queue a job and build the HTTP response for it """
+    if not governor.disk_ok(DEFAULT_DOWNLOAD_FOLDER):
+        return disk_full_response()
+    try:
+        job = job_queue.submit(kind, func, *args, owner=client_id(), **kwargs)
+    except QueueFullError as e:
+        return jsonify({"status": "error", "message": f"❌ {e} Try again shortly."}), 503
+    return jsonify({"status": "queued", "job_id": job.id}), 202
+
+
+@app.route("/download", methods=["POST"])
+def download():
+    data = request.json
+    url = data.get("url")
+    if not url:
+        return jsonify({"status": "error", "message": "❌ Missing URL."}), 400
+    format_id = data.get("format_id")
+    force_download = data.get("force_download", False)  # Force fallback
+    # A prefetch of exactly this download becomes the job; this client's other prefetches are dropped
+    job_id = speculator.claim(client_id(), url, None if force_download else format_id, data.get("speculation"))
+    if job_id:
+        return jsonify({"status": "queued", "job_id": job_id, "prefetched": True}), 202
+    return enqueue_job("video", run_download_job, url, format_id, force_download)
+
+
+def select_formats(url, format_spec):
+    """ Resolve url (through the extraction cache) and pick the formats format_spec selects """
+    video_info = get_video_info(url)
+    if not video_info:
+        raise ValueError("Unable to fetch video information.")
+    return choose_formats(video_info, format_spec)
+
+
+def choose_formats(video_info, format_spec):
+    """ The formats format_spec selects from an extracted info dict, plus the resolved info """
+    with yt_dlp.YoutubeDL({"quiet": True, "no_warnings": True, "simulate": True, "format": format_spec}) as ydl:
+        selected = ydl.process_ie_result(copy.deepcopy(video_info), download=False)
+    return selected.get("requested_formats") or [selected], selected
+
+
+@app.route("/stream", methods=["POST"])
+def create_stream():
+    """ Register a job whose output is piped to the client by GET /stream/<job_id> """
+    data = request.json
+    url = data.get("url")
+    if not url:
+        return jsonify({"status": "error", "message": "❌ Missing URL."}), 400
+    kind = "audio" if data.get("kind") == "audio" else "video"
+    audio_format = data.get("audio_format", "mp3")
+    bitrate = data.get("bitrate")
+    if audio_format not in AUDIO_FORMATS or (bitrate and bitrate not in AUDIO_BITRATES):
+        return jsonify({"status": "error", "message": "❌ Unsupported audio format or bitrate."}), 400
+    speculator.drop(client_id(), data.get("speculation"), "the client chose to stream instead")
+    job = job_queue.register("stream", owner=client_id(), url=url, format_id=data.get("format_id"), media=kind,
+                             audio_format=audio_format, bitrate=bitrate)
+    if broker is not None and BROKER_NODE_URL:
+        # Only this node can pipe it; the others relay GET /stream/<job_id> here
+        job.record(node_url=BROKER_NODE_URL)
+        job.set_status(QUEUED, "Waiting for the client")
+    return jsonify({"status": "ready", "job_id": job.id, "stream_url": f"/stream/{job.id}"}), 201
+
+
+@app.route("/stream/<job_id>")
+def stream(job_id):
+    """ Pipe ffmpeg's output straight to the response; nothing is staged on disk """
+    job = job_queue.get(job_id)
+    if job is None and broker is not None and not request.headers.get(PROXY_HOP_HEADER):
+        # Registered on another node: the broker has its state, which says where
+        state = job_queue.lookup(job_id)
+        node = state and state["kind"] == "stream" and state["details"].get("node_url")
+        if node and node != BROKER_NODE_URL:
+            return proxy_to_node(node, f"/stream/{quote(job_id)}", "stream", chunk_size=PROXY_STREAM_CHUNK)
+    if job is None or job.kind != "stream":
+        return jsonify({"status": "error", "message": "❌ Unknown stream."}), 404
+    if job.status != QUEUED:
+        return jsonify({"status": "error", "message": "❌ This stream was already started."}), 409
+    job.started_at = time.time()
+    job.set_status(RUNNING, "Resolving stream...")
+
+    params = job.kwargs
+    default_spec = "bestaudio/best" if params["media"] == "audio" else "bestvideo+bestaudio/best"
+    format_id = params.get("format_id")
+    if not format_id or format_id == "convert_to_mp3":
+        format_id = default_spec
+    try:
+        formats, selected = select_formats(params["url"], format_id)
+        cmd, mimetype, ext = stream_command(formats, params["media"], params["audio_format"], params["bitrate"])
+    except (StreamNotSupported, ValueError, yt_dlp.utils.YoutubeDLError) as e:
+        job.set_status(FAILED, f"Error: {e}")
+        return jsonify({"status": "error", "message": f"❌ {e} Use /download instead."}), 422
+
+    try:
+        slot = governor.ffmpeg(wait=False)
+    except Busy as e:
+        job.set_status(FAILED, f"Error: {e}")
+        return jsonify({"status": "error", "message": f"❌ {e} Try again shortly or use /download."}), 503
+    transfer = governor.transfer(job.owner, "stream", job.id, job.cancel_event)
+
+    job.set_status(RUNNING, "Streaming")
+    sent = [0]
+
+    def on_chunk(size):
+        sent[0] += size
+        bytes_transferred.inc(size, path="stream")
+        # Blocking here holds back the read, and the pipe holds back ffmpeg
+        transfer.consume(size)
+        # Whole megabytes only, so progress listeners are not woken for every chunk
+        job.update_progress(status="Streaming...", downloaded_bytes=sent[0] - sent[0] % (1024 * 1024))
+
+    def generate():
+        try:
+            for chunk in pipe_process(cmd, cancel=job.cancel_event, on_chunk=on_chunk):
+                yield chunk
+        except GeneratorExit:
+            # Client went away; closing the pipe generator has already killed ffmpeg
+            job.set_status(CANCELLED, "Client disconnected")
+            raise
+        except Exception as e:
+            print(f"❌ Stream {job.id} failed: {e}")
+            job.set_status(FAILED, f"Error: {e}")
+        else:
+            job.update_progress(status="Stream complete!", percent=100.0, downloaded_bytes=sent[0])
+            job.set_status(CANCELLED if job.cancelled else FINISHED, "Cancelled" if job.cancelled else "Done")
+
+    title = selected.get("title") or "download"
+    filename = f"{title}.{ext}"
+    headers = {
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}",
+        "Cache-Control": "no-store",
+        "X-Accel-Buffering": "no",
+    }
+    # Released when the response is closed, even if the body was never iterated
+    return Response(ClosingIterator(generate(), [slot.release, transfer.close]), mimetype=mimetype, headers=headers)
+
+
+def proxy_to_node(node_url, path, what, chunk_size=1024 * 1024):
+    """ Relay path from the node holding it, passing Range and conditional headers through """
+    headers = {k: v for k, v in request.headers.items() if k in PROXY_REQUEST_HEADERS}
+    headers[PROXY_HOP_HEADER] = "1"
+    try:
+        upstream = requests.get(f"{node_url}{path}", headers=headers, stream=True, timeout=30)
+    except requests.RequestException as e:
+        return jsonify({"status": "error", "message": f"❌ The node holding this {what} is unreachable: {e}"}), 502
+
+    def relay():
+        for chunk in upstream.iter_content(chunk_size):
+            bytes_transferred.inc(len(chunk), path="proxy")
+            yield chunk
+
+    response_headers = {k: v for k, v in upstream.headers.items() if k in PROXY_RESPONSE_HEADERS}
+    return Response(ClosingIterator(relay(), [upstream.close]), status=upstream.status_code, headers=response_headers)
+
+
+@app.route("/files/<path:filename>")
+def staged_download(filename):
+    """ Serve a staged file; conditional=True enables HTTP Range and If-Modified-Since """
+    if (download_index is not None and not request.headers.get(PROXY_HOP_HEADER)
+            and not os.path.exists(os.path.join(DEFAULT_DOWNLOAD_FOLDER, filename))):
+        # Finished on another node: the download index says which
+        node = download_index.where(filename)
+        if node:
+            return proxy_to_node(node, f"/files/{quote(filename)}", "file")
+    response = send_from_directory(os.path.abspath(DEFAULT_DOWNLOAD_FOLDER), filename, as_attachment=True, conditional=True)
+    # Files from the download store stay pinned until the response is fully sent
+    if request.method != "GET" or response.status_code not in (200, 206):
+        return response  # No body will be sent
+    entry = download_store.acquire(os.path.join(DEFAULT_DOWNLOAD_FOLDER, filename))
+    if entry is not None:
+        # Wrapping the body (not call_on_close) because passthrough file responses skip Response.close
+        response.response = ClosingIterator(response.response, lambda: download_store.release(entry))
+    return response
+
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    """ Status of a job, including jobs another worker runs (read from the job store) """
+    job = job_queue.lookup(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "❌ Unknown job."}), 404
+    return jsonify(job)
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "❌ Unknown job."}), 404
+    return jsonify(job)
+
+
+@app.route("/jobs")
+def jobs_overview():
+    return jsonify(job_queue.stats())
+
+
+@app.route("/cache/stats")
+def cache_stats():
+    return jsonify(extraction_cache.stats())
+
+
+@app.route("/store/stats")
+def store_stats():
+    return jsonify(download_store.stats())
+
+
+@app.route("/thumb/<thumb_id>")
+def thumbnail(thumb_id):
+    """ Cached thumbnail resized to ?w= (rounded up to a configured width) """
+    width = request.args.get("w", THUMB_DEFAULT_WIDTH, type=int)
+    try:
+        path, mimetype = thumbnail_cache.variant(thumb_id, width)
+    except KeyError:
+        return jsonify({"error": "Unknown thumbnail."}), 404
+    except ThumbnailError as e:
+        return jsonify({"error": str(e)}), 502
+    # ETag from the file's mtime and size; If-None-Match gets a 304
+    response = send_file(path, mimetype=mimetype, conditional=True, etag=True, max_age=THUMB_MAX_AGE)
+    response.cache_control.public = True
+    # Only ever an image: no sniffing it into something else, nothing it could load or run
+    response.headers["X-Content-Type-Options"] = "nosniff"
+    response.headers["Content-Security-Policy"] = "default-src 'none'; sandbox"
+    return response
+
+
+@app.route("/thumbnails/stats")
+def thumbnail_stats():
+    return jsonify(thumbnail_cache.stats())
+
+
+@app.route("/broker")
+def broker_stats():
+    """ The broker backend and this node's share of the distributed work """
+    if broker is None:
+        return jsonify({"backend": None})
+    return jsonify(dict(broker.stats(), node_url=BROKER_NODE_URL or None, jobs=job_queue.stats()))
+
+
+@app.route("/speculation/cancel", methods=["POST"])
+def cancel_speculation():
+    """ The page is going away (sent as a beacon with the speculation id): drop its unclaimed prefetch """
+    return jsonify({"dropped": speculator.drop(client_id(), request.form.get("speculation"), "the page was closed")})
+
+
+@app.route("/speculation/stats")
+def speculation_stats():
+    return jsonify(speculator.stats())
+
+
+@app.route("/ranking/stats")
+def ranking_stats():
+    """ Stream probe cache and timeouts """
+    return jsonify(stream_ranker.stats())
+
+
+@app.route("/governor")
+def governor_stats():
+    """ Current bandwidth shares, ffmpeg slots and disk reservations """
+    return jsonify(governor.stats(DEFAULT_DOWNLOAD_FOLDER))
+
+
+@app.route("/tuning/stats")
+def tuning_stats():
+    return jsonify(download_tuner.stats())
+
+
+def register_metrics():
+    """ Gauges and counters read from the existing stats at scrape time """
+    def by(stats, *fields):
+        values = stats()
+        return {(field,): values[field] for field in fields}
+
+    registry.collect("jobs", "Jobs by state.", lambda: {(k,): v for k, v in job_queue.stats()["jobs"].items()},
+                     labels=("state",))
+    registry.collect("jobs_active", "Jobs running on a worker.", job_queue.active)
+    registry.collect("queue_depth", "Jobs waiting for a worker.", job_queue.depth)
+    registry.collect("extract_cache_lookups_total", "Extraction cache lookups by result.",
+                     lambda: by(extraction_cache.stats, "hits", "shared_hits", "misses"), "counter", ("result",))
+    registry.collect("catalogue_cache_lookups_total", "Format catalogue cache lookups by result.",
+                     lambda: by(catalogue_cache.stats, "hits", "misses"), "counter", ("result",))
+    registry.collect("download_store_lookups_total", "Download store lookups by result.",
+                     lambda: by(download_store.stats, "hits", "coalesced", "misses"), "counter", ("result",))
+    registry.collect("download_store_bytes", "Bytes held by finished downloads.", lambda: download_store.stats()["bytes"])
+    registry.collect("thumbnail_cache_bytes", "Bytes held by cached thumbnails.", lambda: thumbnail_cache.stats()["bytes"])
+    registry.collect("speculations_total", "Speculative prefetches by outcome.",
+                     lambda: by(speculator.stats, "started", "claimed", "abandoned", "skipped"), "counter", ("outcome",))
+    registry.collect("download_store_evictions_total", "Finished downloads evicted.",
+                     lambda: download_store.stats()["evictions"], "counter")
+    registry.collect("browsers_live", "Live pooled browsers.",
+                     lambda: {("selenium",): browser_pool.stats()["live"], ("playwright",): playwright_pool.stats()["live"]},
+                     labels=("pool",))
+    registry.collect("browser_leases_total", "Selenium browser leases.", lambda: browser_pool.stats()["leases"], "counter")
+    registry.collect("subprocesses_live", "Live fallback/ffmpeg subprocesses.", live_process_count)
+    registry.collect("startup_import_seconds", "Seconds this worker's app import took.", lambda: startup["import_seconds"])
+    registry.collect("ffmpeg_processes", "ffmpeg slots by state.",
+                     lambda: {(k,): governor.stats()["ffmpeg"][k] for k in ("running", "waiting")}, labels=("state",))
+    registry.collect("bandwidth_allocated_bytes", "Bytes/second shared out to running transfers.",
+                     lambda: governor.stats()["bandwidth"]["allocated"])
+    registry.collect("batches_running", "Batches still feeding items.", lambda: batch_runner.stats()["batches"][RUNNING])
+
+
+@app.route("/metrics")
+def metrics():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/ready")
+def ready():
+    """ 200 once this worker has its backends loaded and browsers warmed, 503 until then """
+    body = {
+        "ready": startup["backends_ready"] and startup["browsers_ready"],
+        "import_seconds": startup["import_seconds"],
+        "backends": load_times(),
+        "browsers": browser_pool.stats(),
+        "download_folder": os.path.isdir(DEFAULT_DOWNLOAD_FOLDER),
+        "warm_error": startup["warm_error"],
+    }
+    return jsonify(body), 200 if body["ready"] else 503
+
+
+@app.route("/browsers/stats")
+def browser_stats():
+    return jsonify({"selenium": browser_pool.stats(), "playwright": playwright_pool.stats()})
+
+
+def job_updates(job):
+    """ Snapshots of a job in this process as it changes (None every PROGRESS_KEEPALIVE seconds without one) """
+    seen = -1
+    while True:
+        seen, snapshot = job.wait_for_update(seen, timeout=PROGRESS_KEEPALIVE)
+        yield snapshot
+
+
+@app.route('/progress/<job_id>')
+def progress(job_id):
+    """ Stream a job's progress, pushing an event only when it changes """
+    job = job_queue.get(job_id)
+    if job is not None:
+        updates = job_updates(job)
+    else:
+        # Running on another node: relay what it publishes through the broker
+        updates = job_queue.follow(job_id, PROGRESS_KEEPALIVE)
+        if updates is None:
+            return jsonify({"status": "error", "message": "❌ Unknown job."}), 404
 
-@app.route('/progress')
-def progress():
-    """ Stream real-time download progress """
     def event_stream():
-        while True:
-            time.sleep(1)  # Send updates every 1 second
-            yield f"data: {json.dumps(progress_data)}\n\n"
+        try:
+            for snapshot in updates:
+                if snapshot is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"data: {json.dumps(snapshot)}\n\n"
+                if snapshot["state"] in FINAL_STATES:
+                    break
+        finally:
+            updates.close()
 
-    return Response(event_stream(), content_type='text/event-stream')
+    return Response(event_stream(), content_type='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
-def download_video(url, format_id):
-    global pbar  # Define progress bar globally inside function
+def download_video(url, format_id, job=None):
 
     if not format_id or format_id.lower() == "none":
         format_id = "best"  # Fallback to best available format
@@ -439,100 +1050,124 @@ def download_video(url, format_id):
     ydl_opts = {
         "format": format_id if format_id and format_id.lower() != "none" else "bestvideo+bestaudio/best",  # Download selected format
         "outtmpl": os.path.join(DEFAULT_DOWNLOAD_FOLDER, "%(title)s.%(ext)s"),  # Save with video title
-        "progress_hooks": [progress_hook],  # Attach progress hook
+        "progress_hooks": [make_progress_hook(job)] if job else [],  # Attach progress hook
         "cookiefile": COOKIES_FILE,
         "cachedir": True,
         "merge_output_format": "mp4",
         "nocheckcertificate": True,
         "hls_prefer_native": True,
         "embed-metadata": True,
-        "force_overwrites": True,
+        # Keep finished files and resume .part files instead of starting over
+        "continuedl": True,
         "noplaylist": True,
         "retries": 50,
         "postprocessors": [{
             'key': 'FFmpegVideoConvertor',
             'preferedformat': 'mp4',
         }],
-        "force-ipv4": True,
-        "buffer-size": "128M",
-        "throttled-rate": None,
-        "fragment-retries": 50,
-        "concurrent-fragments": 32,
-        "external_downloader": "aria2c",
-        "external_downloader_args": ["-x", "64", "-s", "64", "-k", "8M"],
+        "source_address": "0.0.0.0",  # Force IPv4
+        "fragment_retries": 50,
     }
 
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        # Fragment concurrency, chunk size and the external downloader come from the per-host tuning
+        with download_tuner.session(url) as tuning, yt_dlp.YoutubeDL(dict(
+                ydl_opts, **tuning.ydl_options(), progress_hooks=ydl_opts["progress_hooks"] + [tuning.hook])) as ydl:
             ydl.download([url])
             print("✅ Download complete!\n")
             print(f"✅ Downloaded file saved at: {os.path.join(DEFAULT_DOWNLOAD_FOLDER, '%(title)s.%(ext)s')}")
-            return jsonify({"status": "success", "message": "Download completed!"})
+            return {"status": "success", "message": "Download completed!"}
 
 
     except yt_dlp.utils.DownloadError:
-        print("\n❌ yt-dlp failed! \n Trying streamlink as a backup...\n")
-        return try_alternative_downloads(url)
+        print("\n❌ yt-dlp failed! \n Trying the fallback downloaders...\n")
+        fallback = try_alternative_downloads(url, cancel=job.cancel_event if job else None)
+        if fallback["success"]:
+            return {"status": "success", "message": f"✅ Downloaded using {fallback['backend']}.", "fallback": fallback}
+        return {"status": "error", "message": "❌ All fallback downloaders failed.", "fallback": fallback}
 
 
 
-def try_alternative_downloads(url):
-    """Try backup download methods."""
-    methods = [streamlink_download, ffmpeg_download, mpv_download, aria2c_download, detect_blob_video]
+def try_alternative_downloads(url, cancel=None):
+    """Try backup download methods: probe once, race the viable ones, then blob detection."""
+    result = run_fallbacks(url, FALLBACK_BACKENDS, fallback_output_path, cancel=cancel)
+    if result["success"] or (cancel is not None and cancel.is_set()):
+        return result
 
-    for method in methods:
-        if method(url):
-            return True
+    with span("fallback", "blob") as stage:
+        success, output_path = detect_blob_video(url, cancel=cancel)
+        if not success:
+            stage["outcome"] = "no_result"
+    result["attempts"]["Blob"] = {"viable": True, "outcome": "won" if success else "no result"}
+    if success:
+        result.update(success=True, backend="Blob", output_path=output_path)
+    return result
 
-    return False
 
+def fallback_output_path(backend):
+    """Unique output file per attempt so concurrent jobs and racing backends never collide."""
+    return os.path.join(ensure_download_folder(), f"{backend.name.lower()}_{uuid.uuid4().hex[:8]}.mp4")
 
-def streamlink_download(url):
-    """Try downloading via Streamlink."""
-    output_path = os.path.join(DEFAULT_DOWNLOAD_FOLDER, "streamlink_output.mp4")
-    cmd = f'streamlink {url} best -o "{output_path}"'
-    return run_command(cmd, "Streamlink")
 
+def streamlink_command(url, output_path):
+    """Download via Streamlink."""
+    return ["streamlink", url, "best", "-o", output_path]
 
-def ffmpeg_download(url):
-    """Try downloading via FFmpeg."""
-    output_path = os.path.join(DEFAULT_DOWNLOAD_FOLDER, "ffmpeg_output.mp4")
-    cmd = f'ffmpeg -hwaccel auto -i "{url}" -c:v libx264 -preset ultrafast -crf 18 -c:a copy "{output_path}"'
-    return run_command(cmd, "FFmpeg")
 
+def ffmpeg_command(url, output_path):
+    """Download via FFmpeg, re-encoding only the streams MP4 can't carry."""
+    plan = plan_for_url(url)
+    print(f"[POSTPROCESS] FFmpeg fallback: {plan.action} ({plan.reason})")
+    hwaccel = ["-hwaccel", "auto"] if plan.action == TRANSCODE else []
+    return ["ffmpeg", "-y", *hwaccel, "-i", url, *plan.codec_args(), output_path]
 
-def mpv_download(url):
-    """Try downloading via MPV."""
-    output_path = os.path.join(DEFAULT_DOWNLOAD_FOLDER, "mpv_output.mp4")
-    cmd = f'mpv "{url}" --stream-record="{output_path}"'
-    return run_command(cmd, "MPV")
 
+def mpv_command(url, output_path):
+    """Download via MPV."""
+    return ["mpv", url, f"--stream-record={output_path}"]
 
-def aria2c_download(url):
-    """Try downloading via Aria2c."""
-    cmd = f'aria2c -x 16 -s 16 -d "{DEFAULT_DOWNLOAD_FOLDER}" "{url}"'
-    return run_command(cmd, "Aria2c")
 
+def aria2c_command(url, output_path):
+    """Download via Aria2c."""
+    return ["aria2c", "-x", "16", "-s", "16",
+            "-d", os.path.dirname(output_path), "-o", os.path.basename(output_path), url]
 
-def detect_blob_video(url):
-    """Try detecting and downloading blob videos."""
-    print("🔍 Checking for Blob URLs...")
-    options = Options()
-    options.add_argument("--headless")
-    service = Service(ChromeDriverManager().install())
-    driver = webdriver.Chrome(service=service, options=options)
 
-    driver.get(url)
-    time.sleep(5)
+# Backends run only when the probe says they can handle the URL; each one is
+# killed after its own timeout instead of holding a worker indefinitely.
+FALLBACK_BACKENDS = [
+    Backend("Streamlink", "streamlink", streamlink_command, accepts=lambda probe: True, timeout=300, priority=0),
+    Backend("FFmpeg", "ffmpeg", ffmpeg_command, accepts=lambda probe: probe.kind is not None, timeout=300, priority=1,
+            slot=governor.ffmpeg),
+    Backend("MPV", "mpv", mpv_command, accepts=lambda probe: probe.kind is not None, timeout=120, priority=2),
+    Backend("Aria2c", "aria2c", aria2c_command, accepts=lambda probe: probe.kind == "media", timeout=300, priority=3),
+]
 
-    page_source = driver.page_source
-    driver.quit()
+
+def detect_blob_video(url, cancel=None):
+    """Try detecting and downloading blob videos. Returns (success, output_path)."""
+    print("🔍 Checking for Blob URLs...")
+    try:
+        with browser_pool.lease(cancel=cancel) as driver:
+            driver.get(url)
+            time.sleep(5)
+            page_source = driver.page_source
+    except Exception as e:
+        print(f"[BLOB ERROR] {e}")
+        return False, None
 
     blob_url = extract_blob_url(page_source)
     if blob_url:
-        return ffmpeg_download(blob_url)
+        output_path = os.path.join(ensure_download_folder(), f"blob_{uuid.uuid4().hex[:8]}.mp4")
+        try:
+            slot = governor.ffmpeg(cancel)
+        except InterruptedError:
+            return False, None
+        with slot:
+            if run_command(ffmpeg_command(blob_url, output_path), "FFmpeg", timeout=300, cancel=cancel):
+                return True, output_path
 
-    return False
+    return False, None
 
 
 def extract_blob_url(html):
@@ -542,58 +1177,205 @@ def extract_blob_url(html):
     return match.group(0) if match else None
 
 
-def run_command(cmd, method_name):
-    """Run a command and return success status."""
+def run_command(cmd, method_name, timeout=None, cancel=None):
+    """Run a command (argument list) and return success status."""
     try:
-        subprocess.run(cmd, shell=True, check=True)
+        returncode, timed_out = run_process(cmd, timeout=timeout, cancel=cancel)
+    except OSError as e:
+        print(f"❌ {method_name} failed: {e}")
+        return False
+    if returncode == 0:
         print(f"✅ Downloaded using {method_name}.")
         return True
-    except subprocess.CalledProcessError:
-        print(f"❌ {method_name} failed.")
-        return False
+    print(f"❌ {method_name} {'timed out' if timed_out else 'failed'}.")
+    return False
+
+@job_queue.resumable
+def run_mp3_job(job, url, format_id=None, audio_format="mp3", bitrate=None):
+    """ Worker-side body of /download_mp3. Returns a result dict for the job. """
+    job.update_progress(status=f"Starting {audio_format.upper()} download...")
+
+    try:
+        # The page offers a "convert_to_mp3" pseudo format; anything else is a real format id
+        format_spec = format_id if format_id and format_id != "convert_to_mp3" else "bestaudio/best"
+        formats, selected = select_formats(url, format_spec)
+        fmt = formats[0]
+        title = yt_dlp.utils.sanitize_filename(selected.get("title") or "audio")
+        ext = AUDIO_FORMATS[audio_format][2]
+        copied = audio_codec_args(fmt, audio_format, bitrate)[3]
+        job.record(format=format_spec, resolved_url=fmt.get("url"))
+
+        def produce(workdir):
+            with governor.admit(workdir, estimate_bytes(formats, selected.get("duration"))):
+                return convert(workdir)
+
+        def convert(workdir):
+            job.record(output_dir=workdir)
+            output_path = os.path.join(workdir, f"{title}.{ext}")
+            part_path = output_path + ".part"
+            try:
+                # Single pass: ffmpeg reads the source URL and writes the final file
+                cmd = audio_file_command(fmt, part_path, audio_format, bitrate)[0]
+                staged_source = None
+            except StreamNotSupported:
+                # Fragmented sources ffmpeg can't read directly are fetched by yt-dlp first;
+                # the source stays in the store directory until conversion succeeds
+                staged_source = os.path.join(workdir, "source")
+                with governor.transfer(job.owner, "download", job.id, job.cancel_event) as transfer, \
+                        span("download", "yt-dlp"), download_tuner.session(url) as tuning, yt_dlp.YoutubeDL({
+                            'format': format_spec,
+                            'outtmpl': staged_source,
+                            'progress_hooks': [make_progress_hook(job), tuning.hook, transfer.hook],
+                            'cookiefile': COOKIES_FILE,
+                            'nocheckcertificate': True,
+                            **tuning.ydl_options(),
+                        }) as ydl:
+                    transfer.attach(ydl.params)
+                    download_with_info(ydl, url, selected)
+                job.check_cancelled()
+                cmd = audio_file_command({"url": staged_source, "protocol": "file", "acodec": fmt.get("acodec")},
+                                         part_path, audio_format, bitrate)[0]
+
+            with governor.ffmpeg(job.cancel_event, on_wait=lambda: job.update_progress(status="Waiting for a converter...")):
+                job.update_progress(status="Copying audio..." if copied else "Converting...")
+                with span("conversion", "copy" if copied else audio_format):
+                    follow_ffmpeg_progress(cmd, job, selected.get("duration"))
+            job.check_cancelled()
+            os.replace(part_path, output_path)
+            if staged_source and os.path.exists(staged_source):
+                os.remove(staged_source)
+            job.record(output_path=output_path)
+            return output_path
+
+        key = make_store_key(selected, format_spec, {"audio_format": audio_format, "bitrate": bitrate}, url)
+        output_path, how = stored_download(job, key, produce)
+
+        job.update_progress(status=f"{audio_format.upper()} Conversion Done!", percent=100.0)
+        return {
+            "status": "success",
+            "message": f"✅ {audio_format.upper()} download and conversion complete!",
+            "audio": {"format": audio_format, "copied": copied, "bitrate": None if copied else (bitrate or DEFAULT_AUDIO_BITRATE)},
+            "store": how,
+            **staged_file(output_path),
+        }
+
+    except Exception as e:
+        job.update_progress(status=f"{audio_format.upper()} Conversion Failed")
+        job.check_cancelled()
+        print(f"❌ Error in MP3 conversion: {e}")
+        return {"status": "error", "message": f"MP3 download/conversion failed: {str(e)}"}
+
+
+def follow_ffmpeg_progress(cmd, job, duration):
+    """ Run an ffmpeg command that has -progress pipe:1 and publish its position on the job """
+    buffer = b""
+    for chunk in pipe_process(cmd, cancel=job.cancel_event):
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            key, _, value = line.decode("utf-8", "ignore").strip().partition("=")
+            if key == "out_time_us" and duration and value.isdigit():
+                job.update_progress(percent=min(99.9, round(int(value) / 1e6 * 100 / duration, 1)))
+
 
 @app.route("/download_mp3", methods=["POST"])
 def download_mp3():
-    global progress_data
     data = request.json
     url = data.get("url")
+    if not url:
+        return jsonify({"status": "error", "message": "❌ Missing URL."}), 400
     format_id = data.get("format_id")
-
-    progress_data = {"status": "Starting MP3 download...", "progress": 0}
-
-    # Temporary file path
-    output_path = os.path.join(DEFAULT_DOWNLOAD_FOLDER, "temp_audio.mp4")
-
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'outtmpl': output_path,
-        'progress_hooks': [progress_hook],
-        'cookiefile': COOKIES_FILE,
-        'nocheckcertificate': True
+    audio_format = data.get("audio_format", "mp3")
+    bitrate = data.get("bitrate")
+    if audio_format not in AUDIO_FORMATS:
+        return jsonify({"status": "error", "message": f"❌ Unsupported audio format. Pick one of: {', '.join(AUDIO_FORMATS)}."}), 400
+    if bitrate and bitrate not in AUDIO_BITRATES:
+        return jsonify({"status": "error", "message": f"❌ Unsupported bitrate. Pick one of: {', '.join(AUDIO_BITRATES)}."}), 400
+    speculator.drop(client_id(), data.get("speculation"), "the client chose audio instead")
+    return enqueue_job("audio", run_mp3_job, url, format_id, audio_format, bitrate)
+
+
+def batch_item_job(entry, options):
+    """ Job for one batch item: the same worker bodies as /download and /download_mp3 """
+    if options.get("audio"):
+        return "audio", run_mp3_job, (entry["url"], options.get("format_id"),
+                                      options.get("audio_format", "mp3"), options.get("bitrate")), {}
+    return "video", run_download_job, (entry["url"], options.get("format_id"), options.get("force_download", False)), {}
+
+
+# Batch items share job_queue with single downloads
+batch_runner = BatchRunner(job_queue, batch_item_job)
+# Prefetches what /get_formats callers will probably download (SPECULATE=1)
+speculator = Speculator(job_queue, governor, download_store, run_download_job)
+register_metrics()
+
+
+@app.route("/batch", methods=["POST"])
+def create_batch():
+    """ Download a list of URLs and/or playlist/channel URLs; results stream from /batch/<id>/events """
+    data = request.json or {}
+    sources = data.get("urls") or ([data["url"]] if data.get("url") else [])
+    if not isinstance(sources, list) or not sources or not all(isinstance(u, str) and u for u in sources):
+        return jsonify({"status": "error", "message": "❌ Provide \"urls\" (a list) or a playlist \"url\"."}), 400
+    options = {
+        "format_id": data.get("format_id"),
+        "force_download": bool(data.get("force_download", False)),
+        "audio": bool(data.get("audio", False)),
+        "audio_format": data.get("audio_format", "mp3"),
+        "bitrate": data.get("bitrate"),
     }
+    if options["audio"] and (options["audio_format"] not in AUDIO_FORMATS or
+                             (options["bitrate"] and options["bitrate"] not in AUDIO_BITRATES)):
+        return jsonify({"status": "error", "message": "❌ Unsupported audio format or bitrate."}), 400
+    if not governor.disk_ok(DEFAULT_DOWNLOAD_FOLDER):
+        return disk_full_response()
+    batch = batch_runner.start(sources, options, owner=client_id())
+    return jsonify({"status": "queued", "batch_id": batch.id, "status_url": f"/batch/{batch.id}",
+                    "events_url": f"/batch/{batch.id}/events"}), 202
+
+
+@app.route("/batch/<batch_id>")
+def batch_status(batch_id):
+    batch = batch_runner.get(batch_id)
+    if batch is None:
+        return jsonify({"status": "error", "message": "❌ Unknown batch."}), 404
+    return jsonify(batch.to_dict())
+
+
+@app.route("/batch/<batch_id>/cancel", methods=["POST"])
+def cancel_batch(batch_id):
+    batch = batch_runner.cancel(batch_id)
+    if batch is None:
+        return jsonify({"status": "error", "message": "❌ Unknown batch."}), 404
+    return jsonify(batch.to_dict())
+
+
+@app.route("/batch/<batch_id>/events")
+def batch_events(batch_id):
+    """ Stream a batch's item events as they happen, replaying the ones already sent """
+    batch = batch_runner.get(batch_id)
+    if batch is None:
+        return jsonify({"status": "error", "message": "❌ Unknown batch."}), 404
 
-    try:
-        # Step 1: Download the best audio/video
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
-
-        # Step 2: Convert it to MP3 using ffmpeg
-        mp3_path = os.path.join(DEFAULT_DOWNLOAD_FOLDER, "converted_audio.mp3")
-        ffmpeg_cmd = f'ffmpeg -y -i "{output_path}" -vn -ab 192k -ar 44100 -f mp3 "{mp3_path}"'
-        subprocess.run(ffmpeg_cmd, shell=True, check=True)
-
-        # Step 3: Cleanup (optional)
-        if os.path.exists(output_path):
-            os.remove(output_path)
+    def event_stream():
+        seen = 0
+        while True:
+            seen, events = batch.events_since(seen, timeout=PROGRESS_KEEPALIVE)
+            if not events:
+                yield ": keep-alive\n\n"
+                continue
+            for event in events:
+                yield f"data: {json.dumps(event)}\n\n"
+                if event["event"] == "done":
+                    return
 
-        progress_data = {"status": "MP3 Conversion Done!", "progress": "100%"}
-        return jsonify({"message": "✅ MP3 download and conversion complete!"})
+    return Response(event_stream(), content_type='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
-    except Exception as e:
-        progress_data = {"status": "MP3 Conversion Failed", "progress": "0%"}
-        print(f"❌ Error in MP3 conversion: {e}")
-        return jsonify({"error": f"MP3 download/conversion failed: {str(e)}"})
+@app.route("/batches")
+def batches_overview():
+    return jsonify(batch_runner.stats())
 
 
 @app.route('/shortener')
@@ -605,5 +1387,9 @@ def debug_static():
     import os
     return "<br>".join(os.listdir("static"))
 
+startup["import_seconds"] = round(time.perf_counter() - _import_started, 3)
+if startup["import_seconds"] > STARTUP_IMPORT_BUDGET:
+    print(f"⚠️ Importing app took {startup['import_seconds']}s (budget {STARTUP_IMPORT_BUDGET}s)")
+
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,283 @@
+import os
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+from jobs import (CANCELLED, FINAL_STATES, FINISHED, JOB_RETENTION_SECONDS, QUEUED, RUNNING,
+                  CancelToken, QueueFullError)
+from lazy import lazy_import
+
+yt_dlp = lazy_import("yt_dlp")
+
+# Items of one batch downloading at the same time
+BATCH_PARALLEL = int(os.environ.get("BATCH_PARALLEL", "2"))
+# Items downloading from one host at the same time, across all batches
+BATCH_HOST_CONCURRENCY = int(os.environ.get("BATCH_HOST_CONCURRENCY", "2"))
+# Minimum seconds between two item starts against the same host
+BATCH_HOST_INTERVAL = float(os.environ.get("BATCH_HOST_INTERVAL", "1.0"))
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "500"))
+
+POLL_INTERVAL = 0.5
+
+
+class HostLimiter:
+    """Per-host concurrency cap plus a minimum spacing between starts."""
+
+    def __init__(self, concurrency=BATCH_HOST_CONCURRENCY, interval=BATCH_HOST_INTERVAL):
+        self.concurrency = max(1, concurrency)
+        self.interval = interval
+        self._active = {}
+        self._last_start = {}
+        self._lock = threading.Condition()
+
+    def acquire(self, host, cancel=None):
+        """Block until host has a free slot. Returns False if cancelled first."""
+        with self._lock:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    return False
+                wait = self._last_start.get(host, 0) + self.interval - time.time()
+                if self._active.get(host, 0) < self.concurrency and wait <= 0:
+                    self._active[host] = self._active.get(host, 0) + 1
+                    self._last_start[host] = time.time()
+                    return True
+                self._lock.wait(min(POLL_INTERVAL, wait) if wait > 0 else POLL_INTERVAL)
+
+    def release(self, host):
+        with self._lock:
+            self._active[host] = max(0, self._active.get(host, 0) - 1)
+            self._lock.notify_all()
+
+    def stats(self):
+        with self._lock:
+            return {host: count for host, count in self._active.items() if count}
+
+
+def _extractor_key(url):
+    """Key of the first yt-dlp extractor that claims url."""
+    for ie in yt_dlp.extractor.gen_extractor_classes():
+        if ie.suitable(url):
+            return ie.ie_key()
+    return None
+
+
+def expand_sources(sources, cancel=None):
+    """Yield one entry dict per video, expanding playlist and channel URLs lazily.
+
+    Playlists are read with flat extraction, so only the listing is fetched
+    here; each item gets its full extraction when its download runs.
+    """
+    opts = {"quiet": True, "no_warnings": True, "extract_flat": "in_playlist", "lazy_playlist": True}
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        for source in sources:
+            if cancel is not None and cancel.is_set():
+                return
+            if _extractor_key(source) == "Generic":
+                # A plain page or file URL; listing it would just be a second extraction
+                yield {"url": source, "title": None}
+                continue
+            try:
+                info = ydl.extract_info(source, download=False, process=False)
+            except yt_dlp.utils.YoutubeDLError as e:
+                # Not something yt-dlp can list; the item download decides what to do with it
+                print(f"[BATCH] Couldn't expand {source}: {e}")
+                info = None
+            if not info or info.get("_type") not in ("playlist", "multi_video"):
+                yield {"url": source, "title": (info or {}).get("title")}
+                continue
+            yield from _playlist_entries(info, cancel)
+
+
+def _playlist_entries(info, cancel, depth=0):
+    for entry in info.get("entries") or []:
+        if cancel is not None and cancel.is_set():
+            return
+        if not entry:
+            continue
+        if entry.get("_type") in ("playlist", "multi_video") and depth < 2:
+            # Channels list their tabs/playlists as nested playlists
+            yield from _playlist_entries(entry, cancel, depth + 1)
+            continue
+        url = entry.get("webpage_url") or entry.get("url")
+        if url:
+            yield {"url": url, "title": entry.get("title"), "playlist": info.get("title")}
+
+
+class Batch:
+    """A set of downloads scheduled together, with an append-only event log for streaming."""
+
+    def __init__(self, sources, options=None, max_items=BATCH_MAX_ITEMS, owner=None):
+        self.id = uuid.uuid4().hex
+        self.sources = sources
+        self.options = options or {}
+        self.owner = owner
+        self.max_items = max_items
+        self.items = []
+        self.events = []
+        self.status = RUNNING
+        self.expanded = False
+        self.truncated = False
+        self.created_at = time.time()
+        self.finished_at = None
+        self.cancel_event = CancelToken()
+        self._changed = threading.Condition()
+
+    def publish(self, event):
+        with self._changed:
+            self.events.append(event)
+            self._changed.notify_all()
+
+    def events_since(self, index, timeout=None):
+        """Events after index, waiting up to timeout for one. Returns (next_index, events)."""
+        with self._changed:
+            if index >= len(self.events):
+                self._changed.wait(timeout)
+            return len(self.events), self.events[index:]
+
+    def counts(self):
+        counts = {}
+        for item in self.items:
+            counts[item["state"]] = counts.get(item["state"], 0) + 1
+        return counts
+
+    def to_dict(self):
+        return {
+            "batch_id": self.id,
+            "state": self.status,
+            "expanded": self.expanded,
+            "truncated": self.truncated,
+            "total": len(self.items),
+            "counts": self.counts(),
+            "items": [dict(item) for item in self.items],
+        }
+
+
+class BatchRunner:
+    """Feeds batch items into the job queue within the batch and per-host limits.
+
+    Items go through the same JobQueue as single downloads, so the worker
+    pool bounds total concurrency; each batch runs one feeder thread that
+    expands its sources, waits for a slot and reports items as they finish.
+    """
+
+    def __init__(self, job_queue, make_job, parallel=BATCH_PARALLEL, limiter=None,
+                 retention=JOB_RETENTION_SECONDS):
+        self.job_queue = job_queue
+        self.make_job = make_job  # (entry, options) -> (kind, func, args, kwargs)
+        self.parallel = max(1, parallel)
+        self.limiter = limiter or HostLimiter()
+        self.retention = retention
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def start(self, sources, options=None, owner=None):
+        self._prune()
+        batch = Batch(sources, options, owner=owner)
+        with self._lock:
+            self._batches[batch.id] = batch
+        threading.Thread(target=self._feed, args=(batch,), name=f"batch-{batch.id[:8]}", daemon=True).start()
+        return batch
+
+    def get(self, batch_id):
+        with self._lock:
+            return self._batches.get(batch_id)
+
+    def cancel(self, batch_id):
+        batch = self.get(batch_id)
+        if batch is None:
+            return None
+        batch.cancel_event.cancel()
+        for item in batch.items:
+            if item.get("job_id"):
+                self.job_queue.cancel(item["job_id"])
+        return batch
+
+    def stats(self):
+        with self._lock:
+            batches = list(self._batches.values())
+        return {
+            "batches": {state: sum(1 for b in batches if b.status == state) for state in (RUNNING, FINISHED, CANCELLED)},
+            "parallel": self.parallel,
+            "hosts": self.limiter.stats(),
+        }
+
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        with self._lock:
+            for batch_id in [b.id for b in self._batches.values() if b.finished_at and b.finished_at < cutoff]:
+                del self._batches[batch_id]
+
+    def _feed(self, batch):
+        in_flight = {}  # job id -> (item, job)
+        try:
+            for entry in expand_sources(batch.sources, batch.cancel_event):
+                if len(batch.items) >= batch.max_items:
+                    batch.truncated = True
+                    break
+                item = {"index": len(batch.items), "url": entry["url"], "title": entry.get("title"),
+                        "host": (urlsplit(entry["url"]).hostname or "").lower(), "state": "pending",
+                        "job_id": None, "result": None}
+                batch.items.append(item)
+                batch.publish({"event": "item", **item})
+
+                while len(in_flight) >= self.parallel and not batch.cancel_event.is_set():
+                    self._collect(batch, in_flight, wait=True)
+                if not self.limiter.acquire(item["host"], batch.cancel_event):
+                    break
+                job = self._submit(batch, item, entry)
+                if job is None:
+                    self.limiter.release(item["host"])
+                    break
+                in_flight[job.id] = (item, job)
+                self._collect(batch, in_flight)
+
+            batch.expanded = True
+            batch.publish({"event": "expanded", "total": len(batch.items), "truncated": batch.truncated})
+            while in_flight:
+                self._collect(batch, in_flight, wait=True)
+        except Exception as e:
+            print(f"❌ Batch {batch.id} failed: {e}")
+            batch.publish({"event": "error", "message": str(e)})
+            self.cancel(batch.id)
+            while in_flight:
+                self._collect(batch, in_flight, wait=True)
+        finally:
+            for item in batch.items:
+                if item["state"] == "pending":
+                    item["state"] = CANCELLED
+            batch.status = CANCELLED if batch.cancel_event.is_set() else FINISHED
+            batch.finished_at = time.time()
+            batch.publish({"event": "done", "state": batch.status, "counts": batch.counts()})
+
+    def _submit(self, batch, item, entry):
+        kind, func, args, kwargs = self.make_job(entry, batch.options)
+        while not batch.cancel_event.is_set():
+            try:
+                job = self.job_queue.submit(kind, func, *args, owner=batch.owner, **kwargs)
+            except QueueFullError:
+                # Shared with single downloads; wait for room rather than failing the item
+                batch.cancel_event.wait(POLL_INTERVAL * 2)
+                continue
+            item.update(job_id=job.id, state=QUEUED)
+            batch.publish({"event": "item", **item})
+            return job
+        return None
+
+    def _collect(self, batch, in_flight, wait=False):
+        """Report and release items whose jobs reached a final state."""
+        deadline = time.time() + (POLL_INTERVAL if wait else 0)
+        while True:
+            for job_id, (item, job) in list(in_flight.items()):
+                if job.status == RUNNING and item["state"] != RUNNING:
+                    item["state"] = RUNNING
+                    batch.publish({"event": "item", **item})
+                elif job.status in FINAL_STATES:
+                    del in_flight[job_id]
+                    self.limiter.release(item["host"])
+                    item.update(state=job.status, result=job.result or {"message": job.message})
+                    batch.publish({"event": "item", **item})
+                    wait = False
+            if not wait or time.time() >= deadline:
+                return
+            time.sleep(0.1)
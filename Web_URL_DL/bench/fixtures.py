@@ -0,0 +1,178 @@
+"""Local media fixture server for the load tests.
+
+Serves, for every n:
+  /page/<n>             HTML page with a <video> tag (yt-dlp's generic extractor finds it)
+  /hls-page/<n>         HTML page whose <video> points at an HLS playlist
+  /media/<n>.mp4        an MP4 file (Range requests supported)
+  /hls/<n>/index.m3u8   an HLS playlist and its /hls/<n>/seg<i>.ts segments
+
+With ffmpeg installed the media is a real encoded test pattern, so the
+conversion paths do real work; without it the files are synthetic bytes
+that are only good for exercising the download paths.
+"""
+import os
+import re
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SEGMENT_SECONDS = 2
+
+PAGE = """<!DOCTYPE html>
+<html><head><title>Fixture video {n}</title></head>
+<body><h1>Fixture video {n}</h1>
+<video controls><source src="{src}" type="{mimetype}"></video>
+</body></html>
+"""
+
+
+def synthetic_mp4(size):
+    """ftyp + mdat boxes padded to size bytes."""
+    ftyp = struct.pack(">I4s4sI4s4s", 24, b"ftyp", b"isom", 512, b"isom", b"mp41")
+    payload = os.urandom(max(0, size - len(ftyp) - 8))
+    return ftyp + struct.pack(">I4s", len(payload) + 8, b"mdat") + payload
+
+
+def synthetic_ts(size):
+    """MPEG-TS-shaped bytes: 188-byte packets that start with the sync byte."""
+    packet = b"\x47" + b"\x00" * 187
+    return packet * max(1, size // 188)
+
+
+class MediaSet:
+    """The MP4 file and HLS segments every fixture URL serves."""
+
+    def __init__(self, seconds=10, size_mb=4):
+        self.workdir = tempfile.mkdtemp(prefix="bench-media-")
+        self.real = shutil.which("ffmpeg") is not None
+        if self.real:
+            self._encode(seconds)
+        else:
+            self.mp4 = synthetic_mp4(size_mb * 1024 * 1024)
+            count = max(1, seconds // SEGMENT_SECONDS)
+            self.segments = [synthetic_ts(len(self.mp4) // count) for _ in range(count)]
+        self.playlist = self._playlist()
+
+    def _encode(self, seconds):
+        mp4 = os.path.join(self.workdir, "sample.mp4")
+        subprocess.run([
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"testsrc=duration={seconds}:size=640x360:rate=25",
+            "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+            "-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac", "-shortest", mp4,
+        ], check=True)
+        subprocess.run([
+            "ffmpeg", "-y", "-loglevel", "error", "-i", mp4, "-c", "copy", "-f", "hls",
+            "-hls_time", str(SEGMENT_SECONDS), "-hls_list_size", "0",
+            "-hls_segment_filename", os.path.join(self.workdir, "seg%d.ts"),
+            os.path.join(self.workdir, "index.m3u8"),
+        ], check=True)
+        with open(mp4, "rb") as f:
+            self.mp4 = f.read()
+        self.segments = []
+        while os.path.exists(os.path.join(self.workdir, f"seg{len(self.segments)}.ts")):
+            with open(os.path.join(self.workdir, f"seg{len(self.segments)}.ts"), "rb") as f:
+                self.segments.append(f.read())
+
+    def _playlist(self):
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{SEGMENT_SECONDS}", "#EXT-X-MEDIA-SEQUENCE:0"]
+        for i in range(len(self.segments)):
+            lines += [f"#EXTINF:{SEGMENT_SECONDS}.0,", f"seg{i}.ts"]
+        return ("\n".join(lines + ["#EXT-X-ENDLIST"]) + "\n").encode()
+
+    def cleanup(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def make_handler(media):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_HEAD(self):
+            self._serve(head=True)
+
+        def do_GET(self):
+            self._serve(head=False)
+
+        def _serve(self, head):
+            path = self.path.split("?")[0]
+            m = re.fullmatch(r"/page/(\d+)", path)
+            if m:
+                return self._send(PAGE.format(n=m[1], src=f"/media/{m[1]}.mp4", mimetype="video/mp4").encode(),
+                                  "text/html; charset=utf-8", head)
+            m = re.fullmatch(r"/hls-page/(\d+)", path)
+            if m:
+                return self._send(PAGE.format(n=m[1], src=f"/hls/{m[1]}/index.m3u8",
+                                              mimetype="application/x-mpegURL").encode(),
+                                  "text/html; charset=utf-8", head)
+            if re.fullmatch(r"/media/\d+\.mp4", path):
+                return self._send(media.mp4, "video/mp4", head, ranges=True)
+            if re.fullmatch(r"/hls/\d+/index\.m3u8", path):
+                return self._send(media.playlist, "application/vnd.apple.mpegurl", head)
+            m = re.fullmatch(r"/hls/\d+/seg(\d+)\.ts", path)
+            if m and int(m[1]) < len(media.segments):
+                return self._send(media.segments[int(m[1])], "video/mp2t", head, ranges=True)
+            self._send(b"not found", "text/plain", head, status=404)
+
+        def _send(self, body, content_type, head, ranges=False, status=200):
+            start, end = 0, len(body) - 1
+            match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", "")) if ranges else None
+            if match and (match[1] or match[2]):
+                if match[1]:
+                    start, end = int(match[1]), min(int(match[2] or end), end)
+                else:
+                    start = max(0, len(body) - int(match[2]))
+                status = 206
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(end - start + 1))
+            if ranges:
+                self.send_header("Accept-Ranges", "bytes")
+            if status == 206:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+            self.end_headers()
+            if not head:
+                self.wfile.write(body[start:end + 1])
+
+    return Handler
+
+
+class FixtureServer:
+    """Threaded fixture HTTP server on 127.0.0.1; port 0 picks a free port."""
+
+    def __init__(self, port=0, media=None):
+        self.media = media or MediaSet()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), make_handler(self.media))
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.base_url = f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="fixture-server", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.media.cleanup()
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Serve the load-test media fixtures.")
+    parser.add_argument("--port", type=int, default=8765)
+    server = FixtureServer(parser.parse_args().port).start()
+    print(f"Serving fixtures on {server.base_url} ({'encoded' if server.media.real else 'synthetic'} media)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,57 @@
+"""Check how long `import app` takes in a fresh interpreter.
+
+    python bench/import_budget.py --budget 0.5
+    python bench/import_budget.py --top 20
+
+Runs the import under `python -X importtime`, prints the slowest modules
+(cumulative time) and exits 1 when the total is over --budget seconds, so a
+change that drags a heavy backend back into worker startup fails the check.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure():
+    """[(cumulative_us, self_us, module)] for every module `import app` loaded."""
+    env = dict(os.environ, BROWSER_POOL_WARM="0", PYTHONPATH=APP_DIR)
+    env.pop("EXTRACT_CACHE_DB", None)
+    with tempfile.TemporaryDirectory(prefix="import-budget-") as rundir:
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+                              cwd=rundir, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        sys.exit(f"import app failed:\n{proc.stderr}")
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        rows.append((int(cumulative_us), int(self_us), module.rstrip()))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget", type=float, default=float(os.environ.get("STARTUP_IMPORT_BUDGET", "0.5")),
+                        help="seconds `import app` may take")
+    parser.add_argument("--top", type=int, default=15, help="slowest modules to list")
+    args = parser.parse_args()
+
+    rows = measure()
+    total = next(c for c, _, module in rows if module.strip() == "app") / 1e6
+    print(f"{'cumulative':>11} {'self':>9}  module")
+    for cumulative, own, module in sorted(rows, reverse=True)[:args.top]:
+        print(f"{cumulative / 1e6:10.3f}s {own / 1e6:8.3f}s  {module}")
+    print(f"\nimport app: {total:.3f}s (budget {args.budget:.3f}s)")
+    if total > args.budget:
+        print("❌ Over budget")
+        sys.exit(1)
+    print("✅ Within budget")
+
+
+if __name__ == "__main__":
+    main()
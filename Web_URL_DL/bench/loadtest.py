@@ -0,0 +1,308 @@
+"""Load test for the Flask endpoints, run through gunicorn against local fixtures.
+
+    python bench/loadtest.py --concurrency 8 --requests 40
+    python bench/loadtest.py --endpoints get_formats,progress --save-baseline bench/baselines/main.json
+    python bench/loadtest.py --compare bench/baselines/main.json
+
+Each endpoint is driven in turn with --concurrency clients. Reports p50/p95/p99
+latency, throughput, errors, and the peak RSS, open files and subprocesses of
+the gunicorn process tree (sampled from /proc, so those columns are Linux only).
+For /download and /download_mp3 the latency is enqueue-to-finished, followed
+over /progress; for /progress it is enqueue-to-first-event.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from fixtures import FixtureServer
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENDPOINTS = ("get_formats", "download", "download_mp3", "progress")
+SAMPLE_INTERVAL = 0.2
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class ProcessSampler:
+    """Peak RSS, open files and subprocesses of a process tree, read from /proc."""
+
+    def __init__(self, root_pid):
+        self.root_pid = root_pid
+        self.supported = os.path.isdir("/proc")
+        self._stop = threading.Event()
+        self.reset()
+
+    def reset(self):
+        self.peak_rss = 0
+        self.peak_fds = 0
+        self.peak_subprocesses = 0
+
+    def _children(self):
+        children = {}
+        for pid in filter(str.isdigit, os.listdir("/proc")):
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    # The command name may contain spaces; fields after it are fixed
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(pid))
+        return children
+
+    def sample(self):
+        children = self._children()
+        workers = set(children.get(self.root_pid, []))
+        tree, stack = [], [self.root_pid]
+        while stack:
+            pid = stack.pop()
+            tree.append(pid)
+            stack.extend(children.get(pid, []))
+        rss = fds = 0
+        for pid in tree:
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    rss += next(int(line.split()[1]) for line in f if line.startswith("VmRSS:")) * 1024
+                fds += len(os.listdir(f"/proc/{pid}/fd"))
+            except (OSError, StopIteration):
+                continue
+        # Everything below the gunicorn master except its workers: ffmpeg, browsers, ...
+        subprocesses = len(tree) - 1 - len(workers)
+        self.peak_rss = max(self.peak_rss, rss)
+        self.peak_fds = max(self.peak_fds, fds)
+        self.peak_subprocesses = max(self.peak_subprocesses, subprocesses)
+
+    def run(self):
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            self.sample()
+
+    def start(self):
+        if self.supported:
+            threading.Thread(target=self.run, name="sampler", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+
+def start_gunicorn(args, port, rundir):
+    env = dict(os.environ, BROWSER_POOL_WARM="1" if args.warm_browsers else "0", PYTHONUNBUFFERED="1")
+    env.pop("EXTRACT_CACHE_DB", None)
+    cmd = [sys.executable, "-m", "gunicorn", "app:app", "--bind", f"127.0.0.1:{port}",
+           "--workers", str(args.workers), "--threads", str(args.threads), "--timeout", "600",
+           "--chdir", rundir, "--pythonpath", APP_DIR, "--config", os.path.join(APP_DIR, "gunicorn.conf.py")]
+    log = open(os.path.join(rundir, "gunicorn.log"), "wb")
+    proc = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with {proc.returncode}; see {log.name}")
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/ready", timeout=1).ok:
+                return proc
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError("gunicorn did not become ready in 60s")
+
+
+def follow_job(session, base, job_id, first_event_only=False, timeout=600):
+    """Read /progress/<job_id> until the job finishes (or the first event). Returns the final state."""
+    with session.get(f"{base}/progress/{job_id}", stream=True, timeout=timeout) as resp:
+        for line in resp.iter_lines():
+            if not line.startswith(b"data: "):
+                continue
+            event = json.loads(line[6:])
+            if first_event_only or event["state"] in ("finished", "failed", "cancelled"):
+                return event["state"]
+    return None
+
+
+def run_request(endpoint, session, base, page_url):
+    """One request against endpoint. Returns None on success, else an error string."""
+    if endpoint == "get_formats":
+        resp = session.post(f"{base}/get_formats", json={"url": page_url}, timeout=600)
+        return None if resp.ok and "video" in resp.json() else f"HTTP {resp.status_code}"
+
+    path = "/download_mp3" if endpoint == "download_mp3" else "/download"
+    resp = session.post(f"{base}{path}", json={"url": page_url}, timeout=60)
+    if resp.status_code != 202:
+        return f"HTTP {resp.status_code}"
+    job_id = resp.json()["job_id"]
+    if endpoint == "progress":
+        state = follow_job(session, base, job_id, first_event_only=True)
+        session.post(f"{base}/jobs/{job_id}/cancel", timeout=60)
+        return None if state else "no progress event"
+    state = follow_job(session, base, job_id)
+    return None if state == "finished" else f"job {state}"
+
+
+def run_endpoint(endpoint, args, base, fixture, sampler):
+    sampler.reset()
+    latencies, errors = [], {}
+    lock = threading.Lock()
+    local = threading.local()
+
+    def one(i):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        page_url = f"{fixture.base_url}/{args.page}/{i % args.distinct}"
+        started = time.perf_counter()
+        try:
+            error = run_request(endpoint, session, base, page_url)
+        except requests.RequestException as e:
+            error = type(e).__name__
+        elapsed = time.perf_counter() - started
+        with lock:
+            if error:
+                errors[error] = errors.get(error, 0) + 1
+            else:
+                latencies.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, range(args.requests)))
+    wall = time.perf_counter() - started
+    sampler.sample()
+
+    return {
+        "requests": args.requests,
+        "ok": len(latencies),
+        "errors": errors,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "throughput": round(len(latencies) / wall, 3) if wall else None,
+        "peak_rss_mb": round(sampler.peak_rss / 1024 ** 2, 1) if sampler.supported else None,
+        "peak_open_files": sampler.peak_fds if sampler.supported else None,
+        "peak_subprocesses": sampler.peak_subprocesses if sampler.supported else None,
+    }
+
+
+def print_report(results):
+    columns = ("ok", "p50", "p95", "p99", "throughput", "peak_rss_mb", "peak_open_files", "peak_subprocesses")
+    print(f"\n{'endpoint':<14}" + "".join(f"{c:>18}" for c in columns) + "   errors")
+    for endpoint, r in results.items():
+        cells = []
+        for c in columns:
+            value = r[c]
+            cells.append(f"{value:>18.3f}" if isinstance(value, float) else f"{str(value):>18}")
+        print(f"{endpoint:<14}" + "".join(cells) + f"   {r['errors'] or ''}")
+
+
+def compare(results, baseline, tolerance):
+    """Print regressions against a saved baseline. Returns True if any were found."""
+    regressed = False
+    for endpoint, r in results.items():
+        old = baseline.get("results", {}).get(endpoint)
+        if not old:
+            continue
+        checks = [
+            ("p95", r["p95"], old["p95"], lambda new, base: new > base * (1 + tolerance)),
+            ("p99", r["p99"], old["p99"], lambda new, base: new > base * (1 + tolerance)),
+            ("throughput", r["throughput"], old["throughput"], lambda new, base: new < base * (1 - tolerance)),
+            ("peak_rss_mb", r["peak_rss_mb"], old["peak_rss_mb"], lambda new, base: new > base * (1 + tolerance)),
+            ("error rate", 1 - r["ok"] / r["requests"], 1 - old["ok"] / old["requests"],
+             lambda new, base: new > base + 0.01),
+        ]
+        for name, new, base, worse in checks:
+            if new is None or base is None:
+                continue
+            flag = "REGRESSION" if worse(new, base) else "ok"
+            regressed |= flag == "REGRESSION"
+            print(f"{endpoint:<14} {name:<12} {base:>10.3f} -> {new:>10.3f}  {flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS),
+                        help=f"comma-separated subset of {', '.join(ENDPOINTS)}")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=20, help="requests per endpoint")
+    parser.add_argument("--distinct", type=int, default=5, help="distinct fixture videos to cycle through")
+    parser.add_argument("--page", choices=("page", "hls-page"), default="page", help="progressive MP4 or HLS fixtures")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=4, help="gunicorn threads per worker")
+    parser.add_argument("--warm-browsers", action="store_true", help="let the app warm its browser pool")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--save-baseline", help="save the results as a baseline")
+    parser.add_argument("--compare", help="compare against a saved baseline; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    args = parser.parse_args()
+
+    endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(sorted(unknown))}")
+
+    fixture = FixtureServer().start()
+    rundir = tempfile.mkdtemp(prefix="bench-run-")
+    port = free_port()
+    print(f"Fixtures on {fixture.base_url} ({'encoded' if fixture.media.real else 'synthetic'} media), "
+          f"gunicorn on :{port} with {args.workers}x{args.threads}, run dir {rundir}")
+    proc = start_gunicorn(args, port, rundir)
+    sampler = ProcessSampler(proc.pid).start()
+    results = {}
+    try:
+        for endpoint in endpoints:
+            print(f"▶ {endpoint}: {args.requests} requests, concurrency {args.concurrency}")
+            results[endpoint] = run_endpoint(endpoint, args, f"http://127.0.0.1:{port}", fixture, sampler)
+    finally:
+        sampler.stop()
+        proc.terminate()
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        fixture.stop()
+
+    print_report(results)
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {k: v for k, v in vars(args).items() if k not in ("json", "save_baseline", "compare")},
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+                 "ffmpeg": shutil.which("ffmpeg") is not None},
+        "results": results,
+    }
+    for path in filter(None, (args.json, args.save_baseline)):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved {path}")
+    shutil.rmtree(rundir, ignore_errors=True)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != report["config"]:
+            print("⚠️ Baseline was recorded with a different configuration")
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import json
+import os
+import queue
+import socket
+import threading
+import time
+
+from lazy import lazy_import
+
+redis = lazy_import("redis")
+
+# "" keeps jobs, progress and caches in this process; "local" uses the in-process broker
+# (one process, but through the broker code paths); redis://host:6379/0 shares them between nodes
+BROKER_URL = os.environ.get("BROKER_URL", "")
+# Namespace for every key and channel, so several deployments can share one Redis
+BROKER_PREFIX = os.environ.get("BROKER_PREFIX", "urldl:")
+# How the other nodes reach this one's /files, e.g. http://10.0.0.5:10000 ("" = finished files aren't shared)
+BROKER_NODE_URL = os.environ.get("BROKER_NODE_URL", "").rstrip("/")
+
+
+class BrokerError(Exception):
+    """The broker backend could not be reached or refused the operation."""
+
+
+def node_id():
+    """This process, as other nodes see it (computed per call: gunicorn forks after import)."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _copy(message):
+    # The in-process backend hands out copies, so callers see the same isolation as over Redis
+    return json.loads(json.dumps(message, default=str))
+
+
+class LocalSubscription:
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self._messages = queue.Queue()
+
+    def get(self, timeout=None):
+        """The next message, or None after timeout seconds."""
+        try:
+            return self._messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker._unsubscribe(self)
+
+
+class LocalBroker:
+    """Queues, pub/sub channels and expiring values inside this process.
+
+    The single-node default, and a stand-in for Redis when exercising the
+    broker code paths without one.
+    """
+
+    name = "local"
+
+    def __init__(self):
+        self._queues = {}
+        self._channels = {}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _queue(self, name):
+        with self._lock:
+            return self._queues.setdefault(name, queue.Queue())
+
+    # Work queues
+
+    def push(self, name, message):
+        self._queue(name).put(_copy(message))
+
+    def pop(self, name, timeout=1.0):
+        """The oldest message on name, waiting up to timeout seconds; None if there is none."""
+        try:
+            return self._queue(name).get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def length(self, name):
+        return self._queue(name).qsize()
+
+    # Pub/sub
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscribers = list(self._channels.get(channel, ()))
+        for subscription in subscribers:
+            subscription._messages.put(_copy(message))
+
+    def subscribe(self, channel):
+        subscription = LocalSubscription(self, channel)
+        with self._lock:
+            self._channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            self._channels.get(subscription.channel, set()).discard(subscription)
+
+    # Values
+
+    def put(self, key, value, ttl=None):
+        with self._lock:
+            self._values[key] = (_copy(value), time.time() + ttl if ttl else None)
+
+    def fetch(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self._values[key]
+                return None
+            return _copy(value)
+
+    def remove(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def clear(self, prefix):
+        with self._lock:
+            for key in [k for k in self._values if k.startswith(prefix)]:
+                del self._values[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": self.name,
+                "queues": {name: q.qsize() for name, q in self._queues.items()},
+                "channels": {name: len(subs) for name, subs in self._channels.items() if subs},
+                "values": len(self._values),
+            }
+
+
+class RedisSubscription:
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    def get(self, timeout=None):
+        """The next message, or None after timeout seconds."""
+        deadline = time.monotonic() + (timeout or 0)
+        try:
+            while True:
+                message = self.pubsub.get_message(timeout=max(0.0, deadline - time.monotonic()))
+                if message is not None and message["type"] == "message":
+                    return json.loads(message["data"])
+                if time.monotonic() >= deadline:
+                    return None
+        except redis.RedisError as e:
+            raise BrokerError(str(e)) from e
+
+    def close(self):
+        try:
+            self.pubsub.close()
+        except redis.RedisError:
+            pass
+
+
+class RedisBroker:
+    """The same operations over Redis (or anything speaking its protocol), shared by every node.
+
+    Work queues are lists (RPUSH/BLPOP), channels are Redis pub/sub and
+    values are plain keys with an expiry. Pass client= to use an existing
+    client, e.g. fakeredis in tests.
+    """
+
+    name = "redis"
+
+    def __init__(self, url=BROKER_URL, prefix=BROKER_PREFIX, client=None):
+        self.url = url
+        self.prefix = prefix
+        self.client = client if client is not None else redis.Redis.from_url(url)
+
+    def _call(self, method, *args, **kwargs):
+        try:
+            return getattr(self.client, method)(*args, **kwargs)
+        except redis.RedisError as e:
+            raise BrokerError(str(e)) from e
+
+    def push(self, name, message):
+        self._call("rpush", self.prefix + name, json.dumps(message, default=str))
+
+    def pop(self, name, timeout=1.0):
+        found = self._call("blpop", [self.prefix + name], timeout=timeout)
+        return json.loads(found[1]) if found else None
+
+    def length(self, name):
+        return self._call("llen", self.prefix + name)
+
+    def publish(self, channel, message):
+        self._call("publish", self.prefix + channel, json.dumps(message, default=str))
+
+    def subscribe(self, channel):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(self.prefix + channel)
+        except redis.RedisError as e:
+            pubsub.close()
+            raise BrokerError(str(e)) from e
+        return RedisSubscription(pubsub)
+
+    def put(self, key, value, ttl=None):
+        self._call("set", self.prefix + key, json.dumps(value, default=str), px=int(ttl * 1000) if ttl else None)
+
+    def fetch(self, key):
+        value = self._call("get", self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def remove(self, key):
+        self._call("delete", self.prefix + key)
+
+    def clear(self, prefix):
+        try:
+            keys = list(self.client.scan_iter(match=f"{self.prefix}{prefix}*", count=500))
+        except redis.RedisError as e:
+            raise BrokerError(str(e)) from e
+        if keys:
+            self._call("delete", *keys)
+
+    def stats(self):
+        stats = {"backend": self.name, "prefix": self.prefix}
+        try:
+            stats["reachable"] = bool(self._call("ping"))
+        except BrokerError as e:
+            stats["reachable"] = False
+            stats["error"] = str(e)
+        return stats
+
+
+def make_broker(url=BROKER_URL):
+    """The broker BROKER_URL describes, or None when it's empty (everything stays in this process)."""
+    if not url:
+        return None
+    if url == "local":
+        return LocalBroker()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBroker(url)
+    raise ValueError(f"Unsupported BROKER_URL: {url!r} (use 'local' or a redis:// URL)")
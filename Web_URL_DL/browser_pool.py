@@ -0,0 +1,374 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+
+from lazy import lazy_import
+
+# Selenium is imported on first use, not when a worker starts
+webdriver = lazy_import("selenium.webdriver")
+selenium_exceptions = lazy_import("selenium.common.exceptions")
+
+BROWSER_POOL_SIZE = int(os.environ.get("BROWSER_POOL_SIZE", "2"))
+# Recycle a browser after this many leases to keep its memory in check
+BROWSER_MAX_USES = int(os.environ.get("BROWSER_MAX_USES", "25"))
+BROWSER_LEASE_TIMEOUT = int(os.environ.get("BROWSER_LEASE_TIMEOUT", "30"))
+BROWSER_PAGE_TIMEOUT = int(os.environ.get("BROWSER_PAGE_TIMEOUT", "20"))
+CHROMEDRIVER_PATH = os.environ.get("CHROMEDRIVER_PATH", "/usr/local/bin/chromedriver")
+
+_driver_path = None
+_driver_path_lock = threading.Lock()
+
+
+class BrowserUnavailable(Exception):
+    """Raised when no pooled browser could be leased in time."""
+
+
+def resolve_chromedriver():
+    """Locate chromedriver once per process instead of on every request."""
+    global _driver_path
+    with _driver_path_lock:
+        if _driver_path is None:
+            if os.path.exists(CHROMEDRIVER_PATH):
+                _driver_path = CHROMEDRIVER_PATH
+            else:
+                from webdriver_manager.chrome import ChromeDriverManager
+                _driver_path = ChromeDriverManager().install()
+        return _driver_path
+
+
+def new_chrome_driver():
+    """Start a headless Chrome suitable for stream extraction."""
+    options = webdriver.ChromeOptions()
+    options.add_argument("--headless")
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+    options.add_argument("--disable-gpu")
+    options.add_argument("--window-size=1920x1080")
+    options.add_argument("--disable-blink-features=AutomationControlled")
+    options.page_load_strategy = 'eager'
+    # DevTools network events feed stream discovery
+    options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+
+    driver = webdriver.Chrome(service=webdriver.ChromeService(resolve_chromedriver()), options=options)
+    driver.set_page_load_timeout(BROWSER_PAGE_TIMEOUT)
+    return driver
+
+
+class PooledBrowser:
+    def __init__(self, driver):
+        self.driver = driver
+        self.uses = 0
+        self.created_at = time.time()
+
+
+class BrowserPool:
+    """Fixed-size pool of warm Selenium Chrome instances, leased one request at a time."""
+
+    def __init__(self, size=BROWSER_POOL_SIZE, max_uses=BROWSER_MAX_USES, factory=new_chrome_driver):
+        self.size = max(1, size)
+        self.max_uses = max(1, max_uses)
+        self.factory = factory
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._live = 0
+        self._closed = False
+        self.leases = 0
+        self.recycled = 0
+        self.crashed = 0
+        self.killed = 0
+
+    def warm(self):
+        """Start browsers until the pool is full; raises whatever stopped a browser from starting."""
+        while True:
+            with self._lock:
+                if self._closed or self._live >= self.size:
+                    return
+                self._live += 1
+            try:
+                self._idle.put(self._start())
+            except Exception as e:
+                with self._lock:
+                    self._live -= 1
+                print(f"[BROWSER POOL] Warm-up failed: {e}")
+                raise
+
+    def _start(self):
+        started = time.time()
+        browser = PooledBrowser(self.factory())
+        print(f"[BROWSER POOL] Started browser in {time.time() - started:.1f}s")
+        return browser
+
+    def _acquire(self, timeout):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_start = self._live < self.size
+            if can_start:
+                self._live += 1
+        if can_start:
+            try:
+                return self._start()
+            except Exception:
+                with self._lock:
+                    self._live -= 1
+                raise
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise BrowserUnavailable(f"No browser free after {timeout}s") from None
+
+    def _discard(self, browser):
+        with self._lock:
+            self._live -= 1
+        try:
+            browser.driver.quit()
+        except Exception:
+            pass
+
+    def _reset(self, browser):
+        """Leave the browser blank so that the next lease shares no state with this one."""
+        driver = browser.driver
+        handles = driver.window_handles
+        for handle in handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(handles[0])
+        driver.get("about:blank")
+        driver.delete_all_cookies()
+
+    @contextmanager
+    def lease(self, timeout=BROWSER_LEASE_TIMEOUT, cancel=None):
+        """Borrow a driver; it is reset, recycled or replaced when the block exits.
+
+        If cancel (a CancelToken) fires while the driver is leased, the browser
+        is killed so that any call blocked on it returns straight away.
+        """
+        browser = self._acquire(timeout)
+        browser.uses += 1
+        with self._lock:
+            self.leases += 1
+        killed = []
+
+        def kill():
+            killed.append(True)
+            try:
+                browser.driver.quit()
+            except Exception:
+                pass
+
+        unregister = cancel.on_cancel(kill) if cancel is not None else (lambda: None)
+        broken = False
+        try:
+            yield browser.driver
+        except selenium_exceptions.WebDriverException:
+            broken = True
+            raise
+        finally:
+            unregister()
+            broken = broken or bool(killed)
+            if not broken and not self._closed and browser.uses < self.max_uses:
+                try:
+                    self._reset(browser)
+                except Exception:
+                    broken = True
+            if broken or self._closed or browser.uses >= self.max_uses:
+                with self._lock:
+                    if killed:
+                        self.killed += 1
+                    elif broken:
+                        self.crashed += 1
+                    else:
+                        self.recycled += 1
+                self._discard(browser)
+                if not self._closed:
+                    # Bring up the replacement now rather than on the next request
+                    threading.Thread(target=self.warm, name="browser-warmup", daemon=True).start()
+            else:
+                self._idle.put(browser)
+
+    def shutdown(self):
+        self._closed = True
+        while True:
+            try:
+                browser = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(browser)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "live": self._live,
+                "idle": self._idle.qsize(),
+                "leases": self.leases,
+                "recycled": self.recycled,
+                "crashed": self.crashed,
+                "killed": self.killed,
+            }
+
+
+class _PlaywrightState:
+    """What one Playwright thread owns: the driver, its browser and how often it was leased."""
+
+    def __init__(self):
+        self.playwright = None
+        self.browser = None
+        self.uses = 0
+
+
+class PlaywrightPool:
+    """Warm Chromium instances, each owned by a long-lived thread that runs the leases handed to it.
+
+    Playwright's sync API is bound to the thread that started it, while
+    extractions run on short-lived threads (races, fallbacks). So the
+    browsers stay on their own threads and callers submit work to them with
+    run(); every lease gets a fresh context, and a browser is replaced after
+    max_uses leases or when it crashes.
+    """
+
+    def __init__(self, size=BROWSER_POOL_SIZE, max_uses=BROWSER_MAX_USES):
+        self.size = max(1, size)
+        self.max_uses = max(1, max_uses)
+        self._tasks = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._live = 0
+        self._closed = False
+        self.leases = 0
+        self.recycled = 0
+        self.crashed = 0
+
+    def _ensure_threads(self):
+        with self._lock:
+            if self._closed:
+                raise BrowserUnavailable("The Playwright pool is shut down")
+            while len(self._threads) < self.size:
+                thread = threading.Thread(target=self._serve, name=f"playwright-{len(self._threads)}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    def _serve(self):
+        state = _PlaywrightState()
+        try:
+            while True:
+                task = self._tasks.get()
+                if task is None:
+                    return
+                self._run_task(state, *task)
+        finally:
+            self._stop(state)
+
+    def _stop(self, state):
+        if state.playwright is None:
+            return
+        closers = ([state.browser.close] if state.browser is not None else []) + [state.playwright.stop]
+        for closer in closers:
+            try:
+                closer()
+            except Exception:
+                pass
+        state.playwright = state.browser = None
+        with self._lock:
+            self._live -= 1
+
+    def _browser(self, state):
+        from playwright.sync_api import sync_playwright
+
+        if state.browser is not None:
+            if state.uses < self.max_uses and state.browser.is_connected():
+                return state.browser
+            if state.browser.is_connected():
+                with self._lock:
+                    self.recycled += 1
+            self._stop(state)
+        playwright = sync_playwright().start()
+        try:
+            browser = playwright.chromium.launch(headless=True)
+        except Exception:
+            playwright.stop()
+            raise
+        state.playwright, state.browser, state.uses = playwright, browser, 0
+        with self._lock:
+            self._live += 1
+        return browser
+
+    def _run_task(self, state, func, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        context = None
+        try:
+            browser = self._browser(state)
+            state.uses += 1
+            with self._lock:
+                self.leases += 1
+            context = browser.new_context()
+            context.set_default_timeout(BROWSER_PAGE_TIMEOUT * 1000)
+            future.set_result(func(context.new_page()))
+        except BaseException as e:
+            if state.browser is not None and not state.browser.is_connected():
+                with self._lock:
+                    self.crashed += 1
+                self._stop(state)
+            future.set_exception(e)
+        finally:
+            if context is not None:
+                try:
+                    context.close()
+                except Exception:
+                    pass
+
+    def run(self, func, timeout=BROWSER_LEASE_TIMEOUT, cancel=None):
+        """Call func(page) on a pooled browser's thread and return its result.
+
+        Raises BrowserUnavailable if no browser takes the work within
+        timeout. Returns None if cancel fires first; func should watch
+        cancel too, since the work it already started runs to its end.
+        """
+        self._ensure_threads()
+        future = Future()
+        self._tasks.put((func, future))
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return future.result(timeout=0.2)
+            except FutureTimeout:
+                pass
+            if cancel is not None and cancel.is_set():
+                future.cancel()
+                return None
+            if not future.running() and time.monotonic() > deadline and future.cancel():
+                raise BrowserUnavailable(f"No Playwright browser free after {timeout}s")
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            threads = list(self._threads)
+        for _ in threads:
+            self._tasks.put(None)
+        for thread in threads:
+            thread.join(timeout=5)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "live": self._live,
+                "queued": self._tasks.qsize(),
+                "leases": self.leases,
+                "recycled": self.recycled,
+                "crashed": self.crashed,
+                "max_uses": self.max_uses,
+            }
+
+
+browser_pool = BrowserPool()
+playwright_pool = PlaywrightPool()
+atexit.register(browser_pool.shutdown)
+atexit.register(playwright_pool.shutdown)
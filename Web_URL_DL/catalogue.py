@@ -0,0 +1,165 @@
+# Info dict fields a download never reads; on popular sites they are most of the dict's size
+HEAVY_INFO_FIELDS = ("automatic_captions", "subtitles", "heatmap", "thumbnails", "comments",
+                     "_format_sort_fields", "requested_subtitles")
+
+# Container family a format's extension belongs to, for pairing video with audio that merges without re-muxing
+CONTAINERS = {"mp4": "mp4", "m4a": "mp4", "m4v": "mp4", "mov": "mp4", "webm": "webm", "weba": "webm",
+              "mkv": "mkv", "ogg": "ogg", "opus": "ogg", "mp3": "mp3", "aac": "aac"}
+
+
+def slim_info(info):
+    """Drop the info dict fields downloads don't use. Works in place and returns info."""
+    for field in HEAVY_INFO_FIELDS:
+        info.pop(field, None)
+    return info
+
+
+def codec_family(codec):
+    """'avc1.64001F' -> 'avc1'; None/'none' stay as they are."""
+    if not codec or codec == "none":
+        return codec
+    return codec.split(".")[0].lower()
+
+
+def _number(value):
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+
+class FormatEntry:
+    """The numeric facts about one format; display strings are derived on serialization."""
+
+    __slots__ = ("format_id", "ext", "vcodec", "acodec", "width", "height", "fps", "tbr", "abr",
+                 "filesize", "note", "protocol")
+
+    def __init__(self, fmt):
+        self.format_id = fmt.get("format_id")
+        self.ext = fmt.get("ext")
+        self.vcodec = fmt.get("vcodec", "none")
+        self.acodec = fmt.get("acodec", "none")
+        self.width = _number(fmt.get("width"))
+        self.height = _number(fmt.get("height"))
+        self.fps = _number(fmt.get("fps"))
+        self.tbr = _number(fmt.get("tbr"))
+        self.abr = _number(fmt.get("abr"))
+        self.filesize = _number(fmt.get("filesize")) or _number(fmt.get("filesize_approx"))
+        self.note = fmt.get("format_note")
+        self.protocol = fmt.get("protocol")
+
+    @property
+    def has_video(self):
+        return self.vcodec != "none"
+
+    @property
+    def has_audio(self):
+        return self.acodec != "none"
+
+    @property
+    def container(self):
+        return CONTAINERS.get(self.ext, self.ext)
+
+    def resolution(self):
+        if self.width and self.height:
+            return f"{self.width}x{self.height}"
+        return self.note or "Unknown"
+
+    def size(self):
+        return f"{self.filesize / (1024 * 1024):.2f} MB" if self.filesize else "Unknown size"
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if getattr(self, name) is not None}
+
+
+class FormatCatalogue:
+    """Compact, indexed view of an extraction's formats.
+
+    Built in one pass over info["formats"] and keeps only FormatEntry objects,
+    so callers can let go of the info dict itself. Video formats are indexed
+    by height and codec family, audio formats by codec family and bitrate,
+    and every video-only format is paired with the best audio stream in the
+    same container (falling back to the best audio overall).
+    """
+
+    def __init__(self, video_id=None, title=None, duration=None, thumbnail=None):
+        self.video_id = video_id
+        self.title = title
+        self.duration = duration
+        self.thumbnail = thumbnail
+        self.formats = []
+        self.by_height = {}
+        self.by_vcodec = {}
+        self.by_acodec = {}
+        self.best_audio = None
+        self.best_audio_by_container = {}
+        self.best_audio_by_codec = {}
+
+    @classmethod
+    def from_info(cls, info):
+        catalogue = cls(info.get("id"), info.get("title"), _number(info.get("duration")), info.get("thumbnail") or "")
+        for fmt in info.get("formats") or []:
+            catalogue._add(FormatEntry(fmt))
+        return catalogue
+
+    def _add(self, entry):
+        self.formats.append(entry)
+        if entry.has_video:
+            self.by_height.setdefault(entry.height or 0, []).append(entry)
+            self.by_vcodec.setdefault(codec_family(entry.vcodec), []).append(entry)
+        elif entry.has_audio:
+            self.by_acodec.setdefault(codec_family(entry.acodec), []).append(entry)
+            self.best_audio = self._better_audio(self.best_audio, entry)
+            container, codec = entry.container, codec_family(entry.acodec)
+            self.best_audio_by_container[container] = self._better_audio(self.best_audio_by_container.get(container), entry)
+            self.best_audio_by_codec[codec] = self._better_audio(self.best_audio_by_codec.get(codec), entry)
+
+    @staticmethod
+    def _better_audio(current, candidate):
+        if current is None or (candidate.abr or candidate.tbr or 0) > (current.abr or current.tbr or 0):
+            return candidate
+        return current
+
+    def audio_for(self, video):
+        """Best audio to merge with a video-only format: same container first, then best overall."""
+        return self.best_audio_by_container.get(video.container) or self.best_audio
+
+    def audio_formats(self):
+        """Audio-only formats, highest bitrate first."""
+        audio = [e for e in self.formats if e.has_audio and not e.has_video]
+        return sorted(audio, key=lambda e: e.abr or e.tbr or 0, reverse=True)
+
+    def heights(self):
+        return sorted((h for h in self.by_height if h), reverse=True)
+
+    def is_empty(self):
+        """True when the page would have nothing to offer (the force-download case)."""
+        return not any(e.has_video and (e.has_audio or self.audio_for(e)) for e in self.formats)
+
+    def page_formats(self):
+        """The combined/video/audio lists the download page offers."""
+        formats = {"combined": [], "video": [], "audio": []}
+        for entry in self.formats:
+            if not entry.has_video:
+                continue
+            option = {"format_id": entry.format_id, "resolution": entry.resolution(), "size": entry.size()}
+            if entry.has_audio:
+                formats["combined"].append(option)
+                continue
+            audio = self.audio_for(entry)
+            if audio is not None:
+                # Video-only formats are offered merged with their paired audio
+                option["format_id"] = f"{entry.format_id}+{audio.format_id}"
+                formats["video"].append(option)
+        return formats
+
+    def to_dict(self):
+        """Slim JSON form: the entries plus the precomputed pairings, by format id."""
+        return {
+            "id": self.video_id,
+            "title": self.title,
+            "duration": self.duration,
+            "thumbnail": self.thumbnail,
+            "formats": [e.to_dict() for e in self.formats],
+            "heights": self.heights(),
+            "best_audio": self.best_audio.format_id if self.best_audio else None,
+            "best_audio_by_container": {k: v.format_id for k, v in self.best_audio_by_container.items()},
+            "best_audio_by_codec": {k: v.format_id for k, v in self.best_audio_by_codec.items()},
+        }
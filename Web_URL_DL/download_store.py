@@ -0,0 +1,512 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows: entries are only coordinated between the threads of one process
+    fcntl = None
+
+from broker import BrokerError
+from extract_cache import normalize_url
+from jobs import JobCancelled
+
+# Total size of completed downloads kept for reuse (bytes)
+DOWNLOAD_STORE_SIZE = int(os.environ.get("DOWNLOAD_STORE_SIZE", str(10 * 1024 ** 3)))
+# Interrupted downloads are kept this long so that a retry can resume them
+DOWNLOAD_STORE_PARTIAL_TTL = int(os.environ.get("DOWNLOAD_STORE_PARTIAL_TTL", "86400"))
+# Seconds between sweeps for partial downloads older than the TTL (and leftover lock files)
+DOWNLOAD_STORE_PRUNE_INTERVAL = int(os.environ.get("DOWNLOAD_STORE_PRUNE_INTERVAL", "3600"))
+
+# Marker written next to a finished file; directories without it hold partial downloads
+COMPLETE_MARKER = ".complete"
+# Directory under the store root holding one lock file per key, flocked by every process using the store
+LOCK_DIR = ".locks"
+LOCK_POLL_INTERVAL = 0.2
+# Shared index entries outlive a node that died without removing them for at most this long
+DOWNLOAD_INDEX_TTL = int(os.environ.get("DOWNLOAD_INDEX_TTL", str(7 * 86400)))
+
+
+def canonical_video_id(info, url=None):
+    """Stable identity of a video: extractor + id when yt-dlp knows them, else the normalized URL."""
+    if info and info.get("id") and (info.get("extractor_key") or info.get("extractor")):
+        return f"{info.get('extractor_key') or info.get('extractor')}:{info['id']}"
+    return normalize_url((info or {}).get("webpage_url") or url or "")
+
+
+def make_store_key(info, format_spec, options=None, url=None):
+    """Key for a finished download: video, selected format and post-processing options."""
+    raw = json.dumps([canonical_video_id(info, url), format_spec, options or {}], sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class DownloadIndex:
+    """Which node holds which finished file, shared through the broker.
+
+    Files are named relative to folder (as /files serves them). Store
+    entries are also indexed by their key, so a node can hand out another
+    node's copy instead of downloading the same video again.
+    """
+
+    def __init__(self, broker, folder, node_url, ttl=DOWNLOAD_INDEX_TTL):
+        self.broker = broker
+        self.folder = folder
+        self.node_url = node_url
+        self.ttl = ttl
+
+    def name(self, path):
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.folder)).replace(os.sep, "/")
+
+    def add(self, path, key=None, size=None):
+        name = self.name(path)
+        entry = {"node": self.node_url, "file": name, "size": size}
+        try:
+            self.broker.put(f"file:{name}", entry, ttl=self.ttl)
+            if key:
+                self.broker.put(f"download:{key}", entry, ttl=self.ttl)
+        except BrokerError as e:
+            print(f"⚠️ Couldn't index {name}: {e}")
+
+    def remove(self, path, key=None):
+        try:
+            self.broker.remove(f"file:{self.name(path)}")
+            if key:
+                self.broker.remove(f"download:{key}")
+        except BrokerError as e:
+            print(f"⚠️ Couldn't unindex {path}: {e}")
+
+    def _lookup(self, key):
+        try:
+            entry = self.broker.fetch(key)
+        except BrokerError as e:
+            print(f"⚠️ Download index lookup failed: {e}")
+            return None
+        # Our own entries are only worth anything if the file is still here, which the caller checks
+        return entry if entry and entry.get("node") != self.node_url else None
+
+    def lookup(self, key):
+        """{"node", "file", "size"} for a store key another node holds, or None."""
+        return self._lookup(f"download:{key}")
+
+    def where(self, name):
+        """Base URL of the other node holding the file /files serves as name, or None."""
+        entry = self._lookup(f"file:{name}")
+        return entry["node"] if entry else None
+
+
+class StoreEntry:
+    """A finished download in the store."""
+
+    def __init__(self, key, path, size, last_used):
+        self.key = key
+        self.path = path
+        self.size = size
+        self.last_used = last_used
+        self.refs = 0
+        # Shared lock on the key while refs > 0, so other processes don't evict it
+        self.pin = None
+
+
+class _Flight:
+    """A download in progress that other requests for the same key wait on."""
+
+    def __init__(self, context):
+        self.done = threading.Event()
+        self.context = context
+        self.entry = None
+        self.error = None
+        self.cancelled = False
+        self.waiters = 0
+
+
+class DownloadStore:
+    """Content-addressed store of finished downloads.
+
+    Every key gets its own directory under root. The producer downloads into
+    it, so an interrupted download leaves its .part files there and the next
+    attempt for the same key resumes them. Concurrent requests for a key that
+    is already downloading wait for that download instead of starting another.
+    Finished entries are reference counted while in use and evicted least
+    recently used first once the store grows past max_bytes.
+
+    Several processes (gunicorn workers) can share root: each key has a lock
+    file that producers hold exclusively while downloading and users of a
+    finished entry hold shared. A process that misses waits for the lock and
+    then picks up what another process finished, and eviction skips entries
+    it can't lock exclusively straight away.
+    """
+
+    def __init__(self, root, max_bytes=DOWNLOAD_STORE_SIZE, partial_ttl=DOWNLOAD_STORE_PARTIAL_TTL, index=None,
+                 prune_interval=DOWNLOAD_STORE_PRUNE_INTERVAL):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.partial_ttl = partial_ttl
+        self.prune_interval = prune_interval
+        self._pruned_at = time.time()
+        # Optional DownloadIndex that other nodes find our finished entries through
+        self.index = index
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.evictions = 0
+        self._opened = False
+
+    def workdir(self, key):
+        return os.path.join(self.root, key)
+
+    def _open(self):
+        """Create root and load the index on first use, not when the app is imported."""
+        if self._opened:
+            return
+        with self._lock:
+            if not self._opened:
+                os.makedirs(os.path.join(self.root, LOCK_DIR), exist_ok=True)
+                self._load()
+                self._opened = True
+
+    def _lock_path(self, key):
+        return os.path.join(self.root, LOCK_DIR, key)
+
+    def _lock_key(self, key, shared=False, blocking=True, cancel=None):
+        """flock key's lock file, shared or exclusive. Returns the open file (close it to unlock).
+
+        Returns None when blocking is False and another process holds a
+        conflicting lock; raises JobCancelled if cancel fires while waiting.
+        """
+        path = self._lock_path(key)
+        while True:
+            lock = open(path, "a+")
+            if fcntl is None:
+                return lock
+            while True:
+                try:
+                    fcntl.flock(lock, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if not blocking:
+                        lock.close()
+                        return None
+                    if cancel is not None and cancel.is_set():
+                        lock.close()
+                        raise JobCancelled("Job cancelled while waiting for a shared download.")
+                    time.sleep(LOCK_POLL_INTERVAL)
+            # Evicting a key deletes its lock file; a lock on the deleted file guards nothing, so take the new one
+            try:
+                if os.stat(path).st_ino == os.fstat(lock.fileno()).st_ino:
+                    return lock
+            except FileNotFoundError:
+                pass
+            lock.close()
+
+    def _read_marker(self, key):
+        """StoreEntry for key from its completion marker on disk, or None if it isn't finished."""
+        workdir = self.workdir(key)
+        marker = os.path.join(workdir, COMPLETE_MARKER)
+        with open(marker, encoding="utf-8") as f:
+            path = os.path.join(workdir, json.load(f)["file"])
+        return StoreEntry(key, path, os.path.getsize(path), os.path.getmtime(marker))
+
+    def _load(self):
+        """Rebuild the index from disk, oldest first, and drop stale partial downloads."""
+        found = []
+        for key in os.listdir(self.root):
+            if key == LOCK_DIR:
+                continue
+            try:
+                if os.path.exists(os.path.join(self.workdir(key), COMPLETE_MARKER)):
+                    found.append(self._read_marker(key))
+            except (OSError, ValueError, KeyError) as e:
+                print(f"⚠️ Dropping unreadable store entry {key}: {e}")
+                self._remove_unlocked(key)
+        self._prune_partials({entry.key for entry in found})
+        for entry in sorted(found, key=lambda e: e.last_used):
+            self._entries[entry.key] = entry
+            if self.index is not None:
+                self.index.add(entry.path, entry.key, entry.size)
+
+    def _remove_unlocked(self, key):
+        """Delete key's directory and lock file unless another process holds its lock (i.e. is downloading into it)."""
+        lock = self._lock_key(key, blocking=False)
+        if lock is None:
+            return False
+        try:
+            shutil.rmtree(self.workdir(key), ignore_errors=True)
+            # Still under the lock: anyone who opened the old file sees it is gone once they get it (_lock_key)
+            os.remove(self._lock_path(key))
+        except FileNotFoundError:
+            pass
+        finally:
+            lock.close()
+        return True
+
+    def _maybe_prune(self):
+        if time.time() - self._pruned_at >= self.prune_interval:
+            with self._lock:
+                busy = set(self._inflight) | set(self._entries)
+            self._prune_partials(busy)
+
+    def _prune_partials(self, busy):
+        """Delete partial downloads untouched for partial_ttl, and lock files whose key has no directory.
+
+        Keys in busy (finished or being produced here) are left alone; so is
+        anything another process holds the lock of.
+        """
+        self._pruned_at = time.time()
+        now = time.time()
+        for key in os.listdir(self.root):
+            workdir = self.workdir(key)
+            try:
+                if key == LOCK_DIR or key in busy or os.path.exists(os.path.join(workdir, COMPLETE_MARKER)):
+                    continue
+                if os.path.isdir(workdir) and now - os.path.getmtime(workdir) > self.partial_ttl:
+                    if self._remove_unlocked(key):
+                        print(f"🗑️ Dropped a partial download untouched for {self.partial_ttl}s: {key[:12]}")
+            except OSError:
+                pass
+        for key in os.listdir(os.path.join(self.root, LOCK_DIR)):
+            if key not in busy and not os.path.exists(self.workdir(key)):
+                self._remove_unlocked(key)
+
+    def _use(self, entry):
+        """Count a user of entry (under self._lock); the first one pins it against other processes.
+
+        Never waits: returns False, taking nothing, when another process
+        holds the key exclusively (it is evicting or re-producing it).
+        """
+        if entry.pin is None:
+            pin = self._lock_key(entry.key, shared=True, blocking=False)
+            if pin is None:
+                return False
+            entry.pin = pin
+        entry.refs += 1
+        return True
+
+    def _unuse(self, entry):
+        """Drop a user of entry (under self._lock). Returns whether it has none left."""
+        entry.refs = max(0, entry.refs - 1)
+        if entry.refs == 0 and entry.pin is not None:
+            entry.pin.close()
+            entry.pin = None
+        return entry.refs == 0
+
+    def _usable(self, entry):
+        """Take a use of entry if its file is still there (under self._lock); forget it otherwise.
+
+        An entry another process holds exclusively counts as gone: fetch()
+        then waits for that lock outside self._lock and re-reads the marker.
+        """
+        if self._use(entry):
+            if os.path.exists(entry.path):
+                self._touch(entry)
+                return True
+            # Removed behind our back, e.g. evicted by another process before we pinned it
+            self._unuse(entry)
+        if self._entries.get(entry.key) is entry:
+            del self._entries[entry.key]
+        return False
+
+    def fetch(self, key, produce, cancel=None, context=None, on_wait=None):
+        """Return (entry, how) for key, producing it if nobody has yet.
+
+        produce(workdir) downloads into workdir and returns the finished file's
+        path. how is 'hit', 'coalesced' or 'downloaded'. The entry is acquired
+        for the caller, who must release() it when done with the file.
+        on_wait(context) is called periodically with the producing caller's
+        context while this one waits on it.
+        """
+        self._open()
+        self._maybe_prune()
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and self._usable(entry):
+                    self.hits += 1
+                    return entry, "hit"
+                flight = self._inflight.get(key)
+                if flight is None:
+                    flight = self._inflight[key] = _Flight(context)
+                    self.misses += 1
+                    break
+                flight.waiters += 1
+                self.coalesced += 1
+
+            while not flight.done.wait(0.5):
+                if cancel is not None and cancel.is_set():
+                    with self._lock:
+                        flight.waiters -= 1
+                    raise JobCancelled("Job cancelled while waiting for a shared download.")
+                if on_wait:
+                    on_wait(flight.context)
+            with self._lock:
+                flight.waiters -= 1
+                if flight.entry is not None and self._usable(flight.entry):
+                    return flight.entry, "coalesced"
+            if flight.entry is None and not flight.cancelled:
+                raise flight.error
+            # The producer was cancelled; loop round and take over (resuming its partial files)
+
+        lock = None
+        try:
+            # Held by another process producing key; once we have it, that process is done
+            lock = self._lock_key(key, cancel=cancel)
+            entry, how = self._adopt(key, lock), "hit"
+            if entry is None:
+                workdir = self.workdir(key)
+                os.makedirs(workdir, exist_ok=True)
+                path = produce(workdir)
+                entry, how = self._commit(key, path, lock), "downloaded"
+            # The lock now pins the entry
+            lock = None
+            flight.entry = entry
+            return entry, how
+        except BaseException as e:
+            flight.error = e
+            flight.cancelled = cancel is not None and cancel.is_set()
+            raise
+        finally:
+            if lock is not None:
+                lock.close()
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    def _pin_with(self, entry, lock):
+        """Make the producer's exclusive lock the entry's shared pin."""
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+        entry.pin = lock
+        entry.refs = 1
+
+    def _adopt(self, key, lock):
+        """Index and acquire key if another process finished it (we hold its lock). None if it isn't done."""
+        try:
+            entry = self._read_marker(key)
+        except (OSError, ValueError, KeyError):
+            return None
+        self._pin_with(entry, lock)
+        with self._lock:
+            self._entries[key] = entry
+            self._touch(entry)
+            self.misses -= 1
+            self.hits += 1
+        return entry
+
+    def _commit(self, key, path, lock):
+        workdir = self.workdir(key)
+        if not path or os.path.dirname(os.path.abspath(path)) != os.path.abspath(workdir):
+            raise ValueError(f"Download for {key} did not land in its store directory: {path}")
+        with open(os.path.join(workdir, COMPLETE_MARKER), "w", encoding="utf-8") as f:
+            json.dump({"file": os.path.basename(path), "created": time.time()}, f)
+        entry = StoreEntry(key, path, os.path.getsize(path), time.time())
+        # The producer keeps a reference so the new entry can't be evicted under it
+        self._pin_with(entry, lock)
+        with self._lock:
+            self._entries[key] = entry
+            self._evict()
+        if self.index is not None:
+            self.index.add(entry.path, key, entry.size)
+        return entry
+
+    def _touch(self, entry):
+        entry.last_used = time.time()
+        self._entries.move_to_end(entry.key)
+        try:
+            # Keeps the LRU order across restarts
+            os.utime(os.path.join(self.workdir(entry.key), COMPLETE_MARKER))
+        except OSError:
+            pass
+
+    def _evict(self):
+        total = sum(e.size for e in self._entries.values())
+        for key in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            entry = self._entries[key]
+            if entry.refs > 0:
+                continue
+            # Another process is serving or re-producing it; try again on a later eviction
+            if not self._remove_unlocked(key):
+                continue
+            del self._entries[key]
+            total -= entry.size
+            self.evictions += 1
+            if self.index is not None:
+                self.index.remove(entry.path, key)
+
+    def discard(self, key):
+        """Delete key's finished entry or partial download, unless it is being used or produced.
+
+        For work nobody turned out to want (an abandoned speculative
+        prefetch). Returns whether anything was dropped.
+        """
+        self._open()
+        with self._lock:
+            entry = self._entries.get(key)
+            if key in self._inflight or (entry is not None and entry.refs > 0):
+                return False
+            if entry is None and not os.path.isdir(self.workdir(key)):
+                return False
+            # Under the lock, so a fetch for key can't start producing into the directory meanwhile
+            if not self._remove_unlocked(key):
+                return False
+            self._entries.pop(key, None)
+        if entry is not None and self.index is not None:
+            self.index.remove(entry.path, key)
+        return True
+
+    def has(self, key):
+        """Whether a finished entry for key is on this node's disk (written by any process)."""
+        self._open()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and os.path.exists(entry.path):
+                return True
+        return os.path.exists(os.path.join(self.workdir(key), COMPLETE_MARKER))
+
+    def acquire(self, path):
+        """Pin the entry holding path, if it is one. Returns the entry or None."""
+        self._open()
+        key = os.path.relpath(os.path.abspath(path), os.path.abspath(self.root)).split(os.sep)[0]
+        if key in (LOCK_DIR, os.curdir, os.pardir):
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                # Finished by another process: index it here too
+                try:
+                    entry = self._read_marker(key)
+                except (OSError, ValueError, KeyError):
+                    return None
+                self._entries[key] = entry
+            if os.path.abspath(entry.path) != os.path.abspath(path) or not self._usable(entry):
+                return None
+            return entry
+
+    def release(self, entry):
+        with self._lock:
+            if self._unuse(entry):
+                self._evict()
+
+    def stats(self):
+        self._open()
+        with self._lock:
+            lookups = self.hits + self.coalesced + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(e.size for e in self._entries.values()),
+                "max_bytes": self.max_bytes,
+                "in_use": sum(1 for e in self._entries.values() if e.refs),
+                "in_flight": len(self._inflight),
+                "hits": self.hits,
+                "coalesced": self.coalesced,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round((self.hits + self.coalesced) / lookups, 3) if lookups else 0.0,
+            }
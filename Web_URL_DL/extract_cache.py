@@ -0,0 +1,209 @@
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from broker import BrokerError
+
+EXTRACT_CACHE_TTL = int(os.environ.get("EXTRACT_CACHE_TTL", "600"))
+EXTRACT_CACHE_SIZE = int(os.environ.get("EXTRACT_CACHE_SIZE", "128"))
+# Optional SQLite file shared by all gunicorn workers on the instance ("" disables it)
+EXTRACT_CACHE_DB = os.environ.get("EXTRACT_CACHE_DB", "")
+EXTRACT_CACHE_DB_SIZE = int(os.environ.get("EXTRACT_CACHE_DB_SIZE", "1024"))
+
+# Query parameters that never change what gets extracted, matched by exact name
+TRACKING_PARAMS = frozenset(("fbclid", "gclid", "si", "feature", "ref_src"))
+# ...and by prefix (utm_source, utm_medium...)
+TRACKING_PREFIXES = ("utm_",)
+
+# yt-dlp options that change the extraction result and so belong in the key
+KEY_OPTIONS = ("format", "cookiefile", "user_agent", "noplaylist", "extract_flat", "playlistend")
+
+
+def is_tracking_param(name):
+    """Whether a query parameter only tracks the visitor; sig, size and the like are kept."""
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PREFIXES)
+
+
+def normalize_url(url):
+    """Canonical form of a URL for cache lookups."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower() or "https"
+    host = (parts.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    if parts.port and not ((scheme == "http" and parts.port == 80) or (scheme == "https" and parts.port == 443)):
+        host = f"{host}:{parts.port}"
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                   if not is_tracking_param(k))
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((scheme, host, path, urlencode(query), ""))
+
+
+def make_cache_key(url, ydl_opts=None):
+    """Key for an extraction: normalized URL plus the result-relevant options."""
+    opts = {k: (ydl_opts or {}).get(k) for k in KEY_OPTIONS}
+    raw = json.dumps([normalize_url(url), opts], sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class SQLiteCacheBackend:
+    """Extraction results shared between processes through one SQLite file."""
+
+    def __init__(self, path, max_entries=EXTRACT_CACHE_DB_SIZE):
+        self.path = path
+        self.max_entries = max_entries
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS extractions ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT value, expires FROM extractions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None, None
+            if row[1] < now:
+                conn.execute("DELETE FROM extractions WHERE key = ?", (key,))
+                return None, None
+            conn.execute("UPDATE extractions SET last_used = ? WHERE key = ?", (now, key))
+        return json.loads(row[0]), row[1]
+
+    def set(self, key, value, expires):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO extractions (key, value, expires, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires, time.time()),
+            )
+            conn.execute("DELETE FROM extractions WHERE expires < ?", (time.time(),))
+            conn.execute(
+                "DELETE FROM extractions WHERE key NOT IN "
+                "(SELECT key FROM extractions ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM extractions")
+
+
+class BrokerCacheBackend:
+    """Extraction results shared between nodes through the broker (see broker.py)."""
+
+    def __init__(self, broker, namespace="extract:"):
+        self.broker = broker
+        self.namespace = namespace
+        self.path = f"{broker.name}:{namespace}"
+
+    def get(self, key):
+        entry = self.broker.fetch(self.namespace + key)
+        if entry is None:
+            return None, None
+        return entry["value"], entry["expires"]
+
+    def set(self, key, value, expires):
+        self.broker.put(self.namespace + key, {"value": value, "expires": expires}, ttl=max(1, expires - time.time()))
+
+    def clear(self):
+        self.broker.clear(self.namespace)
+
+
+class ExtractionCache:
+    """TTL + LRU cache of yt-dlp extraction results, optionally backed by SQLite or the broker."""
+
+    def __init__(self, max_entries=EXTRACT_CACHE_SIZE, ttl=EXTRACT_CACHE_TTL, db_path=EXTRACT_CACHE_DB, backend=None):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.backend = backend
+        if backend is None and db_path:
+            try:
+                self.backend = SQLiteCacheBackend(db_path)
+            except sqlite3.Error as e:
+                print(f"⚠️ Shared extraction cache disabled: {e}")
+
+    def get(self, key):
+        """Return a private copy of the cached value, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return copy.deepcopy(value)
+                del self._entries[key]
+
+        if self.backend is not None:
+            try:
+                value, expires = self.backend.get(key)
+            except (sqlite3.Error, BrokerError) as e:
+                print(f"⚠️ Shared extraction cache read failed: {e}")
+                value = None
+            if value is not None:
+                with self._lock:
+                    self.shared_hits += 1
+                    self._store(key, value, expires)
+                return copy.deepcopy(value)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._store(key, value, expires)
+        if self.backend is not None:
+            try:
+                self.backend.set(key, value, expires)
+            except (sqlite3.Error, BrokerError, TypeError, ValueError) as e:
+                print(f"⚠️ Shared extraction cache write failed: {e}")
+
+    def _store(self, key, value, expires):
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round((self.hits + self.shared_hits) / lookups, 3) if lookups else 0.0,
+                "shared_backend": self.backend.path if self.backend else None,
+            }
@@ -0,0 +1,225 @@
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from contextlib import nullcontext
+from urllib.parse import urlsplit
+
+from lazy import lazy_import
+from metrics import span
+from racing import race
+from stream_discovery import classify_stream
+
+requests = lazy_import("requests")
+
+PROBE_TIMEOUT = float(os.environ.get("FALLBACK_PROBE_TIMEOUT", "5"))
+# Upper bound on fallback subprocesses running at once across all jobs
+FALLBACK_MAX_PROCESSES = int(os.environ.get("FALLBACK_MAX_PROCESSES", "3"))
+# Fallbacks racing each other for a single job
+FALLBACK_PARALLEL = int(os.environ.get("FALLBACK_PARALLEL", "2"))
+# Seconds to wait for killed losers to exit before their partial files are removed
+FALLBACK_REAP_TIMEOUT = float(os.environ.get("FALLBACK_REAP_TIMEOUT", "10"))
+
+_process_slots = threading.BoundedSemaphore(max(1, FALLBACK_MAX_PROCESSES))
+_live_processes = set()
+_live_lock = threading.Lock()
+
+
+def live_process_count():
+    with _live_lock:
+        return len(_live_processes)
+
+
+def track_process(proc):
+    """Count a subprocess as live until untrack_process is called."""
+    with _live_lock:
+        _live_processes.add(proc)
+
+
+def untrack_process(proc):
+    with _live_lock:
+        _live_processes.discard(proc)
+
+
+def run_process(cmd, timeout=None, cancel=None):
+    """Run cmd (an argument list, no shell) and kill its whole process group on timeout or cancel.
+
+    Returns (returncode, timed_out). returncode is None if it never finished.
+    """
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, start_new_session=True)
+    track_process(proc)
+
+    def kill():
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    unregister = cancel.on_cancel(kill) if cancel is not None else (lambda: None)
+    try:
+        try:
+            return proc.wait(timeout=timeout), False
+        except subprocess.TimeoutExpired:
+            kill()
+            proc.wait()
+            return None, True
+    finally:
+        unregister()
+        untrack_process(proc)
+
+
+class Probe:
+    """What a cheap request told us about a URL."""
+
+    def __init__(self, url):
+        self.url = url
+        self.reachable = False
+        self.status = None
+        self.content_type = None
+        self.length = None
+        self.kind = None  # 'manifest', 'media' or None (an HTML page or unknown)
+        self.error = None
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+def probe_url(url, timeout=PROBE_TIMEOUT):
+    """HEAD the URL (falling back to a one-byte ranged GET) and classify the response."""
+    probe = Probe(url)
+    if urlsplit(url).scheme not in ("http", "https"):
+        probe.error = "not an http(s) URL"
+        return probe
+    try:
+        resp = requests.head(url, timeout=timeout, allow_redirects=True)
+        if resp.status_code in (403, 405, 501):
+            # Plenty of CDNs refuse HEAD but answer a ranged GET
+            resp = requests.get(url, timeout=timeout, headers={"Range": "bytes=0-0"}, stream=True)
+            resp.close()
+        probe.status = resp.status_code
+        probe.reachable = resp.status_code < 400
+        probe.content_type = resp.headers.get("Content-Type")
+        length = resp.headers.get("Content-Length")
+        probe.length = int(length) if length and length.isdigit() else None
+        probe.kind = classify_stream(resp.url, probe.content_type)
+    except requests.RequestException as e:
+        probe.error = str(e)
+    return probe
+
+
+class Backend:
+    """An external downloader the fallback scheduler may run."""
+
+    def __init__(self, name, binary, build_cmd, accepts, timeout, priority=0, slot=None):
+        self.name = name
+        self.binary = binary
+        self.build_cmd = build_cmd   # (url, output_path) -> argument list
+        self.accepts = accepts       # Probe -> bool
+        self.timeout = timeout
+        self.priority = priority
+        self.slot = slot             # cancel -> context manager held while the process runs, or None
+
+    def viability(self, probe):
+        """Return None if the backend should run for this probe, else the reason it should not."""
+        if shutil.which(self.binary) is None:
+            return f"{self.binary} not installed"
+        if not probe.reachable and probe.kind is None:
+            return f"URL not reachable ({probe.error or probe.status})"
+        if not self.accepts(probe):
+            return f"not suited to {probe.kind or 'page'} URLs"
+        return None
+
+
+def run_fallbacks(url, backends, output_for, cancel=None, parallel=FALLBACK_PARALLEL):
+    """Probe url once, then race the viable backends and return a structured result.
+
+    output_for(backend) gives each backend its own output path so that racing
+    backends never write to the same file; losers' partial files are removed
+    once their processes have exited.
+    """
+    started = time.time()
+    probe = probe_url(url)
+    attempts = {}
+    viable = []
+    for backend in sorted(backends, key=lambda b: b.priority):
+        reason = backend.viability(probe)
+        if reason:
+            attempts[backend.name] = {"viable": False, "reason": reason}
+        else:
+            viable.append(backend)
+            attempts[backend.name] = {"viable": True}
+
+    result = {
+        "success": False,
+        "backend": None,
+        "output_path": None,
+        "probe": probe.to_dict(),
+        "attempts": attempts,
+    }
+    if not viable:
+        result["elapsed"] = round(time.time() - started, 2)
+        return result
+
+    # At most `parallel` of this job's backends hold a process slot at a time
+    job_slots = threading.BoundedSemaphore(max(1, parallel))
+    outputs = {b.name: output_for(b) for b in viable}
+
+    def strategy(backend):
+        def run(token):
+            while not job_slots.acquire(timeout=0.5):
+                if token.is_set():
+                    return None
+            try:
+                while not _process_slots.acquire(timeout=0.5):
+                    if token.is_set():
+                        return None
+                try:
+                    if token.is_set():
+                        return None
+                    try:
+                        slot = backend.slot(token) if backend.slot else nullcontext()
+                    except InterruptedError:
+                        return None
+                    print(f"[FALLBACK] Trying {backend.name}...")
+                    began = time.time()
+                    with slot, span("fallback", backend.name) as stage:
+                        returncode, timed_out = run_process(
+                            backend.build_cmd(url, outputs[backend.name]), backend.timeout, token)
+                        attempts[backend.name].update(
+                            returncode=returncode, timed_out=timed_out, elapsed=round(time.time() - began, 2))
+                        output = outputs[backend.name]
+                        if returncode == 0 and (output is None or os.path.exists(output)):
+                            return backend.name
+                        stage["outcome"] = "cancelled" if token.is_set() else "timeout" if timed_out else "error"
+                        return None
+                finally:
+                    _process_slots.release()
+            finally:
+                job_slots.release()
+        return run
+
+    outcome = race([(b.name, strategy(b)) for b in viable],
+                   timeout=max(b.timeout for b in viable) * len(viable), cancel=cancel, name="fallback",
+                   reap=FALLBACK_REAP_TIMEOUT)
+
+    for name, status in outcome.outcomes.items():
+        attempts[name]["outcome"] = status
+        path = outputs[name]
+        if name in outcome.stragglers:
+            # Removing the file under a process that is still writing it would just leave it half-written
+            print(f"⚠️ {name} did not exit within {FALLBACK_REAP_TIMEOUT}s; leaving {path}")
+        elif name != outcome.winner and path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    if outcome.winner:
+        result.update(success=True, backend=outcome.winner, output_path=outputs[outcome.winner])
+        print(f"✅ Downloaded using {outcome.winner}.")
+    else:
+        print("❌ All fallback downloaders failed.")
+    result["elapsed"] = round(time.time() - started, 2)
+    return result
@@ -0,0 +1,403 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+
+# Bytes/second all transfers on this instance may use together (0 = unlimited)
+GOVERNOR_BANDWIDTH = int(os.environ.get("GOVERNOR_BANDWIDTH", "0"))
+# Bytes/second one client's transfers may use together (0 = unlimited)
+GOVERNOR_USER_BANDWIDTH = int(os.environ.get("GOVERNOR_USER_BANDWIDTH", "0"))
+# Bytes/second speculative prefetches may use together, on top of nobody's share (0 = unlimited)
+GOVERNOR_SPECULATIVE_BANDWIDTH = int(os.environ.get("GOVERNOR_SPECULATIVE_BANDWIDTH", str(4 * 1024 ** 2)))
+# ffmpeg processes (conversions, merges, streams) allowed to run at once
+GOVERNOR_FFMPEG = int(os.environ.get("GOVERNOR_FFMPEG", str(max(1, (os.cpu_count() or 2) // 2))))
+# Free space every admitted job must leave on the download disk
+GOVERNOR_DISK_RESERVE = int(os.environ.get("GOVERNOR_DISK_RESERVE", str(1 << 30)))
+# Disk needed per expected output byte: the download plus a converted or merged copy
+GOVERNOR_DISK_FACTOR = float(os.environ.get("GOVERNOR_DISK_FACTOR", "2"))
+
+# Transfer kind of downloads nobody has asked for yet; they live on their own budget until promoted
+SPECULATIVE = "speculative"
+
+
+class AdmissionError(Exception):
+    """Not enough free disk to start the job."""
+
+
+class Busy(Exception):
+    """No ffmpeg slot free and the caller asked not to wait."""
+
+
+def estimate_bytes(formats, duration=None):
+    """Expected size of downloading formats: reported sizes, else bitrate x duration, else 0."""
+    total = 0
+    for fmt in formats:
+        size = fmt.get("filesize") or fmt.get("filesize_approx")
+        if not size and duration and fmt.get("tbr"):
+            size = fmt["tbr"] * 1000 / 8 * duration
+        total += size or 0
+    return int(total)
+
+
+def anonymize(owner):
+    return hashlib.sha256(str(owner).encode()).hexdigest()[:10] if owner else None
+
+
+class TokenBucket:
+    """Byte budget refilled at rate bytes/second, holding at most one second's worth.
+
+    consume() takes the bytes even when that leaves the bucket in debt, then
+    sleeps until the debt is paid off, so callers are slowed to the rate
+    without splitting their reads.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount, cancel=None):
+        if self.rate <= 0 or amount <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(float(self.rate), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            debt = -self.tokens / self.rate if self.tokens < 0 else 0
+        if debt:
+            if cancel is not None:
+                cancel.wait(debt)
+            else:
+                time.sleep(debt)
+
+
+class Transfer:
+    """One download or stream's bandwidth allocation.
+
+    rate is its current fair share, which the governor rebalances as
+    transfers start and finish; attach() a yt-dlp params dict to have its
+    ratelimit follow along. Bytes reported through hook() or consume() are
+    charged to the user's and the instance's token buckets.
+    """
+
+    def __init__(self, governor, owner, kind, job_id=None, cancel=None):
+        self.id = uuid.uuid4().hex
+        self.governor = governor
+        self.owner = owner
+        self.kind = kind
+        self.job_id = job_id
+        self.cancel = cancel
+        self.started_at = time.time()
+        self.bytes = 0
+        self.rate = None
+        self._params = []
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.governor._remove(self)
+
+    def attach(self, params):
+        """Keep params["ratelimit"] (a YoutubeDL's params) at this transfer's share."""
+        with self._lock:
+            self._params.append(params)
+            self._apply()
+
+    def _apply(self):
+        for params in self._params:
+            params["ratelimit"] = self.rate
+
+    def ydl_options(self):
+        return {"ratelimit": self.rate} if self.rate else {}
+
+    def consume(self, amount):
+        with self._lock:
+            self.bytes += amount
+        self.governor._charge(self, amount)
+
+    def hook(self, d):
+        """progress_hooks entry; resumed bytes are not charged."""
+        if d["status"] not in ("downloading", "finished"):
+            return
+        name = d.get("filename") or d.get("tmpfilename") or ""
+        downloaded = d.get("downloaded_bytes") or d.get("total_bytes") or 0
+        with self._lock:
+            previous = self._seen.get(name)
+            self._seen[name] = downloaded
+        if previous is not None and downloaded > previous:
+            self.consume(downloaded - previous)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "user": anonymize(self.owner),
+            "kind": self.kind,
+            # Hashed like the owner: a job id is enough to cancel the job or fetch its file
+            "job": anonymize(self.job_id),
+            "rate": self.rate,
+            "bytes": self.bytes,
+            "seconds": round(time.time() - self.started_at, 1),
+        }
+
+
+class FfmpegSlot:
+    def __init__(self, governor):
+        self.governor = governor
+        self._released = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.governor._release_ffmpeg()
+
+
+class Governor:
+    """Shares bandwidth, ffmpeg processes and disk space between concurrent jobs.
+
+    Every running transfer gets an equal share of the instance budget,
+    capped by an equal split of its user's (client address's) budget; the
+    shares go to yt-dlp as ratelimit and token buckets enforce the totals. ffmpeg runs are limited to ffmpeg_slots at a time,
+    and jobs are only admitted when the disk would keep disk_reserve free
+    after every admitted job's expected output.
+
+    Speculative transfers don't take a share of either budget: they split
+    speculative_bandwidth between them until promote() turns them into
+    ordinary downloads.
+    """
+
+    def __init__(self, bandwidth=GOVERNOR_BANDWIDTH, user_bandwidth=GOVERNOR_USER_BANDWIDTH,
+                 ffmpeg_slots=GOVERNOR_FFMPEG, disk_reserve=GOVERNOR_DISK_RESERVE, disk_factor=GOVERNOR_DISK_FACTOR,
+                 speculative_bandwidth=GOVERNOR_SPECULATIVE_BANDWIDTH):
+        self.bandwidth = bandwidth
+        self.user_bandwidth = user_bandwidth
+        self.speculative_bandwidth = speculative_bandwidth
+        self.ffmpeg_slots = max(1, ffmpeg_slots)
+        self.disk_reserve = disk_reserve
+        self.disk_factor = disk_factor
+        self._transfers = {}
+        self._global_bucket = TokenBucket(bandwidth)
+        self._user_buckets = {}
+        self._speculative_bucket = TokenBucket(speculative_bandwidth)
+        self._ffmpeg = threading.Condition()
+        self._ffmpeg_running = 0
+        self._ffmpeg_waiting = 0
+        self._reservations = {}
+        self._lock = threading.Lock()
+        self.throttled_seconds = 0.0
+        self.rejected = 0
+
+    # Bandwidth
+
+    def transfer(self, owner, kind, job_id=None, cancel=None):
+        """Open a Transfer; use it as a context manager or close() it."""
+        transfer = Transfer(self, owner, kind, job_id, cancel)
+        with self._lock:
+            self._transfers[transfer.id] = transfer
+            if self.user_bandwidth and owner not in self._user_buckets:
+                self._user_buckets[owner] = TokenBucket(self.user_bandwidth)
+            self._rebalance()
+        return transfer
+
+    def _remove(self, transfer):
+        with self._lock:
+            if self._transfers.pop(transfer.id, None) is None:
+                return
+            if not any(t.owner == transfer.owner for t in self._transfers.values()):
+                self._user_buckets.pop(transfer.owner, None)
+            self._rebalance()
+
+    def promote(self, job_id):
+        """Someone now waits on job_id's speculative transfers: give them an ordinary share."""
+        with self._lock:
+            promoted = [t for t in self._transfers.values() if t.job_id == job_id and t.kind == SPECULATIVE]
+            for t in promoted:
+                t.kind = "download"
+            if promoted:
+                self._rebalance()
+        return bool(promoted)
+
+    def _rebalance(self):
+        """Equal split of the instance budget, capped by an equal split of each user's budget."""
+        counts = {}
+        speculative = sum(1 for t in self._transfers.values() if t.kind == SPECULATIVE)
+        for t in self._transfers.values():
+            if t.kind != SPECULATIVE:
+                counts[t.owner] = counts.get(t.owner, 0) + 1
+        for t in self._transfers.values():
+            shares = []
+            if t.kind == SPECULATIVE:
+                if self.speculative_bandwidth:
+                    shares.append(self.speculative_bandwidth // speculative)
+            else:
+                if self.bandwidth:
+                    shares.append(self.bandwidth // sum(counts.values()))
+                if self.user_bandwidth:
+                    shares.append(self.user_bandwidth // counts[t.owner])
+            with t._lock:
+                t.rate = max(1, min(shares)) if shares else None
+                t._apply()
+
+    def _charge(self, transfer, amount):
+        started = time.monotonic()
+        bucket = self._speculative_bucket if transfer.kind == SPECULATIVE else self._user_buckets.get(transfer.owner)
+        if bucket is not None:
+            bucket.consume(amount, transfer.cancel)
+        self._global_bucket.consume(amount, transfer.cancel)
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            with self._lock:
+                self.throttled_seconds += waited
+
+    # ffmpeg
+
+    def ffmpeg(self, cancel=None, wait=True, on_wait=None):
+        """Take an ffmpeg slot, waiting for one unless wait=False (then raise Busy).
+
+        on_wait() is called once if the caller has to wait. Returns an
+        FfmpegSlot to use as a context manager or release().
+        """
+        with self._ffmpeg:
+            if self._ffmpeg_running >= self.ffmpeg_slots:
+                if not wait:
+                    raise Busy(f"All {self.ffmpeg_slots} ffmpeg slots are busy.")
+                if on_wait:
+                    on_wait()
+                self._ffmpeg_waiting += 1
+                try:
+                    while self._ffmpeg_running >= self.ffmpeg_slots:
+                        if cancel is not None and cancel.is_set():
+                            raise InterruptedError("cancelled while waiting for an ffmpeg slot")
+                        self._ffmpeg.wait(0.5)
+                finally:
+                    self._ffmpeg_waiting -= 1
+            self._ffmpeg_running += 1
+        return FfmpegSlot(self)
+
+    def _release_ffmpeg(self):
+        with self._ffmpeg:
+            self._ffmpeg_running -= 1
+            self._ffmpeg.notify()
+
+    def postprocessor_hook(self, cancel=None):
+        """(hook, release) holding an ffmpeg slot while each yt-dlp post-processor runs.
+
+        Call release() when the download ends, in case a post-processor
+        failed before reporting that it finished.
+        """
+        held = []
+        depth = [0]
+
+        def hook(d):
+            # MoveFiles only renames; everything else yt-dlp post-processes with ffmpeg
+            if d.get("postprocessor") == "MoveFiles":
+                return
+            # Post-processors can run others inside them; the outermost one holds the slot
+            if d["status"] == "started":
+                if depth[0] == 0:
+                    held.append(self.ffmpeg(cancel))
+                depth[0] += 1
+            elif d["status"] == "finished" and depth[0]:
+                depth[0] -= 1
+                if depth[0] == 0 and held:
+                    held.pop().release()
+
+        def release():
+            depth[0] = 0
+            while held:
+                held.pop().release()
+        return hook, release
+
+    # Disk
+
+    def _free_bytes(self, path):
+        while path and not os.path.exists(path):
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+        return shutil.disk_usage(path or ".").free
+
+    def disk_ok(self, path):
+        """Cheap pre-check for the request thread: is there room for anything at all?"""
+        with self._lock:
+            reserved = sum(self._reservations.values())
+        return self._free_bytes(path) - reserved > self.disk_reserve
+
+    def admit(self, path, expected_bytes):
+        """Reserve disk for a job about to write expected_bytes under path.
+
+        Raises AdmissionError when it would leave less than disk_reserve free
+        after the space other admitted jobs have reserved. Returns a context
+        manager that drops the reservation.
+        """
+        needed = int(expected_bytes * self.disk_factor)
+        free = self._free_bytes(path)
+        with self._lock:
+            reserved = sum(self._reservations.values())
+            if free - reserved - needed < self.disk_reserve:
+                self.rejected += 1
+                raise AdmissionError(
+                    f"Not enough disk space: {needed >> 20} MiB needed, "
+                    f"{max(0, free - reserved - self.disk_reserve) >> 20} MiB available.")
+            token = uuid.uuid4().hex
+            self._reservations[token] = needed
+        return _Reservation(self, token)
+
+    def _unreserve(self, token):
+        with self._lock:
+            self._reservations.pop(token, None)
+
+    def stats(self, path=None):
+        with self._lock:
+            transfers = [t.to_dict() for t in self._transfers.values()]
+            reserved = sum(self._reservations.values())
+            stats = {
+                "bandwidth": {
+                    "limit": self.bandwidth or None,
+                    "user_limit": self.user_bandwidth or None,
+                    "speculative_limit": self.speculative_bandwidth or None,
+                    "allocated": sum(t["rate"] or 0 for t in transfers),
+                    "throttled_seconds": round(self.throttled_seconds, 1),
+                    "transfers": transfers,
+                },
+                "disk": {
+                    "reserve": self.disk_reserve,
+                    "reserved": reserved,
+                    "admitted_jobs": len(self._reservations),
+                    "rejected": self.rejected,
+                },
+            }
+        with self._ffmpeg:
+            stats["ffmpeg"] = {"limit": self.ffmpeg_slots, "running": self._ffmpeg_running,
+                               "waiting": self._ffmpeg_waiting}
+        if path is not None:
+            stats["disk"]["free"] = self._free_bytes(path)
+        return stats
+
+
+class _Reservation:
+    def __init__(self, governor, token):
+        self.governor = governor
+        self.token = token
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.governor._unreserve(self.token)
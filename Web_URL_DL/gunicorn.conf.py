@@ -0,0 +1,19 @@
+# Picked up automatically by `gunicorn app:app` when started from this directory.
+import os
+
+# Import the app (and, in when_ready, the heavy backends) once in the master;
+# forked workers share those pages copy-on-write instead of importing again.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+
+def when_ready(server):
+    if preload_app:
+        import app
+        app.preload_backends()
+        server.log.info("Backends preloaded in master (app import took %ss)", app.startup["import_seconds"])
+
+
+def post_fork(server, worker):
+    # Threads don't survive fork, so each worker starts its own warm-up
+    import app
+    app.start_background()
@@ -0,0 +1,208 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# Seconds between a process's heartbeats for the jobs it owns
+JOB_STORE_HEARTBEAT = int(os.environ.get("JOB_STORE_HEARTBEAT", "15"))
+# A job whose owner can't be checked directly is orphaned after this long without a heartbeat
+JOB_STORE_STALE = int(os.environ.get("JOB_STORE_STALE", "60"))
+# Minimum seconds between progress writes for one job (state changes are always written)
+JOB_STORE_FLUSH = float(os.environ.get("JOB_STORE_FLUSH", "2"))
+# Restarts a job may be resumed after before it is failed (guards against jobs that kill their worker)
+JOB_STORE_MAX_ATTEMPTS = int(os.environ.get("JOB_STORE_MAX_ATTEMPTS", "3"))
+# Finished jobs are kept this long
+JOB_STORE_RETENTION = int(os.environ.get("JOB_STORE_RETENTION", str(7 * 86400)))
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS jobs ("
+    "id TEXT PRIMARY KEY, kind TEXT NOT NULL, func TEXT, args TEXT NOT NULL, kwargs TEXT NOT NULL, "
+    "owner TEXT, state TEXT NOT NULL, message TEXT, result TEXT, details TEXT NOT NULL, progress TEXT NOT NULL, "
+    "created_at REAL NOT NULL, started_at REAL, finished_at REAL, updated_at REAL NOT NULL, "
+    "worker TEXT, heartbeat REAL, attempts INTEGER NOT NULL DEFAULT 0)",
+    "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)",
+    "CREATE TABLE IF NOT EXISTS job_transitions ("
+    "job_id TEXT NOT NULL, state TEXT NOT NULL, message TEXT, at REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS job_transitions_job ON job_transitions (job_id)",
+)
+
+_tokens = {}
+
+
+def process_token(pid=None):
+    """pid:start-time, which stays unique when a restarted container reuses pids.
+
+    Falls back to pid:random where /proc isn't available; such tokens can only
+    be judged by their heartbeat.
+    """
+    pid = pid or os.getpid()
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # Field 22 (starttime) counted from the state field that follows "(comm)"
+            return f"{pid}:{f.read().rsplit(')', 1)[1].split()[19]}"
+    except (OSError, IndexError):
+        if pid != os.getpid():
+            return None
+        return _tokens.setdefault(pid, f"{pid}:{uuid.uuid4().hex}")
+
+
+def token_alive(token):
+    """True/False when the owning process can be checked, None when it can't."""
+    if not token or not os.path.isdir("/proc"):
+        return None
+    pid = token.split(":", 1)[0]
+    if not pid.isdigit():
+        return None
+    return process_token(int(pid)) == token
+
+
+class JobStore:
+    """Jobs and their state transitions in a SQLite (WAL) file.
+
+    Every process writes the jobs it runs, with its process token and a
+    heartbeat. When a process dies (worker recycled, timeout kill, deploy),
+    claim_orphans() hands its unfinished jobs to another process, which
+    runs them again; downloads resume from the partial files they left.
+    """
+
+    def __init__(self, path, flush_interval=JOB_STORE_FLUSH):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._opened = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _open(self):
+        """Create the file on first use, not when the app is imported."""
+        if self._opened:
+            return
+        with self._lock:
+            if not self._opened:
+                if os.path.dirname(self.path):
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with self._connect() as conn:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    for statement in SCHEMA:
+                        conn.execute(statement)
+                self._opened = True
+
+    def _write(self, sql, params=(), transition=None):
+        self._open()
+        try:
+            with self._connect() as conn:
+                cursor = conn.execute(sql, params)
+                if transition:
+                    conn.execute("INSERT INTO job_transitions (job_id, state, message, at) VALUES (?, ?, ?, ?)",
+                                 transition)
+                return cursor.rowcount
+        except sqlite3.Error as e:
+            print(f"⚠️ Job store write failed: {e}")
+            return 0
+
+    def insert(self, job):
+        now = time.time()
+        return self._write(
+            "INSERT OR REPLACE INTO jobs (id, kind, func, args, kwargs, owner, state, message, result, details, "
+            "progress, created_at, updated_at, worker, heartbeat, attempts) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL, ?, ?, ?, ?, ?, ?, ?)",
+            (job.id, job.kind, getattr(job.func, "__name__", None), json.dumps(list(job.args), default=str),
+             json.dumps(job.kwargs, default=str), job.owner, job.status, job.message, json.dumps(job.details),
+             json.dumps(job.progress), job.created_at, now, process_token(), now, job.attempts),
+            (job.id, job.status, job.message, now))
+
+    def save(self, job, transition=False):
+        """Write the job's kind, state, details and progress; transition=True also logs the state change."""
+        now = time.time()
+        job._flushed_at = now
+        return self._write(
+            "UPDATE jobs SET kind = ?, state = ?, message = ?, result = ?, details = ?, progress = ?, started_at = ?, "
+            "finished_at = ?, updated_at = ? WHERE id = ?",
+            (job.kind, job.status, job.message, json.dumps(job.result, default=str) if job.result is not None else None,
+             json.dumps(job.details, default=str), json.dumps(job.progress), job.started_at, job.finished_at,
+             now, job.id),
+            (job.id, job.status, job.message, now) if transition else None)
+
+    def save_progress(self, job):
+        """save(), at most once per flush_interval per job."""
+        if time.time() - job._flushed_at >= self.flush_interval:
+            self.save(job)
+
+    def delete(self, job_id):
+        self._write("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def fail(self, job_id, message):
+        now = time.time()
+        self._write("UPDATE jobs SET state = 'failed', message = ?, finished_at = ?, updated_at = ? WHERE id = ?",
+                    (message, now, now, job_id), (job_id, "failed", message, now))
+
+    def heartbeat(self):
+        self._write("UPDATE jobs SET heartbeat = ? WHERE worker = ? AND state IN ('queued', 'running')",
+                    (time.time(), process_token()))
+
+    def claim_orphans(self, stale=JOB_STORE_STALE):
+        """Take over unfinished jobs whose process is gone. Returns their rows as dicts."""
+        self._open()
+        me = process_token()
+        now = time.time()
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute("SELECT * FROM jobs WHERE state IN ('queued', 'running')").fetchall()
+        claimed = []
+        for row in rows:
+            if row["worker"] == me:
+                continue
+            alive = token_alive(row["worker"])
+            if alive or (alive is None and (row["heartbeat"] or 0) > now - stale):
+                continue
+            # Only one process wins the update; the others see rowcount 0
+            if self._write("UPDATE jobs SET worker = ?, heartbeat = ?, attempts = attempts + 1 "
+                           "WHERE id = ? AND worker IS ?", (me, now, row["id"], row["worker"])):
+                claimed.append(self._decode(dict(row), attempts=row["attempts"] + 1))
+        return claimed
+
+    @staticmethod
+    def _decode(row, **overrides):
+        for field in ("args", "kwargs", "details", "progress", "result"):
+            row[field] = json.loads(row[field]) if row.get(field) else None
+        row.update(overrides)
+        return row
+
+    def load(self, job_id):
+        """The stored job (with its transitions) as a dict, or None."""
+        self._open()
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            transitions = conn.execute("SELECT state, message, at FROM job_transitions WHERE job_id = ? "
+                                       "ORDER BY at", (job_id,)).fetchall()
+        job = self._decode(dict(row))
+        return {
+            "job_id": job["id"],
+            "kind": job["kind"],
+            "status": job["state"],
+            "message": job["message"],
+            "result": job["result"],
+            "created_at": job["created_at"],
+            "started_at": job["started_at"],
+            "finished_at": job["finished_at"],
+            "progress": job["progress"],
+            "details": job["details"],
+            "attempts": job["attempts"],
+            "transitions": [dict(t) for t in transitions],
+        }
+
+    def prune(self, retention=JOB_STORE_RETENTION):
+        cutoff = time.time() - retention
+        self._write("DELETE FROM job_transitions WHERE job_id IN "
+                    "(SELECT id FROM jobs WHERE finished_at < ? AND state IN ('finished', 'failed', 'cancelled'))",
+                    (cutoff,))
+        self._write("DELETE FROM jobs WHERE finished_at < ? AND state IN ('finished', 'failed', 'cancelled')",
+                    (cutoff,))
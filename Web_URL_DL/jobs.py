@@ -0,0 +1,680 @@
+import os
+import queue
+import threading
+import time
+import uuid
+
+from broker import BrokerError, node_id
+from job_store import JOB_STORE_FLUSH, JOB_STORE_HEARTBEAT, JOB_STORE_MAX_ATTEMPTS
+from metrics import trace
+
+# Job lifecycle states
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINAL_STATES = (FINISHED, FAILED, CANCELLED)
+
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "2"))
+DOWNLOAD_QUEUE_LIMIT = int(os.environ.get("DOWNLOAD_QUEUE_LIMIT", "16"))
+JOB_RETENTION_SECONDS = int(os.environ.get("JOB_RETENTION_SECONDS", "3600"))
+
+# Broker names: the shared work queue, the channel job transitions and cancels go out on,
+# and the per-job progress channel and state key
+BROKER_QUEUE = "jobs"
+BROKER_EVENTS = "jobs:events"
+
+
+def progress_channel(job_id):
+    return f"progress:{job_id}"
+
+
+def state_key(job_id):
+    return f"job:{job_id}"
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue has reached its depth limit."""
+
+
+class JobCancelled(Exception):
+    """Raised inside a running job once cancellation was requested."""
+
+
+class CancelToken:
+    """Cancellation flag that can also run cleanup callbacks (kill a browser, a subprocess...)."""
+
+    def __init__(self, parent=None):
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+        if parent is not None:
+            parent.on_cancel(self.cancel)
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"⚠️ Cancel callback failed: {e}")
+
+    def on_cancel(self, callback):
+        """Run callback on cancel (now, if already cancelled). Returns a function that unregisters it."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove(callback)
+        callback()
+        return lambda: None
+
+    def _remove(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+class Job:
+    """A single unit of download work and its current status."""
+
+    def __init__(self, kind, func, args=(), kwargs=None, owner=None, job_id=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.kind = kind
+        # Who asked for it (the client address); resources are shared out per owner
+        self.owner = owner
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.status = QUEUED
+        self.message = "Queued"
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = CancelToken()
+        # Progress channel: every published change bumps the version and
+        # wakes up the SSE streams waiting on this job.
+        self.progress = {
+            "status": "Queued",
+            "percent": 0.0,
+            "downloaded_bytes": 0,
+            "total_bytes": None,
+            "speed": None,
+            "eta": None,
+        }
+        self.version = 0
+        self._changed = threading.Condition()
+        # Timed stages (extraction, download, conversion...) as they finish
+        self.timings = []
+        # What the job resolved along the way (stream URL, format, output path...), kept in the job store
+        self.details = {}
+        # Times the job was resumed after the process running it died
+        self.attempts = 0
+        self.store = None
+        self._flushed_at = 0.0
+        # With a broker, progress and transitions are fanned out to the other nodes
+        self.broker = None
+        self._shared_at = 0.0
+        # The process that ran it
+        self.node = None
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def check_cancelled(self):
+        """Raise JobCancelled if the job was asked to stop."""
+        if self.cancel_event.is_set():
+            raise JobCancelled(f"Job {self.id} was cancelled.")
+
+    def update_progress(self, **fields):
+        """Merge fields into the progress state and notify listeners if anything changed."""
+        with self._changed:
+            changed = {k: v for k, v in fields.items() if self.progress.get(k) != v}
+            if not changed:
+                return
+            self.progress.update(changed)
+            self.version += 1
+            self._changed.notify_all()
+        if self.store is not None:
+            self.store.save_progress(self)
+        self._share()
+
+    def set_status(self, status, message):
+        with self._changed:
+            self.status = status
+            self.message = message
+            if status in FINAL_STATES:
+                self.finished_at = time.time()
+            self.version += 1
+            self._changed.notify_all()
+        if self.store is not None:
+            self.store.save(self, transition=True)
+        self._share(transition=True)
+
+    def record(self, **details):
+        """Remember what the job resolved (stream URL, format, output path...) in the job store."""
+        self.details.update(details)
+        if self.store is not None:
+            self.store.save(self)
+
+    def _share(self, transition=False):
+        """Publish progress to the job's broker channel; transitions also go out on BROKER_EVENTS.
+
+        The state key (what /jobs and late subscribers read) is written on
+        transitions and at most every JOB_STORE_FLUSH seconds otherwise.
+        """
+        if self.broker is None:
+            return
+        _, snapshot = self.snapshot()
+        try:
+            self.broker.publish(progress_channel(self.id), snapshot)
+            if transition or time.time() - self._shared_at >= JOB_STORE_FLUSH:
+                self._shared_at = time.time()
+                self.broker.put(state_key(self.id), self.to_dict(), ttl=JOB_RETENTION_SECONDS)
+            if transition:
+                self.broker.publish(BROKER_EVENTS, {"event": "state", "job_id": self.id, "status": self.status,
+                                                    "message": self.message, "result": self.result})
+        except BrokerError as e:
+            print(f"⚠️ Couldn't share job {self.id} through the broker: {e}")
+
+    def snapshot(self):
+        with self._changed:
+            return self.version, dict(self.progress, job_id=self.id, state=self.status, message=self.message)
+
+    def wait_for_update(self, seen_version, timeout=None):
+        """Block until the version moves past seen_version (or timeout).
+
+        Returns (version, snapshot); snapshot is None on timeout.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != seen_version, timeout=timeout)
+            if self.version == seen_version:
+                return seen_version, None
+        return self.snapshot()
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "node": self.node,
+            "status": self.status,
+            "message": self.message,
+            "result": self.result,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "progress": dict(self.progress),
+            "timings": list(self.timings),
+            "details": dict(self.details),
+            "attempts": self.attempts,
+        }
+
+
+class JobQueue:
+    """Bounded queue of jobs served by a fixed pool of worker threads.
+
+    With a JobStore, jobs are written through to it, and jobs left
+    unfinished by a process that died are picked up again by recover().
+
+    With a broker (see broker.py), jobs whose function is registered with
+    resumable() go on the broker's shared queue instead, and the workers of
+    every node take them from there. The submitting node keeps a stand-in
+    Job that follows the real one's transitions; progress, status and
+    cancellation work from any node.
+    """
+
+    def __init__(self, workers=DOWNLOAD_WORKERS, max_queued=DOWNLOAD_QUEUE_LIMIT,
+                 retention=JOB_RETENTION_SECONDS, store=None, broker=None):
+        self.workers = max(1, workers)
+        self.max_queued = max(1, max_queued)
+        self.retention = retention
+        self.store = store
+        self.broker = broker
+        self._queue = queue.Queue(maxsize=self.max_queued)
+        self._jobs = {}
+        # Stand-ins for jobs this process dispatched through the broker
+        self._remote = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._keeper = None
+        self._listener = None
+        self._resumable = {}
+
+    def _ensure_workers(self):
+        # Workers start lazily so that importing the module (e.g. in the
+        # gunicorn master before fork) does not spawn threads.
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._worker, name=f"download-worker-{len(self._threads)}", daemon=True)
+                t.start()
+                self._threads.append(t)
+        self._ensure_keeper()
+        self._ensure_listener()
+
+    def start(self):
+        """Start the workers now. With a broker they take jobs other nodes dispatched, so every node calls this."""
+        self._ensure_workers()
+
+    def _ensure_keeper(self):
+        if self.store is None:
+            return
+        with self._lock:
+            if self._keeper is None or not self._keeper.is_alive():
+                self._keeper = threading.Thread(target=self._keep, name="job-store-keeper", daemon=True)
+                self._keeper.start()
+
+    def _keep(self):
+        """Heartbeat this process's jobs and take over those of processes that died."""
+        while True:
+            time.sleep(JOB_STORE_HEARTBEAT)
+            try:
+                self.store.heartbeat()
+                self.recover()
+                self.store.prune()
+            except Exception as e:
+                print(f"⚠️ Job store upkeep failed: {e}")
+
+    def _ensure_listener(self):
+        if self.broker is None:
+            return
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name="job-broker-listener", daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        """Apply the transitions and cancels other nodes publish.
+
+        Pub/sub drops messages while disconnected, so the stand-ins are also
+        refreshed from their state keys every JOB_STORE_HEARTBEAT seconds.
+        """
+        subscription = None
+        refreshed = time.time()
+        while True:
+            try:
+                if subscription is None:
+                    subscription = self.broker.subscribe(BROKER_EVENTS)
+                message = subscription.get(timeout=1.0)
+                if message is not None:
+                    self._on_event(message)
+                if time.time() - refreshed >= JOB_STORE_HEARTBEAT:
+                    refreshed = time.time()
+                    self._refresh_remote()
+            except Exception as e:
+                print(f"⚠️ Job broker listener failed: {e}")
+                if subscription is not None:
+                    subscription.close()
+                subscription = None
+                time.sleep(1)
+
+    def _on_event(self, message):
+        job_id = message.get("job_id")
+        if message.get("event") == "state":
+            with self._lock:
+                stand_in = self._remote.get(job_id)
+            if stand_in is not None:
+                self._apply_remote(stand_in, message)
+        elif message.get("event") == "cancel":
+            job = self.get(job_id)
+            if job is not None and job.status not in FINAL_STATES:
+                self.cancel(job_id)
+
+    def _apply_remote(self, stand_in, state):
+        """Mirror the real job's status onto its stand-in, waking anything waiting on it."""
+        with stand_in._changed:
+            if stand_in.status in FINAL_STATES:
+                return
+            stand_in.status = state["status"]
+            stand_in.message = state.get("message")
+            stand_in.result = state.get("result")
+            if stand_in.status in FINAL_STATES:
+                stand_in.finished_at = time.time()
+            stand_in.version += 1
+            stand_in._changed.notify_all()
+        if stand_in.status in FINAL_STATES:
+            with self._lock:
+                self._remote.pop(stand_in.id, None)
+
+    def _refresh_remote(self):
+        with self._lock:
+            stand_ins = list(self._remote.values())
+        for stand_in in stand_ins:
+            state = self.broker.fetch(state_key(stand_in.id))
+            if state is not None and state["status"] != stand_in.status:
+                self._apply_remote(stand_in, state)
+
+    def resumable(self, func):
+        """Decorator: jobs running func are run again after a crash (func must cope with partial output).
+
+        With a broker these are also the jobs any node may run, found by name.
+        """
+        self._resumable[func.__name__] = func
+        return func
+
+    def recover(self):
+        """Queue the unfinished jobs of processes that died. Returns the recovered jobs."""
+        if self.store is None:
+            return []
+        recovered = []
+        for row in self.store.claim_orphans():
+            func = self._resumable.get(row["func"])
+            # resumable=False in its details: only worth running for the process that started it
+            if func is None or (row["details"] or {}).get("resumable") is False:
+                self.store.fail(row["id"], "Interrupted by a restart")
+                continue
+            if row["attempts"] > JOB_STORE_MAX_ATTEMPTS:
+                self.store.fail(row["id"], f"Gave up after {JOB_STORE_MAX_ATTEMPTS} restarts")
+                continue
+            job = Job(row["kind"], func, tuple(row["args"]), row["kwargs"], row["owner"], job_id=row["id"])
+            job.created_at = row["created_at"]
+            job.details = row["details"] or {}
+            job.attempts = row["attempts"]
+            job.progress.update(row["progress"] or {})
+            job.store = self.store
+            job.broker = self.broker
+            with self._lock:
+                self._jobs[job.id] = job
+            job.set_status(QUEUED, f"Resuming after a restart (attempt {job.attempts + 1})")
+            self._ensure_workers()
+            # Recovered jobs wait for room instead of being dropped
+            self._queue.put(job)
+            print(f"♻️ Resuming {job.kind} job {job.id} after a restart")
+            recovered.append(job)
+        return recovered
+
+    def submit(self, kind, func, *args, owner=None, **kwargs):
+        """Queue func(job, *args, **kwargs) and return the new Job."""
+        self._ensure_workers()
+        self._prune()
+        if self.broker is not None and self._resumable.get(func.__name__) is func:
+            job = self._dispatch(kind, func, args, kwargs, owner)
+            if job is not None:
+                return job
+        job = Job(kind, func, args, kwargs, owner)
+        job.store = self.store
+        job.broker = self.broker
+        with self._lock:
+            self._jobs[job.id] = job
+        if self.store is not None:
+            self.store.insert(job)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+            if self.store is not None:
+                self.store.delete(job.id)
+            raise QueueFullError(f"Download queue is full ({self.max_queued} jobs waiting).") from None
+        print(f"📥 Queued {kind} job {job.id} ({self.depth()} waiting)")
+        return job
+
+    def _dispatch(self, kind, func, args, kwargs, owner):
+        """Put the job on the broker's shared queue and return its stand-in (None if the broker is down)."""
+        job = Job(kind, func, args, kwargs, owner)
+        try:
+            waiting = self.broker.length(BROKER_QUEUE)
+            if waiting >= self.max_queued:
+                raise QueueFullError(f"Download queue is full ({waiting} jobs waiting).")
+            self.broker.put(state_key(job.id), job.to_dict(), ttl=self.retention)
+            with self._lock:
+                self._remote[job.id] = job
+            self.broker.push(BROKER_QUEUE, {"id": job.id, "kind": kind, "func": func.__name__, "args": list(args),
+                                            "kwargs": kwargs, "owner": owner, "created_at": job.created_at})
+        except BrokerError as e:
+            with self._lock:
+                self._remote.pop(job.id, None)
+            print(f"⚠️ Broker unavailable, queueing {kind} job here: {e}")
+            return None
+        print(f"📤 Dispatched {kind} job {job.id} ({waiting + 1} waiting on the broker)")
+        return job
+
+    def _claim(self, message):
+        """The Job for a message taken off the broker's queue, or None if it shouldn't run."""
+        func = self._resumable.get(message["func"])
+        job = Job(message["kind"], func, tuple(message["args"]), message["kwargs"], message["owner"],
+                  job_id=message["id"])
+        job.created_at = message["created_at"]
+        job.store = self.store
+        job.broker = self.broker
+        if func is None:
+            job.set_status(FAILED, f"No {message['func']} job on this node")
+            return None
+        with self._lock:
+            self._jobs[job.id] = job
+        if self.store is not None:
+            self.store.insert(job)
+        try:
+            cancelled = self.broker.fetch(f"cancel:{job.id}")
+        except BrokerError:
+            cancelled = None
+        if cancelled:
+            self._finish(job, CANCELLED, "Cancelled before start")
+            return None
+        return job
+
+    def register(self, kind, owner=None, func=None, details=None, **params):
+        """Track a job that the caller runs itself (e.g. a streamed response) instead of a worker.
+
+        func, if the caller runs it through run(), is stored with the job so
+        that recover() can resume it; details are stored from the start.
+        """
+        self._prune()
+        job = Job(kind, func, (), params, owner)
+        job.details = dict(details or {})
+        job.store = self.store
+        job.broker = self.broker
+        with self._lock:
+            self._jobs[job.id] = job
+        if self.store is not None:
+            self.store.insert(job)
+            self._ensure_keeper()
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _shared_state(self, job_id):
+        if self.broker is None:
+            return None
+        try:
+            return self.broker.fetch(state_key(job_id))
+        except BrokerError as e:
+            print(f"⚠️ Broker lookup of job {job_id} failed: {e}")
+            return None
+
+    def lookup(self, job_id):
+        """Job status as a dict, from this process, the broker (jobs other nodes run) or the store."""
+        job = self.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        state = self._shared_state(job_id)
+        if state is not None:
+            return state
+        return self.store.load(job_id) if self.store is not None else None
+
+    def follow(self, job_id, keepalive):
+        """Progress of a job another node runs; None if the broker doesn't know the job.
+
+        A generator of snapshots (None after keepalive seconds without one)
+        that ends after the final state.
+        """
+        if self.broker is None:
+            return None
+        # Subscribe before reading the state, so nothing published in between is missed
+        try:
+            subscription = self.broker.subscribe(progress_channel(job_id))
+        except BrokerError as e:
+            print(f"⚠️ Couldn't follow job {job_id}: {e}")
+            return None
+        state = self._shared_state(job_id)
+        if state is None:
+            subscription.close()
+            return None
+
+        def updates():
+            try:
+                yield dict(state["progress"], job_id=job_id, state=state["status"], message=state["message"])
+                if state["status"] in FINAL_STATES:
+                    return
+                while True:
+                    snapshot = subscription.get(timeout=keepalive)
+                    yield snapshot
+                    if snapshot is not None and snapshot["state"] in FINAL_STATES:
+                        return
+            finally:
+                subscription.close()
+        return updates()
+
+    def cancel(self, job_id):
+        """Request cancellation. Returns the job's status dict, or None if unknown."""
+        job = self.get(job_id)
+        if job is None:
+            return self._cancel_remote(job_id)
+        if job.status in FINAL_STATES:
+            return job.to_dict()
+        job.cancel_event.cancel()
+        if job.status == QUEUED:
+            # The worker will skip it when it is dequeued.
+            self._finish(job, CANCELLED, "Cancelled before start")
+        else:
+            job.set_status(job.status, "Cancelling...")
+        return job.to_dict()
+
+    def _cancel_remote(self, job_id):
+        """Cancel a job another node runs or will run.
+
+        Sets a flag for whichever node takes it off the queue, and tells the
+        node already running it.
+        """
+        state = self._shared_state(job_id)
+        if state is None or state["status"] in FINAL_STATES:
+            return state
+        try:
+            self.broker.put(f"cancel:{job_id}", True, ttl=self.retention)
+            self.broker.publish(BROKER_EVENTS, {"event": "cancel", "job_id": job_id})
+        except BrokerError as e:
+            print(f"⚠️ Couldn't cancel job {job_id} through the broker: {e}")
+            return state
+        return dict(state, message="Cancelling...")
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def active(self):
+        with self._lock:
+            return sum(1 for j in self._jobs.values() if j.status == RUNNING)
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        stats = {
+            "workers": self.workers,
+            "queue_limit": self.max_queued,
+            "queued": self.depth(),
+            "jobs": counts,
+        }
+        if self.broker is not None:
+            with self._lock:
+                stats["dispatched"] = len(self._remote)
+            try:
+                stats["broker_queued"] = self.broker.length(BROKER_QUEUE)
+            except BrokerError:
+                stats["broker_queued"] = None
+        return stats
+
+    def _finish(self, job, status, message, result=None):
+        if result is not None:
+            job.result = result
+        job.set_status(status, message)
+
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        with self._lock:
+            stale = [jid for jid, j in self._jobs.items()
+                     if j.status in FINAL_STATES and j.finished_at and j.finished_at < cutoff]
+            for jid in stale:
+                del self._jobs[jid]
+            # Stand-ins whose job never reported back (its node died with it)
+            for jid in [jid for jid, j in self._remote.items() if j.created_at < cutoff]:
+                del self._remote[jid]
+
+    def _next(self):
+        """(job, from_local_queue): this process's queue first, then the broker's."""
+        if self.broker is None:
+            return self._queue.get(), True
+        while True:
+            try:
+                return self._queue.get_nowait(), True
+            except queue.Empty:
+                pass
+            try:
+                message = self.broker.pop(BROKER_QUEUE, timeout=1.0)
+            except BrokerError as e:
+                print(f"⚠️ Couldn't take a job from the broker: {e}")
+                # Local jobs still run while the broker is away
+                try:
+                    return self._queue.get(timeout=5), True
+                except queue.Empty:
+                    continue
+            if message is not None:
+                job = self._claim(message)
+                if job is not None:
+                    return job, False
+
+    def run(self, job):
+        """Run job.func in the calling thread, recording its transitions as a worker would.
+
+        For registered jobs that don't belong on the worker pool (e.g.
+        speculative prefetches, which must not hold up real downloads).
+        """
+        if job.cancelled:
+            if job.status not in FINAL_STATES:
+                self._finish(job, CANCELLED, "Cancelled before start")
+            return
+        job.node = node_id()
+        job.started_at = time.time()
+        job.set_status(RUNNING, "Running")
+        try:
+            with trace(job.timings):
+                result = job.func(job, *job.args, **job.kwargs)
+        except JobCancelled:
+            self._finish(job, CANCELLED, "Cancelled")
+        except Exception as e:
+            if job.cancelled:
+                self._finish(job, CANCELLED, "Cancelled")
+            else:
+                print(f"❌ Job {job.id} crashed: {e}")
+                self._finish(job, FAILED, f"Error: {e}")
+        else:
+            result = result or {}
+            if result.get("status") == "error":
+                self._finish(job, FAILED, result.get("message", "Failed"), result)
+            else:
+                self._finish(job, FINISHED, result.get("message", "Done"), result)
+
+    def _worker(self):
+        while True:
+            job, local = self._next()
+            try:
+                if not job.cancelled:
+                    self.run(job)
+            finally:
+                if local:
+                    self._queue.task_done()
@@ -0,0 +1,55 @@
+import importlib
+import threading
+import time
+
+_load_seconds = {}
+_lock = threading.Lock()
+
+
+class LazyModule:
+    """Stand-in for a module that is only imported on first attribute access.
+
+    Keeps heavy backends (yt-dlp, Selenium, requests) out of worker startup;
+    code keeps writing yt_dlp.YoutubeDL(...) as if it were the real module.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            with _lock:
+                if self._module is None:
+                    started = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    _load_seconds[self._name] = round(time.perf_counter() - started, 3)
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r} ({'loaded' if self._module is not None else 'not loaded'})>"
+
+
+_modules = {}
+
+
+def lazy_import(name):
+    """Shared LazyModule for name, so every importer sees the same load state."""
+    with _lock:
+        return _modules.setdefault(name, LazyModule(name))
+
+
+def preload(*names):
+    """Import the named lazy modules now (e.g. in the gunicorn master before fork)."""
+    for name in names or list(_modules):
+        lazy_import(name)._load()
+
+
+def load_times():
+    """Seconds each lazy module took to import, for the ones loaded so far."""
+    with _lock:
+        return {name: _load_seconds.get(name) for name in _modules}
@@ -0,0 +1,202 @@
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Print one line per finished span
+METRICS_LOG_SPANS = os.environ.get("METRICS_LOG_SPANS", "1") == "1"
+PREFIX = "urldl_"
+
+# Stage durations run from milliseconds (cache hits) to tens of minutes (long downloads)
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+# Span list of the job running in this context; race() copies the context into its threads
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with optional labels."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_labels(self.labels, key)} {_number(v)}" for key, v in sorted(values.items())]
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values = {}  # label values -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        with self._lock:
+            values = {k: (list(c), s, n) for k, (c, s, n) in self._values.items()}
+        lines = []
+        for key, (counts, total, count) in sorted(values.items()):
+            for bound, bucket in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, [('le', _number(bound))])} {bucket}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Collected:
+    """Values read from elsewhere at scrape time (pool sizes, cache stats...).
+
+    collect() returns a number, or a dict mapping label-value tuples to numbers.
+    """
+
+    def __init__(self, name, help, collect, kind="gauge", labels=()):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.kind = kind
+        self.labels = tuple(labels)
+
+    def render(self):
+        try:
+            values = self.collect()
+        except Exception as e:
+            print(f"⚠️ Metric {self.name} failed: {e}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{_labels(self.labels, key)} {_number(v)}"
+                for key, v in sorted(values.items()) if v is not None]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(PREFIX + name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(PREFIX + name, help, labels, buckets))
+
+    def collect(self, name, help, collect, kind="gauge", labels=()):
+        return self._add(Collected(PREFIX + name, help, collect, kind, labels))
+
+    def render(self):
+        """The Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    "stage_duration_seconds", "Time spent in each pipeline stage.", ("stage", "strategy", "outcome"))
+strategy_results = registry.counter(
+    "strategy_results_total", "Outcomes of raced strategies (extractors, fallback downloaders).",
+    ("race", "strategy", "outcome"))
+bytes_transferred = registry.counter(
+    "bytes_transferred_total", "Media bytes fetched or sent, by path.", ("path",))
+
+
+@contextmanager
+def trace(spans):
+    """Collect the spans finished in this context (and the races it starts) into spans."""
+    token = _trace.set(spans)
+    try:
+        yield spans
+    finally:
+        _trace.reset(token)
+
+
+@contextmanager
+def span(stage, strategy=""):
+    """Time a stage into stage_duration_seconds and the current trace.
+
+    The outcome is 'ok', 'cancelled' (JobCancelled and friends), or 'error'.
+    Code that finishes without raising but still failed can set
+    record["outcome"] on the yielded dict.
+    """
+    record = {"stage": stage, "strategy": strategy, "outcome": "ok"}
+    started = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record["outcome"] = "cancelled" if "Cancel" in type(e).__name__ else "error"
+        raise
+    finally:
+        record_span(stage, time.perf_counter() - started, strategy, record["outcome"])
+
+
+def record_span(stage, seconds, strategy="", outcome="ok"):
+    """Record an already measured stage (for callbacks that only see its start and end)."""
+    record = {"stage": stage, "strategy": strategy, "outcome": outcome, "seconds": round(seconds, 3)}
+    stage_seconds.observe(seconds, stage=stage, strategy=strategy, outcome=outcome)
+    spans = _trace.get()
+    if spans is not None:
+        spans.append(record)
+    if METRICS_LOG_SPANS:
+        print(f"[SPAN] stage={stage}{f' strategy={strategy}' if strategy else ''} "
+              f"outcome={outcome} seconds={record['seconds']}")
+
+
+def run_in_context(func):
+    """Wrap func so that the thread running it sees the caller's trace. Use each wrapper once."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
@@ -0,0 +1,130 @@
+import json
+import os
+import shutil
+import subprocess
+
+FFPROBE_TIMEOUT = float(os.environ.get("FFPROBE_TIMEOUT", "15"))
+# x264 settings for the rare sources whose video MP4 cannot carry
+TRANSCODE_PRESET = os.environ.get("TRANSCODE_PRESET", "ultrafast")
+TRANSCODE_CRF = os.environ.get("TRANSCODE_CRF", "18")
+AUDIO_TRANSCODE_BITRATE = "192k"
+
+# Codec name prefixes (yt-dlp and ffprobe spellings) that MP4 carries as-is
+MP4_VIDEO_CODECS = ("avc", "h264", "hev", "hvc", "h265", "hevc", "av01", "av1", "vp09", "vp9", "mp4v", "mpeg4")
+MP4_AUDIO_CODECS = ("mp4a", "aac", "mp3", "ac-3", "ac3", "ec-3", "eac3", "opus", "flac", "alac")
+
+COPY = "copy"
+AUDIO_TRANSCODE = "audio_transcode"
+TRANSCODE = "transcode"
+
+
+class Plan:
+    """How a download gets into MP4: stream copy, audio-only transcode or full transcode."""
+
+    def __init__(self, action, video_codec=None, audio_codec=None, source="info", reason=""):
+        self.action = action
+        self.video_codec = video_codec
+        self.audio_codec = audio_codec
+        self.source = source  # where the codecs came from: 'info', 'ffprobe' or 'unknown'
+        self.reason = reason
+
+    def codec_args(self):
+        """ffmpeg output codec arguments for this plan."""
+        if self.action == COPY:
+            return ["-c", "copy"]
+        audio = ["-c:a", "aac", "-b:a", AUDIO_TRANSCODE_BITRATE]
+        if self.action == AUDIO_TRANSCODE:
+            return ["-c:v", "copy"] + audio
+        return ["-c:v", "libx264", "-preset", TRANSCODE_PRESET, "-crf", TRANSCODE_CRF] + audio
+
+    def ydl_options(self):
+        """yt-dlp post-processing options that carry out the plan."""
+        if self.action == COPY:
+            # The merger already stream-copies; the remuxer only rewraps a non-MP4 container
+            return {
+                "merge_output_format": "mp4",
+                "postprocessors": [{"key": "FFmpegVideoRemuxer", "preferedformat": "mp4"}],
+            }
+        # Merge into MKV, which takes any codec, then convert once into MP4
+        return {
+            "merge_output_format": "mkv",
+            "postprocessors": [{"key": "FFmpegVideoConvertor", "preferedformat": "mp4"}],
+            "postprocessor_args": {"videoconvertor": self.codec_args()},
+        }
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+def _codec(formats, field):
+    """The first real codec in formats; None if unknown, 'none' if no format has that stream."""
+    unknown = not formats
+    for fmt in formats:
+        codec = fmt.get(field)
+        if codec is None:
+            unknown = True
+        elif codec != "none":
+            return codec.lower()
+    return None if unknown else "none"
+
+
+def _fits(codec, allowed):
+    return codec == "none" or codec.startswith(allowed)
+
+
+def ffprobe_codecs(url, headers=None, timeout=FFPROBE_TIMEOUT):
+    """(video codec, audio codec) of a URL according to ffprobe; (None, None) if it can't tell."""
+    if shutil.which("ffprobe") is None:
+        return None, None
+    cmd = ["ffprobe", "-v", "error", "-show_entries", "stream=codec_type,codec_name", "-of", "json"]
+    if headers:
+        cmd += ["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())]
+    try:
+        out = subprocess.run(cmd + [url], capture_output=True, timeout=timeout, check=True).stdout
+        streams = json.loads(out or b"{}").get("streams", [])
+    except (subprocess.SubprocessError, OSError, ValueError) as e:
+        print(f"[POSTPROCESS] ffprobe failed: {e}")
+        return None, None
+    found = {s.get("codec_type"): s.get("codec_name", "").lower() for s in reversed(streams)}
+    return found.get("video", "none"), found.get("audio", "none")
+
+
+def _probed_codec(codecs):
+    real = [c for c in codecs if c and c != "none"]
+    if real:
+        return real[0]
+    return "none" if "none" in codecs else None
+
+
+def plan_postprocessing(formats):
+    """Pick the cheapest way to get the selected formats into MP4.
+
+    Codecs come from the yt-dlp format dicts; when those don't say, ffprobe
+    looks at the format URLs. If neither knows, fall back to copying video
+    and transcoding audio, which is what every download used to do.
+    """
+    video, audio, source = _codec(formats, "vcodec"), _codec(formats, "acodec"), "info"
+    if video is None or audio is None:
+        probed = [ffprobe_codecs(f["url"], f.get("http_headers")) for f in formats if f.get("url")]
+        if video is None:
+            video = _probed_codec([v for v, _ in probed])
+        if audio is None:
+            audio = _probed_codec([a for _, a in probed])
+        source = "ffprobe" if video is not None and audio is not None else "unknown"
+    return plan_for_codecs(video, audio, source)
+
+
+def plan_for_codecs(video, audio, source="info"):
+    if video is None or audio is None:
+        return Plan(AUDIO_TRANSCODE, video, audio, "unknown", "codecs unknown; copying video, transcoding audio")
+    if not _fits(video, MP4_VIDEO_CODECS):
+        return Plan(TRANSCODE, video, audio, source, f"{video} video doesn't fit MP4")
+    if not _fits(audio, MP4_AUDIO_CODECS):
+        return Plan(AUDIO_TRANSCODE, video, audio, source, f"{audio} audio doesn't fit MP4")
+    return Plan(COPY, video, audio, source, "streams already fit MP4")
+
+
+def plan_for_url(url):
+    """Plan for a raw media URL (fallback downloads), based on ffprobe alone."""
+    video, audio = ffprobe_codecs(url)
+    return plan_for_codecs(video, audio, "ffprobe")
@@ -0,0 +1,99 @@
+import os
+import queue
+import threading
+import time
+
+from jobs import CancelToken
+from metrics import run_in_context, strategy_results
+
+EXTRACT_RACE_TIMEOUT = float(os.environ.get("EXTRACT_RACE_TIMEOUT", "30"))
+
+
+class RaceResult:
+    """Outcome of a race: the winning strategy (if any) and how every entrant fared."""
+
+    def __init__(self):
+        self.winner = None
+        self.value = None
+        self.elapsed = 0.0
+        self.outcomes = {}
+        self.stragglers = []  # cancelled entrants still running when race() returned
+
+    def to_dict(self):
+        return {"winner": self.winner, "elapsed": round(self.elapsed, 2), "outcomes": self.outcomes}
+
+
+def race(strategies, accept=lambda value: value is not None, timeout=EXTRACT_RACE_TIMEOUT, cancel=None, name="race",
+         reap=0):
+    """Run strategies concurrently and return the first acceptable result.
+
+    strategies is a list of (name, func) pairs; each func is called with a
+    CancelToken and should stop promptly once it is cancelled. Losers are
+    cancelled as soon as a winner is found, so the worst case is the slowest
+    strategy (bounded by timeout) instead of the sum of all of them.
+    Every entrant's outcome is counted under name in strategy_results.
+
+    With reap > 0, race() waits up to that many seconds for the cancelled
+    entrants to return, so the caller can clean up after them (e.g. remove
+    files their killed processes were writing); any still running are
+    listed in result.stragglers.
+    """
+    token = CancelToken(parent=cancel)
+    results = queue.Queue()
+    result = RaceResult()
+    started = time.time()
+
+    def run(entrant, func):
+        try:
+            results.put((entrant, func(token), None))
+        except Exception as e:
+            results.put((entrant, None, e))
+
+    outcomes = {}
+    threads = []
+    for entrant, func in strategies:
+        result.outcomes[entrant] = "running"
+        thread = threading.Thread(target=run_in_context(run), args=(entrant, func), name=f"race-{entrant}", daemon=True)
+        thread.start()
+        threads.append((entrant, thread))
+
+    pending = len(strategies)
+    deadline = started + timeout
+    try:
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0 or token.is_set():
+                break
+            try:
+                entrant, value, error = results.get(timeout=remaining)
+            except queue.Empty:
+                break
+            pending -= 1
+            elapsed = time.time() - started
+            if error is not None:
+                result.outcomes[entrant] = f"error after {elapsed:.1f}s: {error}"
+                outcomes[entrant] = "error"
+            elif accept(value):
+                result.outcomes[entrant] = f"won in {elapsed:.1f}s"
+                outcomes[entrant] = "won"
+                result.winner, result.value = entrant, value
+                break
+            else:
+                result.outcomes[entrant] = f"no result after {elapsed:.1f}s"
+                outcomes[entrant] = "no_result"
+    finally:
+        # Stops the losers and releases their browsers/subprocesses
+        token.cancel()
+
+    if reap > 0:
+        reap_deadline = time.time() + reap
+        for entrant, thread in threads:
+            thread.join(max(0, reap_deadline - time.time()))
+        result.stragglers = [entrant for entrant, thread in threads if thread.is_alive()]
+
+    for entrant, outcome in result.outcomes.items():
+        if outcome == "running":
+            result.outcomes[entrant] = "cancelled"
+        strategy_results.inc(race=name, strategy=entrant, outcome=outcomes.get(entrant, "cancelled"))
+    result.elapsed = time.time() - started
+    return result
@@ -0,0 +1,459 @@
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from urllib.parse import urljoin
+
+from fallbacks import run_process
+from lazy import lazy_import
+from streaming import adts_filter_args
+
+requests = lazy_import("requests")
+
+SEGMENT_WORKERS = int(os.environ.get("SEGMENT_WORKERS", "8"))
+SEGMENT_RETRIES = int(os.environ.get("SEGMENT_RETRIES", "5"))
+SEGMENT_TIMEOUT = float(os.environ.get("SEGMENT_TIMEOUT", "20"))
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"
+# Codecs (RFC 6381 prefixes) MP4 can carry; anything else is remuxed into Matroska instead
+MP4_CODECS = ("avc1", "avc3", "hvc1", "hev1", "av01", "vp09", "mp4a", "aac", "opus", "ac-3", "ec-3", "flac", "mp3")
+
+
+class UnsupportedStream(Exception):
+    """The manifest uses something this engine does not handle (DRM, live, ...)."""
+
+
+class Segment:
+    def __init__(self, url, byterange=None):
+        self.url = url
+        self.byterange = byterange  # (first_byte, last_byte) or None
+
+
+class Track:
+    """One downloadable rendition: an optional init segment followed by media segments."""
+
+    def __init__(self, kind, segments, init=None, bandwidth=0, height=None, duration=None, codecs=()):
+        self.kind = kind  # 'video', 'audio' or 'muxed'
+        self.segments = segments
+        self.init = init
+        self.bandwidth = bandwidth
+        self.height = height
+        self.duration = duration  # seconds, when the manifest says
+        self.codecs = list(codecs)  # e.g. ['avc1.64001f', 'mp4a.40.2']; empty when the manifest doesn't say
+
+
+_session_local = threading.local()
+
+
+def http_session():
+    """Per-thread pooled HTTP session."""
+    session = getattr(_session_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=SEGMENT_WORKERS)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers["User-Agent"] = USER_AGENT
+        _session_local.session = session
+    return session
+
+
+def retryable(exc):
+    """Whether a failed segment request may succeed if tried again (network trouble, 5xx, 429)."""
+    if isinstance(exc, requests.HTTPError):
+        status = exc.response.status_code if exc.response is not None else None
+        return status is None or status >= 500 or status == 429
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError))
+
+
+def fetch(url, byterange=None, retries=SEGMENT_RETRIES, cancel=None):
+    """GET url (optionally a byte range), retrying transient failures with exponential backoff.
+
+    Client errors such as 403 or 404 won't change on a retry and are raised at once.
+    """
+    headers = {"Range": f"bytes={byterange[0]}-{byterange[1]}"} if byterange else {}
+    delay = 0.5
+    for attempt in range(retries + 1):
+        if cancel is not None and cancel.is_set():
+            raise InterruptedError("cancelled")
+        try:
+            resp = http_session().get(url, headers=headers, timeout=SEGMENT_TIMEOUT)
+            resp.raise_for_status()
+            return resp.content
+        except requests.RequestException as e:
+            if attempt == retries or not retryable(e):
+                raise
+            time.sleep(delay)
+            delay = min(delay * 2, 8)
+
+
+# --- HLS -------------------------------------------------------------------
+
+_ATTR_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+def _attrs(line):
+    return {k: v.strip('"') for k, v in _ATTR_RE.findall(line.split(":", 1)[1])}
+
+
+def _byterange(value, last_end):
+    length, _, offset = value.partition("@")
+    start = int(offset) if offset else last_end
+    return start, start + int(length) - 1
+
+
+def parse_hls(text, base_url, max_height=None):
+    """Return (video_or_muxed_track, audio_track_or_None) for an HLS playlist."""
+    lines = [l.strip() for l in text.splitlines() if l.strip()]
+    if not lines or lines[0] != "#EXTM3U":
+        raise UnsupportedStream("not an HLS playlist")
+
+    if any(l.startswith("#EXT-X-STREAM-INF") for l in lines):
+        variants, audio_groups = [], {}
+        for i, line in enumerate(lines):
+            if line.startswith("#EXT-X-MEDIA:"):
+                attrs = _attrs(line)
+                if attrs.get("TYPE") == "AUDIO" and attrs.get("URI"):
+                    group = audio_groups.setdefault(attrs.get("GROUP-ID"), [])
+                    group.insert(0 if attrs.get("DEFAULT") == "YES" else len(group), urljoin(base_url, attrs["URI"]))
+            elif line.startswith("#EXT-X-STREAM-INF:") and i + 1 < len(lines):
+                attrs = _attrs(line)
+                resolution = attrs.get("RESOLUTION", "")
+                height = int(resolution.split("x")[1]) if "x" in resolution else None
+                variants.append((int(attrs.get("BANDWIDTH", 0)), height, urljoin(base_url, lines[i + 1]), attrs.get("AUDIO"),
+                                 [c.strip() for c in attrs.get("CODECS", "").split(",") if c.strip()]))
+        if max_height:
+            capped = [v for v in variants if v[1] is None or v[1] <= max_height]
+            variants = capped or variants
+        bandwidth, height, variant_url, audio_group, codecs = max(variants, key=lambda v: (v[0], v[1] or 0))
+        video, _ = parse_hls(fetch(variant_url).decode("utf-8", "replace"), variant_url)
+        # The variant's CODECS covers its audio rendition too
+        video.bandwidth, video.height, video.codecs = bandwidth, height, codecs
+        audio = None
+        if audio_group and audio_groups.get(audio_group):
+            audio_url = audio_groups[audio_group][0]
+            audio, _ = parse_hls(fetch(audio_url).decode("utf-8", "replace"), audio_url)
+            audio.kind = "audio"
+            video.kind = "video"
+        return video, audio
+
+    segments, init = [], None
+    pending_range, last_end = None, 0
+    duration = 0.0
+    for i, line in enumerate(lines):
+        if line.startswith("#EXTINF:"):
+            try:
+                duration += float(line.split(":", 1)[1].split(",", 1)[0])
+            except ValueError:
+                pass
+        elif line.startswith("#EXT-X-KEY:"):
+            if _attrs(line).get("METHOD", "NONE") != "NONE":
+                raise UnsupportedStream("encrypted HLS")
+        elif line.startswith("#EXT-X-MAP:"):
+            attrs = _attrs(line)
+            br = _byterange(attrs["BYTERANGE"], 0) if "BYTERANGE" in attrs else None
+            init = Segment(urljoin(base_url, attrs["URI"]), br)
+        elif line.startswith("#EXT-X-BYTERANGE:"):
+            pending_range = _byterange(line.split(":", 1)[1], last_end)
+        elif not line.startswith("#"):
+            segments.append(Segment(urljoin(base_url, line), pending_range))
+            if pending_range:
+                last_end = pending_range[1] + 1
+            pending_range = None
+    if "#EXT-X-ENDLIST" not in lines:
+        raise UnsupportedStream("live HLS playlist")
+    if not segments:
+        raise UnsupportedStream("empty HLS playlist")
+    return Track("muxed", segments, init, duration=duration or None), None
+
+
+# --- DASH ------------------------------------------------------------------
+
+def _local(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def _child(node, name):
+    for child in node:
+        if _local(child.tag) == name:
+            return child
+    return None
+
+
+def _children(node, name):
+    return [child for child in node if _local(child.tag) == name]
+
+
+def _iso_duration(value):
+    match = re.match(r"P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?", value or "")
+    if not match:
+        return 0.0
+    d, h, m, s = (float(x) if x else 0.0 for x in match.groups())
+    return d * 86400 + h * 3600 + m * 60 + s
+
+
+def _fill_template(template, rep_id, bandwidth, number=None, start_time=None):
+    def sub(match):
+        name, fmt = match.group(1), match.group(2)
+        value = {"RepresentationID": rep_id, "Bandwidth": bandwidth, "Number": number, "Time": start_time}.get(name)
+        if value is None:
+            return match.group(0)
+        return (fmt % value) if fmt else str(value)
+    return re.sub(r"\$(RepresentationID|Bandwidth|Number|Time)(%0\d+d)?\$", sub, template).replace("$$", "$")
+
+
+def _base(url, node):
+    base = _child(node, "BaseURL")
+    return urljoin(url, base.text.strip()) if base is not None and base.text else url
+
+
+def _dash_track(rep, adaptation, base_url, total_duration, kind):
+    rep_id = rep.get("id", "")
+    bandwidth = int(rep.get("bandwidth", 0))
+    base_url = _base(base_url, rep)
+    # Element truthiness reflects child count, so compare against None explicitly
+    template = _child(rep, "SegmentTemplate")
+    if template is None:
+        template = _child(adaptation, "SegmentTemplate")
+    seg_list = _child(rep, "SegmentList")
+    if seg_list is None:
+        seg_list = _child(adaptation, "SegmentList")
+    height = int(rep.get("height") or adaptation.get("height") or 0) or None
+    codecs = [c.strip() for c in (rep.get("codecs") or adaptation.get("codecs") or "").split(",") if c.strip()]
+
+    if template is not None:
+        init_t = template.get("initialization")
+        init = Segment(urljoin(base_url, _fill_template(init_t, rep_id, bandwidth))) if init_t else None
+        media = template.get("media")
+        number = int(template.get("startNumber", 1))
+        timescale = int(template.get("timescale", 1))
+        segments = []
+        timeline = _child(template, "SegmentTimeline")
+        if timeline is not None:
+            t = 0
+            for s in _children(timeline, "S"):
+                t = int(s.get("t", t))
+                d = int(s.get("d"))
+                for _ in range(int(s.get("r", 0)) + 1):
+                    segments.append(Segment(urljoin(base_url, _fill_template(media, rep_id, bandwidth, number, t))))
+                    t += d
+                    number += 1
+        else:
+            seg_duration = int(template.get("duration", 0)) / timescale
+            if not seg_duration or not total_duration:
+                raise UnsupportedStream("DASH template without a usable duration")
+            count = int(-(-total_duration // seg_duration))
+            segments = [Segment(urljoin(base_url, _fill_template(media, rep_id, bandwidth, number + i)))
+                        for i in range(count)]
+        return Track(kind, segments, init, bandwidth, height, codecs=codecs)
+
+    if seg_list is not None:
+        init_node = _child(seg_list, "Initialization")
+        init = Segment(urljoin(base_url, init_node.get("sourceURL"))) if init_node is not None else None
+        segments = [Segment(urljoin(base_url, s.get("media"))) for s in _children(seg_list, "SegmentURL")]
+        return Track(kind, segments, init, bandwidth, height, codecs=codecs)
+
+    # A single progressive file per representation
+    return Track(kind, [Segment(base_url)], None, bandwidth, height, codecs=codecs)
+
+
+def parse_dash(text, base_url, max_height=None):
+    """Return (video_track, audio_track_or_None) for a static DASH manifest."""
+    root = ET.fromstring(text)
+    if root.get("type") == "dynamic":
+        raise UnsupportedStream("live DASH manifest")
+    for node in root.iter():
+        if _local(node.tag) == "ContentProtection":
+            raise UnsupportedStream("DRM-protected DASH")
+
+    base_url = _base(base_url, root)
+    periods = _children(root, "Period")
+    if len(periods) != 1:
+        raise UnsupportedStream("multi-period DASH")
+    period = periods[0]
+    base_url = _base(base_url, period)
+    total = _iso_duration(root.get("mediaPresentationDuration") or period.get("duration"))
+
+    best = {}
+    for adaptation in _children(period, "AdaptationSet"):
+        kind = (adaptation.get("contentType") or adaptation.get("mimeType", "").split("/")[0])
+        reps = _children(adaptation, "Representation")
+        if not kind and reps:
+            kind = reps[0].get("mimeType", "").split("/")[0]
+        if kind not in ("video", "audio"):
+            continue
+        for rep in reps:
+            height = int(rep.get("height") or adaptation.get("height") or 0)
+            if kind == "video" and max_height and height > max_height:
+                continue
+            key = (int(rep.get("bandwidth", 0)), height)
+            if kind not in best or key > best[kind][0]:
+                best[kind] = (key, rep, adaptation)
+
+    if "video" not in best and "audio" not in best:
+        raise UnsupportedStream("no video or audio representation")
+    tracks = {kind: _dash_track(rep, ad, _base(base_url, ad), total, kind) for kind, (_, rep, ad) in best.items()}
+    for track in tracks.values():
+        track.duration = total or None
+    if "video" in tracks:
+        return tracks["video"], tracks.get("audio")
+    return tracks["audio"], None
+
+
+# --- Download --------------------------------------------------------------
+
+class TrackDownload:
+    """Fetch a track's segments concurrently and append them in order to a resumable .part file."""
+
+    def __init__(self, track, part_path, workers=SEGMENT_WORKERS, cancel=None, on_segment=None):
+        self.track = track
+        self.part_path = part_path
+        self.state_path = part_path + ".state"
+        self.workers = max(1, workers)
+        self.cancel = cancel
+        self.on_segment = on_segment
+
+    def _load_state(self):
+        """Index of the next segment and byte length of the verified prefix."""
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            size = os.path.getsize(self.part_path)
+            if state.get("segments") == len(self.track.segments) and size >= state["bytes"]:
+                return state["next"], state["bytes"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return 0, 0
+
+    def _save_state(self, next_index, written):
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"next": next_index, "bytes": written, "segments": len(self.track.segments)}, f)
+        os.replace(tmp, self.state_path)
+
+    def run(self):
+        segments = self.track.segments
+        start, written = self._load_state()
+        if start:
+            print(f"[SEGMENTS] Resuming {self.track.kind} at segment {start}/{len(segments)}")
+
+        mode = "r+b" if start else "wb"
+        with open(self.part_path, mode) as out:
+            out.truncate(written)
+            out.seek(written)
+            if not start and self.track.init is not None:
+                out.write(fetch(self.track.init.url, self.track.init.byterange, cancel=self.cancel))
+                written = out.tell()
+                self._save_state(0, written)
+
+            # Keep at most 2x workers segments in memory while waiting for the next one in order
+            window = self.workers * 2
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="segment") as pool:
+                futures = {}
+                next_submit = start
+                try:
+                    for index in range(start, len(segments)):
+                        if self.cancel is not None and self.cancel.is_set():
+                            raise InterruptedError("cancelled")
+                        while next_submit < len(segments) and next_submit - index < window:
+                            seg = segments[next_submit]
+                            futures[next_submit] = pool.submit(fetch, seg.url, seg.byterange, cancel=self.cancel)
+                            next_submit += 1
+                        data = futures.pop(index).result()
+                        out.write(data)
+                        out.flush()
+                        written = out.tell()
+                        self._save_state(index + 1, written)
+                        if self.on_segment:
+                            self.on_segment(self.track.kind, index + 1, len(segments), len(data))
+                finally:
+                    for future in futures.values():
+                        future.cancel()
+        return self.part_path
+
+    def cleanup(self):
+        for path in (self.part_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def load_manifest(url, max_height=None):
+    """Fetch and parse an HLS or DASH manifest into (primary_track, audio_track)."""
+    resp = http_session().get(url, timeout=SEGMENT_TIMEOUT)
+    resp.raise_for_status()
+    text = resp.text
+    content_type = resp.headers.get("Content-Type", "")
+    if "dash" in content_type or text.lstrip().startswith("<"):
+        return parse_dash(text, resp.url, max_height)
+    return parse_hls(text, resp.url, max_height)
+
+
+def mp4_compatible(codecs):
+    """Whether MP4 can carry every codec listed (an empty list, from a manifest that doesn't say, counts as yes)."""
+    return all(codec.lower().startswith(MP4_CODECS) for codec in codecs)
+
+
+def remux(inputs, output_path, cancel=None, slot=None, codecs=()):
+    """Stream-copy the downloaded track files into the container output_path's extension names.
+
+    codecs are the tracks' codecs; AAC gets the ADTS bitstream filter.
+    slot(cancel), when given, returns a context manager held while ffmpeg runs.
+    """
+    cmd = ["ffmpeg", "-y", "-loglevel", "error"]
+    for path in inputs:
+        cmd += ["-i", path]
+    for i in range(len(inputs)):
+        cmd += ["-map", str(i)]
+    cmd += ["-c", "copy", *adts_filter_args(codecs)]
+    if output_path.endswith(".mp4"):
+        cmd += ["-movflags", "+faststart"]
+    cmd.append(output_path)
+
+    with slot(cancel) if slot else nullcontext():
+        returncode, timed_out = run_process(cmd, cancel=cancel)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode if returncode is not None else -1, "ffmpeg")
+
+
+def download_segmented(url, output_path, cancel=None, on_progress=None, max_height=None, workers=SEGMENT_WORKERS,
+                       ffmpeg_slot=None):
+    """Download an HLS/DASH stream with concurrent segment fetching, then remux to output_path.
+
+    Partial data is kept next to output_path (.part + .state files) so that a
+    later call with the same output_path resumes from the last finished segment.
+    ffmpeg_slot is passed on to remux(). Codecs MP4 can't carry go into a .mkv
+    next to output_path instead; returns the path actually written.
+    """
+    primary, audio = load_manifest(url, max_height)
+    tracks = [t for t in (primary, audio) if t is not None]
+    codecs = [codec for t in tracks for codec in t.codecs]
+    totals = {t.kind: len(t.segments) for t in tracks}
+    done = {t.kind: 0 for t in tracks}
+    byte_count = [0]
+    lock = threading.Lock()
+
+    def on_segment(kind, finished, total, size):
+        with lock:
+            done[kind] = finished
+            byte_count[0] += size
+            if on_progress:
+                on_progress(sum(done.values()), sum(totals.values()), byte_count[0])
+
+    downloads = [TrackDownload(t, f"{output_path}.{t.kind}.part", workers, cancel, on_segment) for t in tracks]
+    print(f"[SEGMENTS] {', '.join(f'{t.kind}: {len(t.segments)} segments' for t in tracks)}")
+    parts = [d.run() for d in downloads]
+
+    if cancel is not None and cancel.is_set():
+        raise InterruptedError("cancelled")
+    final_path = output_path
+    if not mp4_compatible(codecs):
+        final_path = os.path.splitext(output_path)[0] + ".mkv"
+        print(f"[SEGMENTS] {', '.join(codecs)} won't fit in MP4, remuxing to Matroska")
+    remux(parts, final_path, cancel, ffmpeg_slot, codecs)
+    for d in downloads:
+        d.cleanup()
+    return final_path
@@ -0,0 +1,250 @@
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from extract_cache import normalize_url
+from governor import SPECULATIVE, anonymize
+from jobs import CANCELLED, FAILED, FINAL_STATES
+
+# Opt-in: once /get_formats has answered, start downloading the format the page preselects
+SPECULATE = os.environ.get("SPECULATE", "0") == "1"
+# Seconds a prefetch waits for its /download before it is cancelled and its files deleted
+SPECULATE_TTL = int(os.environ.get("SPECULATE_TTL", "120"))
+# Prefetches running at once, across all clients
+SPECULATE_MAX = int(os.environ.get("SPECULATE_MAX", "2"))
+# Bytes unclaimed prefetches may hold together; the newest are dropped beyond it
+SPECULATE_MAX_BYTES = int(os.environ.get("SPECULATE_MAX_BYTES", str(2 * 1024 ** 3)))
+
+POLL_INTERVAL = 1.0
+
+
+class Speculation:
+    """One client's prefetch of the download it will most likely ask for."""
+
+    def __init__(self, job, owner, url, format_id):
+        # Handed only to the page that asked for it; claiming or dropping the prefetch takes it
+        self.id = secrets.token_hex(16)
+        self.job = job
+        self.owner = owner
+        self.url = url
+        self.key = normalize_url(url)
+        self.format_id = format_id
+        self.started = time.time()
+        self.claimed = False
+        self.abandoned = False
+
+    def matches(self, url, format_id):
+        return format_id is not None and self.format_id == format_id and self.key == normalize_url(url)
+
+    def bytes(self):
+        progress = self.job.progress
+        return max(progress.get("total_bytes") or 0, progress.get("downloaded_bytes") or 0)
+
+    def store_key(self):
+        """The download store key the prefetch downloaded into; None when it found the file already there."""
+        workdir = self.job.details.get("output_dir")
+        return os.path.basename(workdir) if workdir else None
+
+    def to_dict(self):
+        # /speculation/stats is public: no URL, and the job id hashed (once claimed it is the client's download)
+        return {
+            "job": anonymize(self.job.id),
+            "format_id": self.format_id,
+            "status": self.job.status,
+            "claimed": self.claimed,
+            "bytes": self.bytes(),
+            "seconds": round(time.time() - self.started, 1),
+        }
+
+
+class Speculator:
+    """Downloads what a client will probably ask for while it is still choosing.
+
+    Each client has at most one prefetch. It is an ordinary download job
+    (registered with the job queue, so /jobs and /progress see it) run on
+    a pool of its own, so it never holds up a worker. Its transfer lives on
+    the governor's speculative bandwidth budget. A /download for the same
+    URL and format claims it: the job is promoted to an ordinary download
+    and handed to the client as its own. Prefetches for anything else, that
+    nobody claims within ttl, or that push the unclaimed total past
+    max_bytes are cancelled and what they downloaded is discarded.
+    """
+
+    def __init__(self, job_queue, governor, store, run, enabled=SPECULATE, max_running=SPECULATE_MAX,
+                 max_bytes=SPECULATE_MAX_BYTES, ttl=SPECULATE_TTL):
+        self.job_queue = job_queue
+        self.governor = governor
+        self.store = store
+        self.run = run
+        self.enabled = enabled
+        self.max_running = max(1, max_running)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._pending = {}  # owner -> unclaimed Speculation
+        self._claimed = []  # claimed and still running, re-promoted until they finish
+        self._lock = threading.Lock()
+        self._executor = None
+        self._watchdog = None
+        self.started = 0
+        self.claims = 0
+        self.abandoned = 0
+        self.skipped = 0
+
+    def _running(self):
+        running = [s for s in self._pending.values() if s.job.status not in FINAL_STATES]
+        return len(running) + len(self._claimed)
+
+    def start(self, owner, url, format_id):
+        """Prefetch format_id of url for owner, replacing owner's previous prefetch.
+
+        Returns the speculation id the page claims it with, or None.
+        """
+        if not self.enabled or not url or not format_id:
+            return None
+        with self._lock:
+            previous = self._pending.get(owner)
+        if previous is not None:
+            if previous.matches(url, format_id) and previous.job.status not in (FAILED, CANCELLED):
+                # The same page asked for its formats again
+                return previous.id
+            self._abandon(previous, "replaced by a new lookup")
+
+        with self._lock:
+            held = sum(s.bytes() for s in self._pending.values())
+            if self._running() >= self.max_running or held >= self.max_bytes:
+                self.skipped += 1
+                return None
+            # Not resumed after a restart until claimed: nobody could claim it any more
+            job = self.job_queue.register(SPECULATIVE, owner=owner, func=self.run, details={"resumable": False},
+                                          url=url, format_id=format_id)
+            speculation = self._pending[owner] = Speculation(job, owner, url, format_id)
+            self.started += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_running, thread_name_prefix="speculate")
+        self._ensure_watchdog()
+        self._executor.submit(self._run, speculation)
+        print(f"🔮 Prefetching {format_id} of {url} (job {job.id})")
+        return speculation.id
+
+    def _run(self, speculation):
+        try:
+            self.job_queue.run(speculation.job)
+        finally:
+            with self._lock:
+                if speculation in self._claimed:
+                    self._claimed.remove(speculation)
+                abandoned = speculation.abandoned
+            if abandoned:
+                self._discard(speculation)
+
+    def claim(self, owner, url, format_id, speculation_id):
+        """A /download from owner. Returns the id of the prefetch job that already does it, or None.
+
+        Only the page the prefetch was started for (the one holding
+        speculation_id) can claim it. If that page asks for any other URL
+        or format (format_id None matches nothing), the prefetch is
+        dropped, since the page has made its choice.
+        """
+        with self._lock:
+            speculation = self._pending.get(owner)
+        if speculation is None or speculation.id != speculation_id:
+            # Another client behind the same address, or a page from before this prefetch
+            return None
+        if not speculation.matches(url, format_id) or speculation.job.status in (FAILED, CANCELLED):
+            self._abandon(speculation, "a different download was asked for")
+            return None
+        with self._lock:
+            if speculation.abandoned or self._pending.get(owner) is not speculation:
+                return None
+            del self._pending[owner]
+            speculation.claimed = True
+            if speculation.job.status not in FINAL_STATES:
+                self._claimed.append(speculation)
+            self.claims += 1
+        # From here on it is an ordinary download: full bandwidth share, never discarded, resumed after a restart
+        speculation.job.kind = "video"
+        speculation.job.record(resumable=True)
+        self.governor.promote(speculation.job.id)
+        print(f"🔮 Prefetch {speculation.job.id} claimed after {round(time.time() - speculation.started, 1)}s")
+        return speculation.job.id
+
+    def drop(self, owner, speculation_id, reason="dropped by the client"):
+        """Abandon owner's unclaimed prefetch, if it has one and speculation_id is its id."""
+        with self._lock:
+            speculation = self._pending.get(owner)
+        if speculation is None or speculation.id != speculation_id:
+            return False
+        self._abandon(speculation, reason)
+        return True
+
+    def _abandon(self, speculation, reason):
+        with self._lock:
+            if speculation.abandoned or speculation.claimed:
+                return
+            speculation.abandoned = True
+            if self._pending.get(speculation.owner) is speculation:
+                del self._pending[speculation.owner]
+            self.abandoned += 1
+        print(f"🔮 Dropping prefetch {speculation.job.id}: {reason}")
+        self.job_queue.cancel(speculation.job.id)
+        if speculation.job.status in FINAL_STATES:
+            self._discard(speculation)
+        # Otherwise _run() discards it once the cancelled download has stopped
+
+    def _discard(self, speculation):
+        key = speculation.store_key()
+        if key and self.store.discard(key):
+            print(f"🗑️ Discarded prefetched download {key[:12]}")
+
+    # Budget and expiry
+
+    def _ensure_watchdog(self):
+        with self._lock:
+            if self._watchdog is None:
+                self._watchdog = threading.Thread(target=self._watch, name="speculation-watchdog", daemon=True)
+                self._watchdog.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(POLL_INTERVAL)
+            try:
+                self._check()
+            except Exception as e:
+                print(f"⚠️ Speculation check failed: {e}")
+
+    def _check(self):
+        now = time.time()
+        with self._lock:
+            pending = sorted(self._pending.values(), key=lambda s: s.started)
+            claimed = list(self._claimed)
+        held = 0
+        for speculation in pending:
+            if now - speculation.started > self.ttl:
+                self._abandon(speculation, f"not claimed within {self.ttl}s")
+                continue
+            held += speculation.bytes()
+            if held > self.max_bytes:
+                # The oldest prefetches are the likeliest to be claimed soon; the newest make room
+                self._abandon(speculation, "over the speculative disk budget")
+                held -= speculation.bytes()
+        for speculation in claimed:
+            # Claimed between the job's check of its kind and the start of its transfer
+            self.governor.promote(speculation.job.id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "running": self._running(),
+                "max_running": self.max_running,
+                "bytes": sum(s.bytes() for s in self._pending.values()),
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "started": self.started,
+                "claimed": self.claims,
+                "abandoned": self.abandoned,
+                "skipped": self.skipped,
+                "pending": [s.to_dict() for s in self._pending.values()],
+            }
@@ -0,0 +1,141 @@
+import json
+import os
+import time
+from urllib.parse import urlsplit
+
+STREAM_DISCOVERY_TIMEOUT = float(os.environ.get("STREAM_DISCOVERY_TIMEOUT", "10"))
+# Give up early once the page has loaded and the network has been quiet this long
+STREAM_DISCOVERY_SETTLE = float(os.environ.get("STREAM_DISCOVERY_SETTLE", "2"))
+# Keep listening this long after the first likely stream, so the main feature can be
+# ranked against the trailers and ads requested around it
+STREAM_DISCOVERY_GRACE = float(os.environ.get("STREAM_DISCOVERY_GRACE", "1.5"))
+POLL_INTERVAL = 0.1
+
+TRAILER_MARKERS = ('trailer', 'preview', 'teaser', 'promo')
+
+MANIFEST_EXTENSIONS = ('.m3u8', '.mpd')
+MEDIA_EXTENSIONS = ('.mp4', '.m4v', '.webm', '.mov')
+STREAM_CONTENT_TYPES = (
+    'application/vnd.apple.mpegurl',
+    'application/x-mpegurl',
+    'audio/mpegurl',
+    'application/dash+xml',
+    'video/mp4',
+    'video/webm',
+    'video/quicktime',
+)
+
+
+def is_trailer(url):
+    return any(x in url.lower() for x in TRAILER_MARKERS)
+
+
+def classify_stream(url, content_type=None):
+    """Return 'manifest', 'media' or None for a URL seen on the network."""
+    if not url or not url.startswith(('http://', 'https://')):
+        return None
+    path = urlsplit(url).path.lower()
+    if path.endswith(MANIFEST_EXTENSIONS):
+        return 'manifest'
+    if path.endswith(MEDIA_EXTENSIONS):
+        return 'media'
+    if content_type:
+        content_type = content_type.split(';')[0].strip().lower()
+        if content_type in STREAM_CONTENT_TYPES:
+            return 'manifest' if 'mpegurl' in content_type or 'dash' in content_type else 'media'
+    return None
+
+
+class StreamCollector:
+    """Collects manifest/media URLs in the order the page requested them."""
+
+    def __init__(self):
+        self.candidates = []
+        self._seen = set()
+        self.last_activity = time.time()
+        self.first_found = None
+
+    def feed(self, url, content_type=None):
+        self.last_activity = time.time()
+        kind = classify_stream(url, content_type)
+        if kind is None or url in self._seen:
+            return
+        self._seen.add(url)
+        self.candidates.append((url, kind))
+        if self.first_found is None and not is_trailer(url):
+            self.first_found = time.time()
+
+    def urls(self):
+        """Every candidate, the ones that don't look like trailers first."""
+        return [url for url, _ in sorted(self.candidates, key=lambda c: is_trailer(c[0]))]
+
+    def done(self):
+        """A likely stream was seen and the grace period after it has passed."""
+        return self.first_found is not None and time.time() - self.first_found >= STREAM_DISCOVERY_GRACE
+
+    def settled(self, page_loaded):
+        return page_loaded and time.time() - self.last_activity >= STREAM_DISCOVERY_SETTLE
+
+
+def discover_with_playwright(page, url, timeout=STREAM_DISCOVERY_TIMEOUT, cancel=None):
+    """Navigate a Playwright page and return the stream URLs it requests (see StreamCollector.urls)."""
+    collector = StreamCollector()
+    loaded = []
+
+    page.on("request", lambda req: collector.feed(req.url))
+    page.on("response", lambda resp: collector.feed(resp.url, resp.headers.get("content-type")))
+    page.on("load", lambda _: loaded.append(True))
+
+    page.goto(url, wait_until="commit")
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if cancel is not None and cancel.is_set():
+            return []
+        if collector.done() or collector.settled(bool(loaded)):
+            break
+        # Lets Playwright dispatch the queued request/response events
+        page.wait_for_timeout(POLL_INTERVAL * 1000)
+
+    return collector.urls()
+
+
+def _feed_chrome_log(collector, entries):
+    for entry in entries:
+        try:
+            message = json.loads(entry["message"])["message"]
+        except (KeyError, ValueError):
+            continue
+        method = message.get("method")
+        params = message.get("params", {})
+        if method == "Network.requestWillBeSent":
+            collector.feed(params.get("request", {}).get("url"))
+        elif method == "Network.responseReceived":
+            response = params.get("response", {})
+            collector.feed(response.get("url"), response.get("mimeType"))
+
+
+def discover_with_chrome(driver, url, timeout=STREAM_DISCOVERY_TIMEOUT, cancel=None):
+    """Navigate a Selenium Chrome and return the stream URLs its DevTools network events show.
+
+    Needs a driver started with the "performance" log enabled.
+    """
+    collector = StreamCollector()
+
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.get_log("performance")  # drop events left over from a previous lease
+    # Page.navigate returns once navigation starts, not when the page has loaded
+    driver.execute_cdp_cmd("Page.navigate", {"url": url})
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if cancel is not None and cancel.is_set():
+            return []
+        _feed_chrome_log(collector, driver.get_log("performance"))
+        if collector.done():
+            break
+        loaded = driver.execute_script("return document.readyState") == "complete"
+        if collector.settled(loaded):
+            break
+        time.sleep(POLL_INTERVAL)
+
+    return collector.urls()
@@ -0,0 +1,301 @@
+import os
+import re
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from extract_cache import ExtractionCache, normalize_url
+from fallbacks import probe_url
+from lazy import lazy_import
+from segmented import UnsupportedStream, http_session, load_manifest
+from stream_discovery import TRAILER_MARKERS, classify_stream, is_trailer
+
+requests = lazy_import("requests")
+
+RANKING_PROBE_TIMEOUT = float(os.environ.get("RANKING_PROBE_TIMEOUT", "5"))
+# Candidates probed at once for one page
+RANKING_WORKERS = int(os.environ.get("RANKING_WORKERS", "8"))
+RANKING_CACHE_TTL = int(os.environ.get("RANKING_CACHE_TTL", "600"))
+RANKING_CACHE_SIZE = int(os.environ.get("RANKING_CACHE_SIZE", "512"))
+# Streams at least this share of the longest candidate's duration count as the main feature
+RANKING_FEATURE_SHARE = float(os.environ.get("RANKING_FEATURE_SHARE", "0.95"))
+# A trailer-looking title only disqualifies a video shorter than this (or of unknown length)
+TRAILER_MAX_SECONDS = int(os.environ.get("TRAILER_MAX_SECONDS", "300"))
+
+# Bytes read from the start of an MP4 (and from its end when moov isn't up front)
+MP4_HEAD_BYTES = 64 * 1024
+MP4_TAIL_BYTES = 512 * 1024
+MP4_CONTAINERS = (b"moov", b"trak", b"mdia")
+
+
+def looks_like_trailer(title, duration=None):
+    """A trailer/teaser/promo title, unless the video is long enough to be the real thing."""
+    title = (title or "").lower()
+    if not any(marker in title for marker in TRAILER_MARKERS):
+        return False
+    return not duration or duration < TRAILER_MAX_SECONDS
+
+
+def _boxes(data, start, end):
+    """(type, payload_start, payload_end) for the ISO-BMFF boxes in data[start:end], clipped to data."""
+    end = min(end, len(data))
+    while start + 8 <= end:
+        size, kind = struct.unpack(">I4s", data[start:start + 8])
+        header = 8
+        if size == 1 and start + 16 <= end:
+            size = struct.unpack(">Q", data[start + 8:start + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - start
+        if size < header:
+            return
+        yield kind, start + header, min(start + size, end)
+        start += size
+
+
+def parse_mp4_header(data, start=0):
+    """(duration_seconds, width, height) from the moov box in data; unknowns are None.
+
+    Tolerates a truncated moov, since mvhd and the track headers come before
+    the (large) sample tables.
+    """
+    duration = width = height = None
+    stack = [(start, len(data))]
+    while stack:
+        for kind, begin, end in _boxes(data, *stack.pop()):
+            if kind in MP4_CONTAINERS:
+                stack.append((begin, end))
+            elif kind == b"mvhd" and end - begin >= 32:
+                if data[begin] == 1:
+                    timescale, length = struct.unpack(">IQ", data[begin + 20:begin + 32])
+                else:
+                    timescale, length = struct.unpack(">II", data[begin + 12:begin + 20])
+                if timescale and length not in (0, 0xFFFFFFFF, 0xFFFFFFFFFFFFFFFF):
+                    duration = length / timescale
+            elif kind == b"tkhd":
+                offset = begin + (36 if data[begin] == 1 else 24) + 52
+                if offset + 8 <= end:
+                    w, h = struct.unpack(">II", data[offset:offset + 8])
+                    # Audio tracks have 0x0; keep the largest picture
+                    if (h >> 16) > (height or 0):
+                        width, height = w >> 16, h >> 16
+    return duration, width, height
+
+
+class StreamProbe:
+    """What a few cheap requests told us about one candidate stream."""
+
+    def __init__(self, url, kind=None):
+        self.url = url
+        self.kind = kind  # 'manifest', 'media' or None
+        self.ok = False
+        self.size = None
+        self.duration = None
+        self.bitrate = None  # bits/second
+        self.width = None
+        self.height = None
+        self.note = None  # why some fields are unknown (encrypted, live, no moov...)
+        self.error = None
+        self.seconds = None
+        self.cached = False
+
+    def effective_duration(self):
+        if self.duration:
+            return self.duration
+        if self.size and self.bitrate:
+            return self.size * 8 / self.bitrate
+        return None
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_dict(cls, data):
+        probe = cls(data["url"])
+        probe.__dict__.update(data)
+        return probe
+
+
+def _read_range(url, first, last, timeout):
+    """(bytes, total size or None) for a byte range, reading no more than asked even if Range is ignored."""
+    resp = http_session().get(url, headers={"Range": f"bytes={first}-{last}"}, timeout=timeout, stream=True)
+    try:
+        resp.raise_for_status()
+        total = None
+        match = re.search(r"/(\d+)$", resp.headers.get("Content-Range", ""))
+        if match:
+            total = int(match.group(1))
+        elif resp.status_code == 200 and (resp.headers.get("Content-Length") or "").isdigit():
+            total = int(resp.headers["Content-Length"])
+            if first:
+                # Range ignored: the tail isn't reachable without reading the whole file
+                return b"", total
+        data = b""
+        for chunk in resp.iter_content(64 * 1024):
+            data += chunk
+            if len(data) > last - first:
+                break
+        return data[:last - first + 1], total
+    finally:
+        resp.close()
+
+
+def _probe_media(probe, timeout):
+    head, probe.size = _read_range(probe.url, 0, MP4_HEAD_BYTES - 1, timeout)
+    duration, width, height = parse_mp4_header(head)
+    if duration is None and probe.size and probe.size > len(head):
+        # moov after mdat (no faststart): look for it near the end
+        first = max(len(head), probe.size - MP4_TAIL_BYTES)
+        tail, _ = _read_range(probe.url, first, probe.size - 1, timeout)
+        at = tail.rfind(b"moov")
+        if at >= 4:
+            duration, width, height = parse_mp4_header(tail, at - 4)
+    if duration is None:
+        probe.note = "no MP4 header found"
+    probe.duration, probe.width, probe.height = duration, width, height
+    if probe.size and duration:
+        probe.bitrate = int(probe.size * 8 / duration)
+    probe.ok = True
+
+
+def _probe_manifest(probe):
+    try:
+        primary, audio = load_manifest(probe.url)
+    except UnsupportedStream as e:
+        # Reachable, and yt-dlp/ffmpeg may still manage it (AES-128, live); just nothing to score
+        probe.ok = True
+        probe.note = str(e)
+        return
+    probe.ok = True
+    probe.duration = primary.duration
+    probe.height = primary.height
+    probe.bitrate = (primary.bandwidth + (audio.bandwidth if audio else 0)) or None
+    if probe.duration and probe.bitrate:
+        probe.size = int(probe.duration * probe.bitrate / 8)
+
+
+def probe_stream(url, timeout=RANKING_PROBE_TIMEOUT):
+    """Probe one candidate: manifests are parsed, MP4s have their header read, anything else is HEADed."""
+    probe = StreamProbe(url, classify_stream(url))
+    started = time.perf_counter()
+    try:
+        if probe.kind is None:
+            head = probe_url(url, timeout=timeout)
+            probe.kind = head.kind
+            probe.size = head.length
+            probe.ok = head.reachable
+            probe.error = head.error
+        if probe.kind == "manifest":
+            _probe_manifest(probe)
+        elif probe.kind == "media":
+            _probe_media(probe, timeout)
+    except (requests.RequestException, OSError, ValueError, struct.error) as e:
+        probe.ok = False
+        probe.error = str(e)
+    probe.seconds = round(time.perf_counter() - started, 3)
+    return probe
+
+
+class Ranking:
+    """Probed candidates, best first."""
+
+    def __init__(self, probes):
+        longest = max((p.effective_duration() or 0 for p in probes if p.ok), default=0)
+
+        def key(probe):
+            duration = probe.effective_duration() or 0
+            feature = bool(longest) and duration >= longest * RANKING_FEATURE_SHARE
+            if feature:
+                # Among full-length streams, the best picture wins
+                quality = (probe.height or 0, probe.bitrate or 0, probe.size or 0)
+            else:
+                # Otherwise the longest (or, with no duration at all, the biggest)
+                quality = (duration, probe.size or 0, probe.height or 0)
+            # A trailer-looking URL drops below the others in its group; a full-length one still beats short ones
+            return probe.ok, feature, not is_trailer(probe.url), quality
+
+        self.probes = sorted(probes, key=key, reverse=True)
+
+    @property
+    def best(self):
+        return self.probes[0].url if self.probes else None
+
+    def urls(self):
+        return [p.url for p in self.probes]
+
+    def to_dict(self):
+        return {"best": self.best, "candidates": [p.to_dict() for p in self.probes]}
+
+
+class StreamRanker:
+    """Probes candidate stream URLs in parallel and ranks them; probe results are cached per URL."""
+
+    def __init__(self, workers=RANKING_WORKERS, timeout=RANKING_PROBE_TIMEOUT,
+                 cache_size=RANKING_CACHE_SIZE, cache_ttl=RANKING_CACHE_TTL):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.cache = ExtractionCache(cache_size, cache_ttl, db_path="")
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def probe(self, url):
+        key = normalize_url(url)
+        cached = self.cache.get(key)
+        if cached is not None:
+            probe = StreamProbe.from_dict(cached)
+            probe.url, probe.cached = url, True
+            return probe
+        probe = probe_stream(url, self.timeout)
+        # Failures may be transient, so only successful probes are kept
+        if probe.ok:
+            self.cache.set(key, probe.to_dict())
+        return probe
+
+    def rank(self, urls, cancel=None):
+        """Ranking of urls. A single candidate is returned unprobed, there being nothing to choose."""
+        urls = list(dict.fromkeys(u for u in urls if u))
+        if len(urls) < 2:
+            return Ranking([StreamProbe(u) for u in urls])
+
+        pool = ThreadPoolExecutor(max_workers=min(self.workers, len(urls)), thread_name_prefix="probe")
+        futures = {pool.submit(self.probe, u): u for u in urls}
+        # Manifest probes make two or three requests, each bounded by timeout
+        deadline = time.monotonic() + self.timeout * 3
+        pending = set(futures)
+        while pending and time.monotonic() < deadline:
+            if cancel is not None and cancel.is_set():
+                break
+            _, pending = wait(pending, timeout=min(0.2, max(0, deadline - time.monotonic())))
+        # Stragglers finish in the background and still fill the cache
+        pool.shutdown(wait=False, cancel_futures=True)
+
+        probes = []
+        for future, url in futures.items():
+            if future in pending:
+                probe = StreamProbe(url, classify_stream(url))
+                probe.error = "probe timed out"
+                with self._lock:
+                    self.timeouts += 1
+            elif future.exception() is not None:
+                probe = StreamProbe(url, classify_stream(url))
+                probe.error = str(future.exception())
+            else:
+                probe = future.result()
+            probes.append(probe)
+        ranking = Ranking(probes)
+        print(f"[RANKING] {len(probes)} candidates, best {ranking.best} "
+              f"({', '.join(_summary(p) for p in ranking.probes[:3])})")
+        return ranking
+
+    def stats(self):
+        with self._lock:
+            timeouts = self.timeouts
+        return {"cache": self.cache.stats(), "timeouts": timeouts}
+
+
+def _summary(probe):
+    if not probe.ok:
+        return f"failed: {probe.error}"
+    duration = probe.effective_duration()
+    return f"{probe.kind or '?'} {round(duration) if duration else '?'}s {probe.height or '?'}p"
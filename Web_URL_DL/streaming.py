@@ -0,0 +1,138 @@
+import os
+import signal
+import subprocess
+
+from fallbacks import track_process, untrack_process
+
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", str(64 * 1024)))
+
+# Protocols ffmpeg can read directly from a format's URL ("file" is a locally staged input)
+PIPEABLE_PROTOCOLS = ("http", "https", "m3u8", "m3u8_native", "file")
+
+
+# target -> (encoder, ffmpeg muxer, extension, mimetype, source codecs that need no re-encode)
+AUDIO_FORMATS = {
+    "mp3": ("libmp3lame", "mp3", "mp3", "audio/mpeg", ("mp3",)),
+    "m4a": ("aac", "ipod", "m4a", "audio/mp4", ("mp4a", "aac")),
+    "opus": ("libopus", "opus", "opus", "audio/ogg", ("opus",)),
+}
+# Extra output arguments when the target is a pipe: the ipod (MP4) muxer needs a seekable file unless it
+# writes fragments. Every audio packet is a keyframe, so fragments are cut by duration, not frag_keyframe.
+PIPE_AUDIO_ARGS = {
+    "m4a": ["-movflags", "empty_moov+default_base_moof", "-frag_duration", "1000000"],
+}
+DEFAULT_AUDIO_BITRATE = "192k"
+# Audio codec ids (yt-dlp acodec, manifest CODECS) of AAC, whose ADTS framing needs aac_adtstoasc in MP4
+AAC_CODECS = ("mp4a", "aac")
+AUDIO_BITRATES = ("64k", "96k", "128k", "160k", "192k", "256k", "320k")
+
+
+class StreamNotSupported(Exception):
+    """The selected formats cannot be piped straight to the client."""
+
+
+def _header_args(fmt):
+    headers = fmt.get("http_headers") or {}
+    if not headers:
+        return []
+    return ["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())]
+
+
+def adts_filter_args(acodecs):
+    """-bsf:a aac_adtstoasc when one of the audio codecs is AAC; ffmpeg refuses it for Opus, Vorbis..."""
+    if any((codec or "").lower().startswith(AAC_CODECS) for codec in acodecs):
+        return ["-bsf:a", "aac_adtstoasc"]
+    return []
+
+
+def _check_pipeable(formats):
+    for fmt in formats:
+        if fmt.get("protocol", "https") not in PIPEABLE_PROTOCOLS:
+            raise StreamNotSupported(f"{fmt.get('protocol')} formats cannot be streamed")
+
+
+def audio_codec_args(fmt, audio_format="mp3", bitrate=None):
+    """Output arguments for turning fmt's audio into audio_format.
+
+    The audio is stream-copied when the source already uses the target codec
+    and no explicit bitrate was asked for. Returns (args, extension, mimetype, copied).
+    """
+    encoder, muxer, ext, mimetype, native = AUDIO_FORMATS[audio_format]
+    acodec = (fmt.get("acodec") or "").lower()
+    if not bitrate and acodec.startswith(native):
+        return ["-vn", "-c:a", "copy", "-f", muxer], ext, mimetype, True
+    return ["-vn", "-c:a", encoder, "-b:a", bitrate or DEFAULT_AUDIO_BITRATE, "-f", muxer], ext, mimetype, False
+
+
+def audio_file_command(fmt, output_path, audio_format="mp3", bitrate=None):
+    """Single ffmpeg pass from the source URL to an audio file, reporting progress on stdout.
+
+    Returns (cmd, copied).
+    """
+    _check_pipeable([fmt])
+    args, _, _, copied = audio_codec_args(fmt, audio_format, bitrate)
+    cmd = ["ffmpeg", "-y", "-loglevel", "error", "-nostdin", "-nostats", "-progress", "pipe:1"]
+    cmd += _header_args(fmt) + ["-i", fmt["url"]] + args + [output_path]
+    return cmd, copied
+
+
+def stream_command(formats, kind="video", audio_format="mp3", bitrate=None):
+    """ffmpeg command that writes the selected formats to stdout as a streamable container.
+
+    Video becomes fragmented MP4 (playable while it is still arriving); audio
+    becomes a progressive audio stream. Returns (cmd, mimetype, extension).
+    """
+    _check_pipeable(formats)
+
+    cmd = ["ffmpeg", "-loglevel", "error", "-nostdin"]
+    for fmt in formats:
+        cmd += _header_args(fmt) + ["-i", fmt["url"]]
+
+    if kind == "audio":
+        args, ext, mimetype, _ = audio_codec_args(formats[0], audio_format, bitrate)
+        return cmd + args + PIPE_AUDIO_ARGS.get(audio_format, []) + ["pipe:1"], mimetype, ext
+
+    for i in range(len(formats)):
+        cmd += ["-map", str(i)]
+    cmd += ["-c", "copy", *adts_filter_args(fmt.get("acodec") for fmt in formats),
+            "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+            "-f", "mp4", "pipe:1"]
+    return cmd, "video/mp4", "mp4"
+
+
+def pipe_process(cmd, cancel=None, on_chunk=None, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield a subprocess's stdout in chunks.
+
+    Reading only as fast as the client consumes gives natural backpressure:
+    once the pipe buffer is full the encoder blocks instead of buffering
+    the file in memory or on disk. The process group is killed when the
+    generator is closed early (client disconnect) or cancelled.
+    """
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, start_new_session=True)
+    track_process(proc)
+
+    def kill():
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    unregister = cancel.on_cancel(kill) if cancel is not None else (lambda: None)
+    try:
+        while True:
+            # read1 hands over whatever is available instead of waiting for a full chunk
+            chunk = proc.stdout.read1(chunk_size)
+            if not chunk:
+                break
+            if on_chunk:
+                on_chunk(len(chunk))
+            yield chunk
+        if proc.wait() != 0 and not (cancel is not None and cancel.is_set()):
+            raise subprocess.CalledProcessError(proc.returncode, cmd[0])
+    finally:
+        unregister()
+        if proc.poll() is None:
+            kill()
+            proc.wait()
+        proc.stdout.close()
+        untrack_process(proc)
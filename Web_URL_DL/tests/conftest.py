@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "bench"))
+
+from fixtures import FixtureServer, MediaSet  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def media():
+    media = MediaSet(seconds=12, size_mb=1)
+    yield media
+    media.cleanup()
+
+
+@pytest.fixture(scope="session")
+def server(media):
+    server = FixtureServer(media=media).start()
+    yield server
+    server.stop()
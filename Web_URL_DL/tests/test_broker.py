@@ -0,0 +1,138 @@
+"""The in-process and Redis brokers, and job dispatch through them."""
+import threading
+import time
+
+import fakeredis
+import pytest
+
+from broker import LocalBroker, RedisBroker
+from jobs import CANCELLED, FINISHED, RUNNING, JobQueue
+
+
+@pytest.fixture(params=["local", "redis"])
+def broker(request):
+    if request.param == "local":
+        return LocalBroker()
+    return RedisBroker(prefix="test:", client=fakeredis.FakeRedis())
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def test_publish_reaches_every_subscriber(broker):
+    first, second = broker.subscribe("news"), broker.subscribe("news")
+    other = broker.subscribe("other")
+    broker.publish("news", {"n": 1})
+    assert first.get(timeout=2) == {"n": 1}
+    assert second.get(timeout=2) == {"n": 1}
+    assert other.get(timeout=0.2) is None
+
+    second.close()
+    broker.publish("news", {"n": 2})
+    assert first.get(timeout=2) == {"n": 2}
+    first.close()
+    other.close()
+
+
+def test_subscription_times_out(broker):
+    subscription = broker.subscribe("quiet")
+    started = time.monotonic()
+    assert subscription.get(timeout=0.3) is None
+    assert time.monotonic() - started >= 0.25
+    subscription.close()
+
+
+def test_queue_is_first_in_first_out(broker):
+    for n in range(3):
+        broker.push("work", {"n": n})
+    assert broker.length("work") == 3
+    assert [broker.pop("work", timeout=1)["n"] for _ in range(3)] == [0, 1, 2]
+    assert broker.pop("work", timeout=0.2) is None
+
+
+def test_values_expire_and_clear(broker):
+    broker.put("job:a", {"status": "queued"})
+    broker.put("job:b", [1, 2], ttl=0.2)
+    broker.put("other", "kept")
+    assert broker.fetch("job:a") == {"status": "queued"}
+    assert broker.fetch("job:b") == [1, 2]
+    time.sleep(0.3)
+    assert broker.fetch("job:b") is None
+    broker.clear("job:")
+    assert broker.fetch("job:a") is None
+    assert broker.fetch("other") == "kept"
+    broker.remove("other")
+    assert broker.fetch("other") is None
+
+
+def busy(queue):
+    """Occupy queue's only worker with a local job; returns the event that frees it."""
+    running, release = threading.Event(), threading.Event()
+
+    def hold(job):
+        running.set()
+        release.wait(10)
+
+    queue.submit("hold", hold)
+    assert running.wait(5)
+    return release
+
+
+def test_dispatched_job_runs_on_another_node(broker):
+    ran = []
+
+    def fetch_video(job, url):
+        ran.append(url)
+        job.update_progress(percent=50.0)
+        return {"status": "success", "message": "Done", "url": url}
+
+    submitter, worker = JobQueue(workers=1, broker=broker), JobQueue(workers=1, broker=broker)
+    for queue in (submitter, worker):
+        queue.resumable(fetch_video)
+    release = busy(submitter)
+    worker.start()
+    try:
+        stand_in = submitter.submit("video", fetch_video, "https://example.com/v")
+        assert submitter.get(stand_in.id) is None  # Not running here: it went to the broker
+        wait_for(lambda: stand_in.status == FINISHED)
+        assert stand_in.result["url"] == "https://example.com/v"
+        assert ran == ["https://example.com/v"]
+        assert worker.get(stand_in.id).status == FINISHED
+        assert submitter.lookup(stand_in.id)["status"] == FINISHED
+    finally:
+        release.set()
+
+
+def test_cancel_reaches_the_node_running_the_job(broker):
+    started = threading.Event()
+
+    def slow_video(job):
+        started.set()
+        while not job.cancelled:
+            time.sleep(0.05)
+        job.check_cancelled()
+
+    submitter, worker = JobQueue(workers=1, broker=broker), JobQueue(workers=1, broker=broker)
+    for queue in (submitter, worker):
+        queue.resumable(slow_video)
+    release = busy(submitter)
+    worker.start()
+    try:
+        stand_in = submitter.submit("video", slow_video)
+        assert started.wait(5)
+        wait_for(lambda: stand_in.status == RUNNING)
+        submitter.cancel(stand_in.id)
+        wait_for(lambda: stand_in.status == CANCELLED)
+    finally:
+        release.set()
+
+
+def test_jobs_stay_local_without_a_broker():
+    queue = JobQueue(workers=1)
+    job = queue.submit("video", lambda job: {"message": "ok"})
+    wait_for(lambda: job.status == FINISHED)
+    assert queue.get(job.id) is job
@@ -0,0 +1,136 @@
+"""Download store entries shared between the processes (gunicorn workers) of one node."""
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+import download_store
+from download_store import LOCK_DIR, DownloadStore
+
+pytestmark = pytest.mark.skipif(download_store.fcntl is None, reason="needs flock")
+
+fork = multiprocessing.get_context("fork")
+
+
+def producer(root, produced, delay=0.0):
+    def produce(workdir):
+        time.sleep(delay)
+        with open(produced, "a") as f:
+            f.write(f"{os.getpid()}\n")
+        path = os.path.join(workdir, "video.mp4")
+        with open(path, "wb") as f:
+            f.write(b"x" * 1000)
+        return path
+    return produce
+
+
+def fetch_in_child(root, key, produced, results):
+    store = DownloadStore(root)
+    entry, how = store.fetch(key, producer(root, produced, delay=0.5))
+    results.put(how)
+    store.release(entry)
+
+
+def test_processes_produce_a_key_once(tmp_path):
+    root, produced = str(tmp_path / "store"), str(tmp_path / "produced")
+    results = fork.Queue()
+    children = [fork.Process(target=fetch_in_child, args=(root, "k", produced, results)) for _ in range(2)]
+    for child in children:
+        child.start()
+    for child in children:
+        child.join(10)
+    assert sorted(results.get(timeout=1) for _ in children) == ["downloaded", "hit"]
+    with open(produced) as f:
+        assert len(f.read().split()) == 1
+
+
+def hold_exclusive(root, key, held, release):
+    import fcntl
+    with open(os.path.join(root, LOCK_DIR, key), "a+") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        held.set()
+        release.wait(10)
+
+
+def test_a_key_locked_elsewhere_does_not_stall_the_store(tmp_path):
+    root, produced = str(tmp_path / "store"), str(tmp_path / "produced")
+    store = DownloadStore(root)
+    entry, _ = store.fetch("k", producer(root, produced))
+    store.release(entry)
+
+    held, release = fork.Event(), fork.Event()
+    child = fork.Process(target=hold_exclusive, args=(root, "k", held, release))
+    child.start()
+    assert held.wait(5)
+    fetched = []
+    waiter = threading.Thread(target=lambda: fetched.append(store.fetch("k", producer(root, produced))))
+    waiter.start()
+    time.sleep(0.3)
+    # The waiting fetch holds no store-wide lock: everything else carries on
+    started = time.monotonic()
+    assert store.has("k")
+    store.stats()
+    assert time.monotonic() - started < 0.2
+    assert waiter.is_alive()
+
+    release.set()
+    child.join(5)
+    waiter.join(5)
+    (entry, how), = fetched
+    assert how == "hit"  # Picked up from the marker, not downloaded again
+    with open(produced) as f:
+        assert len(f.read().split()) == 1
+    store.release(entry)
+
+
+def pin_in_child(root, path, pinned, release):
+    store = DownloadStore(root)
+    entry = store.acquire(path)
+    assert entry is not None
+    pinned.set()
+    release.wait(10)
+    store.release(entry)
+
+
+def test_eviction_waits_for_other_processes_and_removes_the_lock_file(tmp_path):
+    root, produced = str(tmp_path / "store"), str(tmp_path / "produced")
+    store = DownloadStore(root, max_bytes=1500)
+    first, _ = store.fetch("first", producer(root, produced))
+    store.release(first)
+
+    pinned, release = fork.Event(), fork.Event()
+    child = fork.Process(target=pin_in_child, args=(root, first.path, pinned, release))
+    child.start()
+    assert pinned.wait(5)
+    second, _ = store.fetch("second", producer(root, produced))
+    store.release(second)
+    assert os.path.exists(first.path)  # In use by the other process
+
+    release.set()
+    child.join(5)
+    third, _ = store.fetch("third", producer(root, produced))
+    store.release(third)
+    assert not os.path.exists(store.workdir("first"))
+    assert not os.path.exists(os.path.join(root, LOCK_DIR, "first"))
+    assert store.stats()["evictions"] >= 1
+
+
+def test_stale_partials_are_pruned_while_running(tmp_path):
+    root, produced = str(tmp_path / "store"), str(tmp_path / "produced")
+    store = DownloadStore(root, partial_ttl=60, prune_interval=0)
+    store.stats()  # Opens the store; the startup sweep finds nothing yet
+
+    stale, fresh = store.workdir("stale"), store.workdir("fresh")
+    for workdir in (stale, fresh):
+        os.makedirs(workdir)
+        open(os.path.join(workdir, "video.mp4.part"), "wb").close()
+    os.utime(stale, (time.time() - 120, time.time() - 120))
+    open(os.path.join(root, LOCK_DIR, "gone"), "w").close()
+
+    entry, _ = store.fetch("k", producer(root, produced))
+    store.release(entry)
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh)
+    assert os.listdir(os.path.join(root, LOCK_DIR)) == ["k"]  # The orphaned lock file is gone
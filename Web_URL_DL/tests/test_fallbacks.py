@@ -0,0 +1,47 @@
+"""Racing fallback downloaders and cleaning up after the ones that lose."""
+import os
+import threading
+import time
+
+from fallbacks import Backend, run_fallbacks
+from racing import race
+
+
+def test_race_reaps_cancelled_losers():
+    finished = threading.Event()
+
+    def winner(token):
+        return "done"
+
+    def slow_loser(token):
+        token.wait(5)
+        time.sleep(0.3)  # Still cleaning up after it was cancelled
+        finished.set()
+
+    result = race([("winner", winner), ("loser", slow_loser)], reap=5)
+    assert result.winner == "winner"
+    assert finished.is_set()
+    assert result.stragglers == []
+
+    stuck = threading.Event()
+    result = race([("winner", winner), ("stuck", lambda token: stuck.wait(5))], reap=0.1)
+    assert result.stragglers == ["stuck"]
+    stuck.set()
+
+
+def shell_backend(name, script, priority):
+    return Backend(name, "sh", lambda url, output: ["sh", "-c", script, "sh", output],
+                   accepts=lambda probe: True, timeout=10, priority=priority)
+
+
+def test_losers_files_are_removed_after_their_process_exits(server, tmp_path):
+    backends = [
+        # Keeps writing until it is killed
+        shell_backend("writer", 'while :; do echo x >> "$1"; sleep 0.01; done', priority=0),
+        shell_backend("quick", 'sleep 0.3; echo ok > "$1"', priority=1),
+    ]
+    result = run_fallbacks(f"{server.base_url}/media/1.mp4", backends,
+                           output_for=lambda backend: str(tmp_path / f"{backend.name}.out"))
+    assert result["backend"] == "quick"
+    time.sleep(0.2)
+    assert sorted(os.listdir(tmp_path)) == ["quick.out"]
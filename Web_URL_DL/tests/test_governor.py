@@ -0,0 +1,10 @@
+"""What the public /governor endpoint reveals about other clients' transfers."""
+from governor import Governor
+
+
+def test_stats_never_show_owners_or_job_ids():
+    governor = Governor()
+    with governor.transfer("10.0.0.1", "download", "3f2a9c0d4b5e4f60a1b2c3d4e5f60718"):
+        stats = str(governor.stats())
+    assert "10.0.0.1" not in stats
+    assert "3f2a9c0d4b5e4f60a1b2c3d4e5f60718" not in stats
@@ -0,0 +1,248 @@
+"""HLS/DASH parsing and the segmented download engine."""
+import shutil
+import threading
+
+import pytest
+
+import segmented
+from governor import Governor
+from segmented import TrackDownload, UnsupportedStream, parse_dash, parse_hls
+
+MEDIA_PLAYLIST = """#EXTM3U
+#EXT-X-VERSION:7
+#EXT-X-TARGETDURATION:4
+#EXT-X-MAP:URI="init.mp4"
+#EXTINF:4.0,
+seg0.m4s
+#EXTINF:3.5,
+seg1.m4s
+#EXT-X-ENDLIST
+"""
+
+MASTER_PLAYLIST = """#EXTM3U
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="en",DEFAULT=YES,URI="audio/index.m3u8"
+#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360,AUDIO="aud"
+low/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2400000,RESOLUTION=1280x720,CODECS="avc1.64001f,mp4a.40.2",AUDIO="aud"
+high/index.m3u8
+"""
+
+DASH_MANIFEST = """<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT10S">
+  <Period>
+    <AdaptationSet contentType="video" codecs="vp09.00.31.08">
+      <SegmentTemplate initialization="$RepresentationID$/init.mp4" media="$RepresentationID$/$Number%03d$.m4s"
+                       startNumber="1" timescale="1000" duration="4000"/>
+      <Representation id="v360" bandwidth="800000" height="360"/>
+      <Representation id="v720" bandwidth="2400000" height="720"/>
+    </AdaptationSet>
+    <AdaptationSet contentType="audio">
+      <Representation id="a1" bandwidth="128000" codecs="opus">
+        <SegmentList>
+          <Initialization sourceURL="a1/init.mp4"/>
+          <SegmentURL media="a1/1.m4s"/>
+          <SegmentURL media="a1/2.m4s"/>
+        </SegmentList>
+      </Representation>
+    </AdaptationSet>
+  </Period>
+</MPD>
+"""
+
+
+def test_parse_hls_media_playlist():
+    track, audio = parse_hls(MEDIA_PLAYLIST, "https://cdn.example/v/index.m3u8")
+    assert audio is None
+    assert track.kind == "muxed"
+    assert track.init.url == "https://cdn.example/v/init.mp4"
+    assert [s.url for s in track.segments] == ["https://cdn.example/v/seg0.m4s", "https://cdn.example/v/seg1.m4s"]
+    assert track.duration == 7.5
+
+
+def test_parse_hls_byteranges():
+    text = "#EXTM3U\n#EXTINF:2,\n#EXT-X-BYTERANGE:100@0\nall.ts\n#EXTINF:2,\n#EXT-X-BYTERANGE:50\nall.ts\n#EXT-X-ENDLIST\n"
+    track, _ = parse_hls(text, "https://cdn.example/index.m3u8")
+    assert [s.byterange for s in track.segments] == [(0, 99), (100, 149)]
+
+
+def test_parse_hls_master_picks_best_variant_and_audio(monkeypatch):
+    fetched = []
+
+    def fake_fetch(url, byterange=None, **kwargs):
+        fetched.append(url)
+        return MEDIA_PLAYLIST.encode()
+
+    monkeypatch.setattr(segmented, "fetch", fake_fetch)
+    video, audio = parse_hls(MASTER_PLAYLIST, "https://cdn.example/master.m3u8")
+    assert fetched == ["https://cdn.example/high/index.m3u8", "https://cdn.example/audio/index.m3u8"]
+    assert (video.kind, video.height, video.bandwidth) == ("video", 720, 2400000)
+    assert video.codecs == ["avc1.64001f", "mp4a.40.2"]
+    assert audio.kind == "audio"
+
+    fetched.clear()
+    video, _ = parse_hls(MASTER_PLAYLIST, "https://cdn.example/master.m3u8", max_height=480)
+    assert fetched[0] == "https://cdn.example/low/index.m3u8"
+    assert video.height == 360
+
+
+@pytest.mark.parametrize("text, reason", [
+    ("#EXTM3U\n#EXTINF:2,\nseg0.ts\n", "live"),
+    ("#EXTM3U\n#EXT-X-KEY:METHOD=AES-128,URI=\"k\"\n#EXTINF:2,\nseg0.ts\n#EXT-X-ENDLIST\n", "encrypted"),
+    ("<html></html>", "not an HLS"),
+])
+def test_parse_hls_rejects_unsupported(text, reason):
+    with pytest.raises(UnsupportedStream, match=reason):
+        parse_hls(text, "https://cdn.example/index.m3u8")
+
+
+def test_parse_dash():
+    video, audio = parse_dash(DASH_MANIFEST, "https://cdn.example/dash/manifest.mpd")
+    assert (video.kind, video.height, video.bandwidth) == ("video", 720, 2400000)
+    assert video.init.url == "https://cdn.example/dash/v720/init.mp4"
+    assert [s.url for s in video.segments] == [f"https://cdn.example/dash/v720/{n:03d}.m4s" for n in (1, 2, 3)]
+    assert video.duration == 10
+    assert (video.codecs, audio.codecs) == (["vp09.00.31.08"], ["opus"])
+    assert audio.init.url == "https://cdn.example/dash/a1/init.mp4"
+    assert [s.url for s in audio.segments] == ["https://cdn.example/dash/a1/1.m4s", "https://cdn.example/dash/a1/2.m4s"]
+
+    video, _ = parse_dash(DASH_MANIFEST, "https://cdn.example/dash/manifest.mpd", max_height=480)
+    assert video.height == 360
+
+
+def test_parse_dash_rejects_live_and_drm():
+    with pytest.raises(UnsupportedStream, match="live"):
+        parse_dash(DASH_MANIFEST.replace('type="static"', 'type="dynamic"'), "https://cdn.example/m.mpd")
+    drm = DASH_MANIFEST.replace("<SegmentTemplate", "<ContentProtection schemeIdUri=\"x\"/><SegmentTemplate")
+    with pytest.raises(UnsupportedStream, match="DRM"):
+        parse_dash(drm, "https://cdn.example/m.mpd")
+
+
+@pytest.mark.parametrize("statuses, calls, ok", [
+    ([404], 1, False),
+    ([403], 1, False),
+    ([503, 429, 200], 3, True),
+    ([500] * 3, 3, False),
+])
+def test_fetch_retries_only_transient_failures(monkeypatch, statuses, calls, ok):
+    import requests
+    answered = []
+
+    class FakeSession:
+        def get(self, url, **kwargs):
+            resp = requests.Response()
+            resp.status_code = statuses[len(answered)]
+            resp._content = b"data"
+            resp.url = url
+            answered.append(resp.status_code)
+            return resp
+    monkeypatch.setattr(segmented, "http_session", FakeSession)
+    monkeypatch.setattr(segmented.time, "sleep", lambda seconds: None)
+    if ok:
+        assert segmented.fetch("http://origin.test/seg0.m4s", retries=2) == b"data"
+    else:
+        with pytest.raises(requests.HTTPError):
+            segmented.fetch("http://origin.test/seg0.m4s", retries=2)
+    assert len(answered) == calls
+
+
+def test_track_download_resumes_after_interruption(server, media, tmp_path, monkeypatch):
+    track, _ = segmented.load_manifest(f"{server.base_url}/hls/1/index.m3u8")
+    assert len(track.segments) == len(media.segments) >= 4
+    part = str(tmp_path / "stream.mp4.muxed.part")
+
+    cancel = threading.Event()
+
+    def stop_after_two(kind, finished, total, size):
+        if finished == 2:
+            cancel.set()
+
+    with pytest.raises(InterruptedError):
+        TrackDownload(track, part, workers=1, cancel=cancel, on_segment=stop_after_two).run()
+    with open(part, "rb") as f:
+        assert f.read() == b"".join(media.segments[:2])
+
+    fetched = []
+    real_fetch = segmented.fetch
+
+    def counting_fetch(url, byterange=None, **kwargs):
+        fetched.append(url)
+        return real_fetch(url, byterange, **kwargs)
+
+    monkeypatch.setattr(segmented, "fetch", counting_fetch)
+    download = TrackDownload(track, part, workers=2)
+    download.run()
+    assert fetched == [s.url for s in track.segments[2:]]
+    with open(part, "rb") as f:
+        assert f.read() == b"".join(media.segments)
+    download.cleanup()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_download_segmented_hands_the_whole_stream_to_remux(server, media, tmp_path, monkeypatch):
+    remuxed = []
+
+    def fake_remux(inputs, output_path, cancel=None, slot=None, codecs=()):
+        with slot(cancel):
+            with open(inputs[0], "rb") as f:
+                remuxed.append(f.read())
+            shutil.copyfile(inputs[0], output_path)
+
+    monkeypatch.setattr(segmented, "remux", fake_remux)
+    governor = Governor(ffmpeg_slots=1)
+    progress = []
+    output = str(tmp_path / "stream.mp4")
+    assert segmented.download_segmented(f"{server.base_url}/hls/1/index.m3u8", output,
+                                        on_progress=lambda *p: progress.append(p), ffmpeg_slot=governor.ffmpeg) == output
+    assert remuxed == [b"".join(media.segments)]
+    assert governor.stats()["ffmpeg"]["running"] == 0
+    assert progress[-1] == (len(media.segments), len(media.segments), sum(map(len, media.segments)))
+    # The .part and .state files are gone once the remux succeeded
+    assert [p.name for p in tmp_path.iterdir()] == ["stream.mp4"]
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+def test_download_segmented_end_to_end(server, tmp_path):
+    output = str(tmp_path / "stream.mp4")
+    segmented.download_segmented(f"{server.base_url}/hls/1/index.m3u8", output)
+    with open(output, "rb") as f:
+        assert f.read(12)[4:8] == b"ftyp"
+    assert [p.name for p in tmp_path.iterdir()] == ["stream.mp4"]
+
+
+@pytest.fixture
+def ffmpeg_calls(monkeypatch):
+    calls = []
+
+    def fake_run_process(cmd, timeout=None, cancel=None):
+        calls.append(cmd)
+        return 0, False
+
+    monkeypatch.setattr(segmented, "run_process", fake_run_process)
+    return calls
+
+
+def test_remux_filters_aac_only(ffmpeg_calls):
+    segmented.remux(["v.part", "a.part"], "out.mp4", codecs=["avc1.64001f", "mp4a.40.2"])
+    segmented.remux(["v.part", "a.part"], "out.mp4", codecs=["vp09.00.31.08", "opus"])
+    aac, opus = ffmpeg_calls
+    assert aac[aac.index("-bsf:a") + 1] == "aac_adtstoasc"
+    assert "-bsf:a" not in opus
+    assert opus[-3:] == ["-movflags", "+faststart", "out.mp4"]
+
+
+def test_codecs_mp4_cannot_carry_go_to_matroska(server, tmp_path, monkeypatch, ffmpeg_calls):
+    real_load = segmented.load_manifest
+
+    def vorbis_manifest(url, max_height=None):
+        track, audio = real_load(url, max_height)
+        track.codecs = ["vp8", "vorbis"]
+        return track, audio
+
+    monkeypatch.setattr(segmented, "load_manifest", vorbis_manifest)
+    output = str(tmp_path / "stream.mp4")
+    assert segmented.download_segmented(f"{server.base_url}/hls/1/index.m3u8", output) == str(tmp_path / "stream.mkv")
+    cmd, = ffmpeg_calls
+    assert cmd[-1] == str(tmp_path / "stream.mkv")
+    assert "-bsf:a" not in cmd and "-movflags" not in cmd
+    assert segmented.mp4_compatible(["av01.0.08M.08", "opus"])
+    assert segmented.mp4_compatible([])
@@ -0,0 +1,126 @@
+"""Prefetches are claimed and dropped only by the page they were started for."""
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from download_store import DownloadStore
+from governor import Governor
+from job_store import JobStore
+from jobs import CANCELLED, FINISHED, JobQueue
+from speculation import Speculator
+
+URL = "https://example.com/watch?v=1"
+
+
+def prefetch(job, url, format_id):
+    while not job.cancelled and not job.details.get("go"):
+        time.sleep(0.02)
+    job.check_cancelled()
+    return {"message": "Done"}
+
+
+@pytest.fixture
+def speculator(tmp_path):
+    return Speculator(JobQueue(workers=1), Governor(), DownloadStore(str(tmp_path)), prefetch, enabled=True)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+def test_only_the_speculation_id_claims(speculator):
+    speculation_id = speculator.start("10.0.0.1", URL, "137")
+    assert speculation_id
+    # Same address, but not the page that got the id: nothing is claimed or dropped
+    assert speculator.claim("10.0.0.1", URL, "137", None) is None
+    assert speculator.claim("10.0.0.1", URL, "137", "f" * 32) is None
+    assert speculator.claim("10.0.0.2", URL, "137", speculation_id) is None
+    assert len(speculator.stats()["pending"]) == 1
+
+    job_id = speculator.claim("10.0.0.1", URL, "137", speculation_id)
+    job = speculator.job_queue.get(job_id)
+    assert job.kind == "video"
+    job.record(go=True)
+    wait_for(lambda: job.status == FINISHED)
+    assert speculator.stats()["claimed"] == 1
+
+
+def test_the_page_choosing_something_else_drops_it(speculator):
+    speculation_id = speculator.start("10.0.0.1", URL, "137")
+    job = speculator._pending["10.0.0.1"].job
+    assert speculator.claim("10.0.0.1", URL, "22", speculation_id) is None
+    wait_for(lambda: job.status == CANCELLED)
+    assert speculator.stats()["pending"] == []
+
+
+def test_drop_needs_the_speculation_id(speculator):
+    speculation_id = speculator.start("10.0.0.1", URL, "137")
+    assert not speculator.drop("10.0.0.1", None)
+    assert not speculator.drop("10.0.0.1", "f" * 32)
+    assert len(speculator.stats()["pending"]) == 1
+    assert speculator.drop("10.0.0.1", speculation_id)
+    assert speculator.stats()["pending"] == []
+
+
+def test_asking_again_keeps_the_same_id(speculator):
+    speculation_id = speculator.start("10.0.0.1", URL, "137")
+    assert speculator.start("10.0.0.1", URL, "137") == speculation_id
+    # Neither the id, the job nor the URL is listed where other clients can read it
+    stats = str(speculator.stats())
+    assert speculation_id not in stats
+    assert speculator._pending["10.0.0.1"].job.id not in stats
+    assert URL not in stats
+    speculator.drop("10.0.0.1", speculation_id)
+
+
+RESTARTED_NODE = """
+import os, sys, time
+sys.path.insert(0, sys.argv[1])
+from download_store import DownloadStore
+from governor import Governor
+from job_store import JobStore
+from jobs import JobQueue
+from speculation import Speculator
+
+def prefetch(job, url, format_id):
+    time.sleep(30)
+
+queue = JobQueue(store=JobStore(sys.argv[2]))
+speculator = Speculator(queue, Governor(), DownloadStore(sys.argv[3]), prefetch, enabled=True)
+speculation_id = speculator.start("10.0.0.1", sys.argv[4], "137")
+job = speculator._pending["10.0.0.1"].job
+if sys.argv[5] == "claim":
+    speculator.claim("10.0.0.1", sys.argv[4], "137", speculation_id)
+print(job.id, flush=True)
+os._exit(0)
+"""
+
+
+@pytest.mark.parametrize("claimed", [True, False])
+def test_only_claimed_prefetches_resume_after_a_restart(tmp_path, claimed):
+    db = str(tmp_path / "jobs.sqlite3")
+    here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    child = subprocess.run([sys.executable, "-c", RESTARTED_NODE, here, db,
+                            str(tmp_path / "store"), URL, "claim" if claimed else "leave"],
+                           capture_output=True, text=True, timeout=30, check=True)
+    job_id = child.stdout.split()[-1]
+
+    def prefetch(job, url, format_id):
+        return {"message": "Resumed"}
+
+    queue = JobQueue(workers=1, store=JobStore(db))
+    queue.resumable(prefetch)
+    recovered = queue.recover()
+    if claimed:
+        job, = recovered
+        assert (job.id, job.kind, job.kwargs) == (job_id, "video", {"url": URL, "format_id": "137"})
+        wait_for(lambda: job.status == FINISHED)
+    else:
+        assert recovered == []
+        assert queue.lookup(job_id)["status"] == "failed"
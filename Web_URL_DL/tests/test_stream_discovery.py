@@ -0,0 +1,98 @@
+"""Stream discovery against the fixture pages: what a browser loading them would report."""
+import json
+import re
+from urllib.parse import urljoin
+
+import pytest
+import requests
+
+from stream_discovery import StreamCollector, _feed_chrome_log, classify_stream, discover_with_playwright
+
+
+def devtools_entry(method, params):
+    return {"message": json.dumps({"message": {"method": method, "params": params}})}
+
+
+def browse(url):
+    """Fetch url and the media its <video> loads (and, for a playlist, its segments) as a browser would.
+
+    Returns the DevTools performance log entries Chrome would have recorded.
+    """
+    entries = []
+    pending = [url]
+    while pending:
+        current = pending.pop(0)
+        entries.append(devtools_entry("Network.requestWillBeSent", {"request": {"url": current}}))
+        resp = requests.get(current, timeout=10)
+        mimetype = resp.headers["Content-Type"].split(";")[0]
+        entries.append(devtools_entry("Network.responseReceived", {"response": {"url": current, "mimeType": mimetype}}))
+        if mimetype == "text/html":
+            pending += [urljoin(current, src) for src in re.findall(r'<source src="([^"]+)"', resp.text)]
+        elif "mpegurl" in mimetype:
+            pending += [urljoin(current, line) for line in resp.text.splitlines() if line and not line.startswith("#")]
+    return entries
+
+
+def test_classify_stream():
+    assert classify_stream("https://cdn.example/v/index.m3u8?token=1") == "manifest"
+    assert classify_stream("https://cdn.example/v/manifest.mpd") == "manifest"
+    assert classify_stream("https://cdn.example/v/movie.MP4") == "media"
+    assert classify_stream("https://cdn.example/play?id=7", "application/vnd.apple.mpegurl; charset=utf-8") == "manifest"
+    assert classify_stream("https://cdn.example/play?id=7", "application/dash+xml") == "manifest"
+    assert classify_stream("https://cdn.example/play?id=7", "video/webm") == "media"
+    assert classify_stream("https://cdn.example/seg0.ts", "video/mp2t") is None
+    assert classify_stream("https://cdn.example/page", "text/html") is None
+    assert classify_stream("blob:https://cdn.example/3f2a") is None
+    assert classify_stream(None) is None
+
+
+def test_video_tag_page(server):
+    collector = StreamCollector()
+    _feed_chrome_log(collector, browse(f"{server.base_url}/page/3"))
+    assert collector.candidates == [(f"{server.base_url}/media/3.mp4", "media")]
+    assert collector.first_found is not None
+
+
+def test_hls_page(server, media):
+    collector = StreamCollector()
+    entries = browse(f"{server.base_url}/hls-page/4")
+    # The page, the playlist and every segment were requested; only the playlist is a stream
+    assert len(entries) == 2 * (2 + len(media.segments))
+    _feed_chrome_log(collector, entries)
+    assert collector.candidates == [(f"{server.base_url}/hls/4/index.m3u8", "manifest")]
+    assert collector.urls() == [f"{server.base_url}/hls/4/index.m3u8"]
+
+
+def test_trailers_rank_last(server):
+    collector = StreamCollector()
+    collector.feed("https://cdn.example/promo/trailer.mp4")
+    assert collector.first_found is None
+    _feed_chrome_log(collector, browse(f"{server.base_url}/hls-page/5"))
+    assert collector.urls() == [f"{server.base_url}/hls/5/index.m3u8", "https://cdn.example/promo/trailer.mp4"]
+
+
+def test_malformed_devtools_entries_are_skipped():
+    collector = StreamCollector()
+    _feed_chrome_log(collector, [{"message": "not json"}, {}, devtools_entry("Network.loadingFinished", {})])
+    assert collector.candidates == []
+
+
+@pytest.fixture(scope="module")
+def chromium():
+    sync_api = pytest.importorskip("playwright.sync_api")
+    with sync_api.sync_playwright() as playwright:
+        try:
+            browser = playwright.chromium.launch()
+        except Exception as e:
+            pytest.skip(f"Chromium is not available: {e}")
+        yield browser
+        browser.close()
+
+
+def test_playwright_discovers_the_hls_stream(server, chromium):
+    page = chromium.new_page()
+    try:
+        urls = discover_with_playwright(page, f"{server.base_url}/hls-page/6", timeout=15)
+    finally:
+        page.close()
+    assert urls[0] == f"{server.base_url}/hls/6/index.m3u8"
@@ -0,0 +1,33 @@
+"""The ffmpeg commands /stream and the audio jobs run."""
+from streaming import audio_file_command, stream_command
+
+VP9 = {"url": "https://cdn.example/v.webm", "protocol": "https", "vcodec": "vp9", "acodec": "none"}
+OPUS = {"url": "https://cdn.example/a.webm", "protocol": "https", "vcodec": "none", "acodec": "opus"}
+H264 = {"url": "https://cdn.example/v.mp4", "protocol": "https", "vcodec": "avc1.64001F", "acodec": "none"}
+AAC = {"url": "https://cdn.example/a.m4a", "protocol": "https", "vcodec": "none", "acodec": "mp4a.40.2"}
+
+
+def test_opus_audio_gets_no_aac_filter():
+    cmd, mimetype, ext = stream_command([VP9, OPUS])
+    assert "aac_adtstoasc" not in cmd
+    assert cmd[cmd.index("-c") + 1] == "copy"
+    assert (cmd[-3:], mimetype, ext) == (["-f", "mp4", "pipe:1"], "video/mp4", "mp4")
+
+
+def test_aac_audio_gets_the_aac_filter():
+    cmd, _, _ = stream_command([H264, AAC])
+    assert cmd[cmd.index("-bsf:a") + 1] == "aac_adtstoasc"
+    muxed = dict(H264, acodec="mp4a.40.2")
+    assert "aac_adtstoasc" in stream_command([muxed])[0]
+
+
+def test_m4a_is_fragmented_for_the_pipe():
+    cmd, mimetype, ext = stream_command([AAC], "audio", "m4a")
+    assert (mimetype, ext) == ("audio/mp4", "m4a")
+    assert cmd[cmd.index("-f") + 1] == "ipod"
+    assert "empty_moov" in cmd[cmd.index("-movflags") + 1]
+    assert cmd[-1] == "pipe:1"
+    # Files on disk are seekable: no fragments there
+    file_cmd, _ = audio_file_command(AAC, "/tmp/out.m4a", "m4a")
+    assert "-movflags" not in file_cmd
+    assert "-movflags" not in stream_command([OPUS], "audio", "opus")[0]
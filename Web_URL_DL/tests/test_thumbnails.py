@@ -0,0 +1,78 @@
+"""The thumbnail proxy only fetches from public addresses, redirects included."""
+import socket
+
+import pytest
+import requests
+
+import thumbnails
+from thumbnails import ThumbnailCache, ThumbnailError, check_public
+
+PUBLIC = "93.184.216.34"
+
+
+@pytest.fixture
+def resolve(monkeypatch):
+    """Resolve hostnames from a dict instead of DNS."""
+    names = {}
+
+    def fake_getaddrinfo(host, port, *args, **kwargs):
+        family = socket.AF_INET6 if ":" in names[host] else socket.AF_INET
+        return [(family, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (names[host], port))]
+    monkeypatch.setattr(thumbnails.socket, "getaddrinfo", fake_getaddrinfo)
+    return names
+
+
+@pytest.mark.parametrize("address", [
+    "127.0.0.1", "10.1.2.3", "192.168.0.10", "172.16.5.5", "169.254.169.254", "100.64.0.1",
+    "0.0.0.0", "224.0.0.1", "::1", "fe80::1", "fd00::1", "::ffff:127.0.0.1",
+])
+def test_non_public_addresses_are_refused(resolve, address):
+    resolve["origin.test"] = address
+    with pytest.raises(ThumbnailError):
+        check_public("http://origin.test/thumb.jpg")
+
+
+def test_public_addresses_pass(resolve):
+    resolve["origin.test"] = PUBLIC
+    check_public("https://origin.test:8443/thumb.jpg")
+    with pytest.raises(ThumbnailError):
+        check_public("file:///etc/passwd")
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = headers
+
+    @property
+    def is_redirect(self):
+        return "Location" in self.headers and self.status_code in (301, 302, 303, 307, 308)
+
+    def close(self):
+        pass
+
+
+def test_redirects_to_private_addresses_are_not_followed(resolve, monkeypatch, tmp_path):
+    resolve.update({"origin.test": PUBLIC, "metadata.test": "169.254.169.254"})
+    fetched = []
+
+    def fake_get(url, **kwargs):
+        assert kwargs["allow_redirects"] is False
+        fetched.append(url)
+        return FakeResponse(302, {"Location": "http://metadata.test/latest/meta-data/"})
+    monkeypatch.setattr(requests, "get", fake_get)
+
+    cache = ThumbnailCache(str(tmp_path))
+    tid = cache.register("http://origin.test/thumb.jpg")
+    with pytest.raises(ThumbnailError, match="not public"):
+        cache.original(tid)
+    assert fetched == ["http://origin.test/thumb.jpg"]
+    assert cache.stats()["errors"] == 1
+
+
+def test_redirect_loops_give_up(resolve, monkeypatch, tmp_path):
+    resolve["origin.test"] = PUBLIC
+    monkeypatch.setattr(requests, "get", lambda url, **kwargs: FakeResponse(301, {"Location": "/again"}))
+    cache = ThumbnailCache(str(tmp_path))
+    with pytest.raises(ThumbnailError, match="redirected"):
+        cache.original(cache.register("http://origin.test/thumb.jpg"))
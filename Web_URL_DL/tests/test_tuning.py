@@ -0,0 +1,37 @@
+"""Throttle and retry detection in yt-dlp's log output."""
+import pytest
+
+from tuning import HostProfile, TuningSession
+
+
+@pytest.fixture
+def session():
+    return TuningSession(HostProfile("example.com"))
+
+
+@pytest.mark.parametrize("level, msg", [
+    ("debug", "[download] Got error: HTTP Error 429: Too Many Requests. Retrying fragment 3 (1/10)..."),
+    ("warning", "[generic] Unable to download webpage: HTTP Error 429: Too Many Requests"),
+    ("error", "ERROR: unable to download video data: HTTP Error 429: Too Many Requests"),
+])
+def test_throttling_is_detected(session, level, msg):
+    getattr(session.logger, level)(msg)
+    assert session.throttled
+
+
+@pytest.mark.parametrize("msg", [
+    "[debug] Invoking http downloader on \"https://cdn.example.com/v/4291/seg429.ts\"",
+    "[download]  42.9% of   14.29MiB at    1.42MiB/s ETA 00:04",
+    "[info] 1429: Downloading 1 format(s): 429-1",
+    "[generic] Too Many Requests is the title of this video",
+])
+def test_debug_lines_never_count_as_throttling(session, msg):
+    session.logger.debug(msg)
+    assert not session.throttled
+
+
+def test_retries_are_counted(session):
+    session.logger.debug("[download] Got error: Read timed out. Retrying fragment 7 (1/10)...")
+    session.logger.warning("Retrying (2/10)...")
+    assert session.retries == 2
+    assert not session.throttled
@@ -0,0 +1,396 @@
+import hashlib
+import ipaddress
+import json
+import os
+import re
+import shutil
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+from extract_cache import normalize_url
+from fallbacks import run_process
+from governor import Busy
+from lazy import lazy_import
+
+requests = lazy_import("requests")
+
+# Total size of cached originals and resized variants (bytes)
+THUMB_CACHE_SIZE = int(os.environ.get("THUMB_CACHE_SIZE", str(256 * 1024 ** 2)))
+# Widths variants are made in; a requested width is rounded up to the next one
+THUMB_WIDTHS = tuple(sorted(int(w) for w in os.environ.get("THUMB_WIDTHS", "320,640,1280").split(",") if w.strip()))
+THUMB_DEFAULT_WIDTH = int(os.environ.get("THUMB_DEFAULT_WIDTH", "640"))
+# ffmpeg JPEG quality, 2 (best) to 31
+THUMB_QUALITY = int(os.environ.get("THUMB_QUALITY", "5"))
+# Origin images bigger than this are refused
+THUMB_MAX_BYTES = int(os.environ.get("THUMB_MAX_BYTES", str(10 * 1024 ** 2)))
+THUMB_TIMEOUT = float(os.environ.get("THUMB_TIMEOUT", "10"))
+# Redirects followed per origin fetch; every hop is checked like the first URL
+THUMB_MAX_REDIRECTS = int(os.environ.get("THUMB_MAX_REDIRECTS", "5"))
+# Cache-Control max-age for /thumb responses
+THUMB_MAX_AGE = int(os.environ.get("THUMB_MAX_AGE", "86400"))
+THUMB_WORKERS = int(os.environ.get("THUMB_WORKERS", "2"))
+
+# Raster types served as they are, recognised by their leading bytes rather than the origin's
+# Content-Type (SVG, which can carry script, is never accepted); WebP is checked in sniff_image
+THUMB_TYPES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+THUMB_MIMETYPES = ("image/jpeg", "image/png", "image/gif", "image/webp")
+ORIGIN_FILE = "origin.json"
+ORIGINAL_FILE = "original"
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"
+_ID_RE = re.compile(r"^[0-9a-f]{20}$")
+
+
+class ThumbnailError(Exception):
+    """The origin image couldn't be fetched (unreachable, not an image, too big)."""
+
+
+def thumb_id(url):
+    return hashlib.sha256(normalize_url(url).encode("utf-8")).hexdigest()[:20]
+
+
+def is_thumb_id(value):
+    return bool(_ID_RE.match(value or ""))
+
+
+def check_public(url):
+    """Raise ThumbnailError unless url is http(s) and its host resolves only to public addresses.
+
+    Origin URLs come from extracted pages, so without this /thumb would
+    fetch loopback, private network and cloud metadata addresses for anyone.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ThumbnailError(f"Not an http(s) URL: {url}")
+    try:
+        infos = socket.getaddrinfo(parts.hostname, parts.port or (443 if parts.scheme == "https" else 80),
+                                   proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError, ValueError) as e:
+        raise ThumbnailError(f"Couldn't resolve {parts.hostname}: {e}")
+    for *_, sockaddr in infos:
+        address = ipaddress.ip_address(sockaddr[0].split("%")[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise ThumbnailError(f"Refusing to fetch a thumbnail from {parts.hostname} ({address} is not public)")
+
+
+def sniff_image(data):
+    """The mimetype of data if it is a JPEG, PNG, GIF or WebP image, else None."""
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    for magic, mimetype in THUMB_TYPES:
+        if data.startswith(magic):
+            return mimetype
+    return None
+
+
+class ThumbnailCache:
+    """Origin thumbnails fetched once, plus JPEG variants resized by ffmpeg, on disk.
+
+    Every thumbnail gets a directory under root named after its id, holding
+    the origin URL, the original image and its variants. Directories are
+    evicted least recently used first once the cache grows past max_bytes.
+    Without ffmpeg (or with every ffmpeg slot busy) the original is served.
+    """
+
+    def __init__(self, root, max_bytes=THUMB_CACHE_SIZE, widths=THUMB_WIDTHS, quality=THUMB_QUALITY,
+                 governor=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.widths = widths or (THUMB_DEFAULT_WIDTH,)
+        self.quality = quality
+        self.governor = governor
+        self._entries = OrderedDict()  # id -> bytes on disk
+        self._origins = {}
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._opened = False
+        self.hits = 0
+        self.misses = 0
+        self.resized = 0
+        self.evictions = 0
+        self.errors = 0
+
+    def _dir(self, tid):
+        return os.path.join(self.root, tid)
+
+    def _open(self):
+        """Create root and load the index on first use, not when the app is imported."""
+        if self._opened:
+            return
+        with self._lock:
+            if not self._opened:
+                os.makedirs(self.root, exist_ok=True)
+                self._load()
+                self._opened = True
+
+    def _load(self):
+        found = []
+        for tid in os.listdir(self.root):
+            if not is_thumb_id(tid):
+                continue
+            try:
+                files = [os.path.join(self._dir(tid), name) for name in os.listdir(self._dir(tid))]
+                size = sum(os.path.getsize(f) for f in files if not f.endswith(ORIGIN_FILE))
+                found.append((max(os.path.getmtime(f) for f in files), tid, size))
+            except (OSError, ValueError):
+                shutil.rmtree(self._dir(tid), ignore_errors=True)
+        for _, tid, size in sorted(found):
+            self._entries[tid] = size
+
+    # Registration
+
+    def register(self, url):
+        """Remember url under its id and return the id (None for non-http URLs)."""
+        if not url or not url.startswith(("http://", "https://")):
+            return None
+        self._open()
+        tid = thumb_id(url)
+        with self._lock:
+            if self._origins.get(tid) == url:
+                return tid
+            self._origins[tid] = url
+            self._entries.setdefault(tid, 0)
+        os.makedirs(self._dir(tid), exist_ok=True)
+        with open(os.path.join(self._dir(tid), ORIGIN_FILE), "w", encoding="utf-8") as f:
+            json.dump({"url": url}, f)
+        return tid
+
+    def path_for(self, url):
+        """/thumb/<id> for url, or None (the page then loads the origin URL itself)."""
+        try:
+            tid = self.register(url)
+        except OSError as e:
+            print(f"⚠️ Thumbnail proxy unavailable: {e}")
+            return None
+        return f"/thumb/{tid}" if tid else None
+
+    def _origin(self, tid):
+        with self._lock:
+            url = self._origins.get(tid)
+        if url:
+            return url
+        # Registered by another worker, or before a restart
+        try:
+            with open(os.path.join(self._dir(tid), ORIGIN_FILE), encoding="utf-8") as f:
+                url = json.load(f)["url"]
+        except (OSError, ValueError, KeyError):
+            return None
+        with self._lock:
+            self._origins[tid] = url
+            self._entries.setdefault(tid, 0)
+        return url
+
+    def prefetch(self, url, width=THUMB_DEFAULT_WIDTH):
+        """Fetch url and make its default variant in the background."""
+        path = self.path_for(url)
+        if path is None:
+            return
+        tid = path.rsplit("/", 1)[1]
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=THUMB_WORKERS, thread_name_prefix="thumb")
+        self._executor.submit(self._prefetch, tid, width)
+
+    def _prefetch(self, tid, width):
+        try:
+            self.variant(tid, width)
+        except (ThumbnailError, OSError) as e:
+            print(f"⚠️ Thumbnail prefetch failed for {tid}: {e}")
+
+    # Serving
+
+    def _single_flight(self, name, make):
+        """Run make() once for name, however many threads ask for it at once."""
+        with self._lock:
+            lock = self._flights.setdefault(name, threading.Lock())
+        with lock:
+            try:
+                return make()
+            finally:
+                with self._lock:
+                    self._flights.pop(name, None)
+
+    def original(self, tid):
+        """(path, mimetype) of the original image, fetching it if needed. KeyError for unknown ids."""
+        url = self._origin(tid) if is_thumb_id(tid) else None
+        if url is None:
+            raise KeyError(tid)
+        path = os.path.join(self._dir(tid), ORIGINAL_FILE)
+        meta = os.path.join(self._dir(tid), ORIGINAL_FILE + ".json")
+
+        def fetch():
+            if not os.path.exists(path):
+                self._download(url, path, meta)
+                self._account(tid)
+            else:
+                with self._lock:
+                    self.hits += 1
+            with open(meta, encoding="utf-8") as f:
+                content_type = json.load(f)["content_type"]
+            if content_type not in THUMB_MIMETYPES:
+                # Stored before only raster images were accepted
+                raise ThumbnailError(f"Unsupported thumbnail type {content_type}")
+            return path, content_type
+        return self._single_flight(path, fetch)
+
+    def _get(self, url):
+        """GET url, following redirects by hand so that every hop passes check_public."""
+        for _ in range(THUMB_MAX_REDIRECTS + 1):
+            check_public(url)
+            resp = requests.get(url, timeout=THUMB_TIMEOUT, stream=True, allow_redirects=False,
+                                headers={"User-Agent": USER_AGENT})
+            if not resp.is_redirect:
+                return resp
+            url = urljoin(url, resp.headers["Location"])
+            resp.close()
+        raise ThumbnailError(f"Origin redirected more than {THUMB_MAX_REDIRECTS} times")
+
+    def _download(self, url, path, meta):
+        try:
+            resp = self._get(url)
+        except ThumbnailError:
+            self._failed()
+            raise
+        except requests.RequestException as e:
+            self._failed()
+            raise ThumbnailError(f"Thumbnail fetch failed: {e}")
+        try:
+            content_type = resp.headers.get("Content-Type", "").split(";")[0].strip().lower()
+            if resp.status_code >= 400 or not content_type.startswith("image/"):
+                self._failed()
+                raise ThumbnailError(f"Origin answered {resp.status_code} {content_type or 'without a type'}")
+            data = b""
+            for chunk in resp.iter_content(64 * 1024):
+                data += chunk
+                if len(data) > THUMB_MAX_BYTES:
+                    self._failed()
+                    raise ThumbnailError("Thumbnail is too large")
+        except requests.RequestException as e:
+            self._failed()
+            raise ThumbnailError(f"Thumbnail fetch failed: {e}")
+        finally:
+            resp.close()
+        content_type = sniff_image(data)
+        if content_type is None:
+            self._failed()
+            raise ThumbnailError("Thumbnail is not a JPEG, PNG, GIF or WebP image")
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        with open(meta, "w", encoding="utf-8") as f:
+            json.dump({"content_type": content_type, "fetched": time.time()}, f)
+        os.replace(path + ".tmp", path)
+        with self._lock:
+            self.misses += 1
+
+    def _failed(self):
+        with self._lock:
+            self.errors += 1
+
+    def snap(self, width):
+        """The smallest configured width >= width (the largest if none is)."""
+        for candidate in self.widths:
+            if candidate >= width:
+                return candidate
+        return self.widths[-1]
+
+    def variant(self, tid, width=THUMB_DEFAULT_WIDTH):
+        """(path, mimetype) of tid resized to snap(width), falling back to the original."""
+        width = self.snap(width)
+        path = os.path.join(self._dir(tid), f"w{width}.jpg")
+        if os.path.exists(path):
+            self._touch(tid, hit=True)
+            return path, "image/jpeg"
+        original, content_type = self.original(tid)
+        if not shutil.which("ffmpeg"):
+            self._touch(tid)
+            return original, content_type
+
+        def resize():
+            if os.path.exists(path):
+                return True
+            slot = None
+            if self.governor is not None:
+                try:
+                    slot = self.governor.ffmpeg(wait=False)
+                except Busy:
+                    # Not worth queueing behind conversions; the original will do this time
+                    return False
+            try:
+                returncode, _ = run_process([
+                    "ffmpeg", "-y", "-loglevel", "error", "-i", original,
+                    "-vf", f"scale='min({width},iw)':-2", "-frames:v", "1", "-q:v", str(self.quality),
+                    path + ".tmp.jpg",
+                ], timeout=THUMB_TIMEOUT)
+            finally:
+                if slot is not None:
+                    slot.release()
+            if returncode != 0:
+                self._failed()
+                print(f"⚠️ Couldn't resize thumbnail {tid} to {width}px (ffmpeg exited with {returncode})")
+                return False
+            os.replace(path + ".tmp.jpg", path)
+            with self._lock:
+                self.resized += 1
+            self._account(tid)
+            return True
+
+        if self._single_flight(path, resize):
+            self._touch(tid)
+            return path, "image/jpeg"
+        self._touch(tid)
+        return original, content_type
+
+    # Size bound
+
+    def _touch(self, tid, hit=False):
+        with self._lock:
+            if tid in self._entries:
+                self._entries.move_to_end(tid)
+            if hit:
+                self.hits += 1
+
+    def _account(self, tid):
+        try:
+            size = sum(entry.stat().st_size for entry in os.scandir(self._dir(tid))
+                       if entry.is_file() and entry.name != ORIGIN_FILE)
+        except OSError:
+            return
+        with self._lock:
+            self._entries[tid] = size
+            self._entries.move_to_end(tid)
+            total = sum(self._entries.values())
+            for victim in list(self._entries):
+                if total <= self.max_bytes:
+                    break
+                if victim == tid:
+                    continue
+                total -= self._entries.pop(victim)
+                self._origins.pop(victim, None)
+                self.evictions += 1
+                shutil.rmtree(self._dir(victim), ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(self._entries.values()),
+                "max_bytes": self.max_bytes,
+                "widths": list(self.widths),
+                "hits": self.hits,
+                "misses": self.misses,
+                "resized": self.resized,
+                "evictions": self.evictions,
+                "errors": self.errors,
+                "resizer": "ffmpeg" if shutil.which("ffmpeg") else None,
+            }
@@ -0,0 +1,285 @@
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+TUNING_MIN_FRAGMENTS = int(os.environ.get("TUNING_MIN_FRAGMENTS", "1"))
+TUNING_MAX_FRAGMENTS = int(os.environ.get("TUNING_MAX_FRAGMENTS", "16"))
+TUNING_START_FRAGMENTS = int(os.environ.get("TUNING_START_FRAGMENTS", "4"))
+# Seconds without a 429 before a host's lowered ceiling is allowed to double again
+TUNING_RELAX = int(os.environ.get("TUNING_RELAX", "3600"))
+# Downloads smaller than this are too short to say anything about throughput
+TUNING_MIN_BYTES = int(os.environ.get("TUNING_MIN_BYTES", str(2 * 1024 * 1024)))
+# Optional SQLite file that keeps learned settings across restarts and workers ("" keeps them in memory)
+TUNING_DB = os.environ.get("TUNING_DB", "")
+# External downloader for progressive HTTP formats, e.g. "aria2c" ("" uses yt-dlp's own).
+# Off by default: yt-dlp only reports progress (and so only notices a cancel) when it finishes.
+DOWNLOAD_EXTERNAL = os.environ.get("DOWNLOAD_EXTERNAL", "")
+
+# http_chunk_size steps; throttled hosts move down, clean downloads move back up to the default
+CHUNK_SIZES = (1 << 20, 2 << 20, 5 << 20, 10 << 20)
+DEFAULT_CHUNK = CHUNK_SIZES[-1]
+# A level needs this much more throughput than the one below it to be worth its extra connections
+GAIN = 1.1
+# Weight of a new throughput sample in a level's running average
+EWMA = 0.3
+
+# Looked for in warnings and errors only; anything else (URLs, byte counts, ids) may contain "429" by chance
+THROTTLE_MARKERS = ("HTTP Error 429", "Too Many Requests")
+RETRY_MARKERS = ("Got error", "Retrying")
+# yt-dlp sends its retry warnings through to_screen, which is the logger's debug()
+RETRY_WARNING = "[download] Got error:"
+
+
+def host_of(url):
+    host = (urlsplit(url).hostname or "").lower()
+    return host[4:] if host.startswith("www.") else host
+
+
+class HostProfile:
+    """What has been learned about downloading from one host.
+
+    rates maps a connection count to the running average throughput seen
+    with it. The next download uses the smallest count within GAIN of the
+    best rate, probing twice as many connections while throughput keeps
+    scaling. A 429 halves the count and caps it (the ceiling) until the
+    host has gone TUNING_RELAX seconds without throttling again.
+    """
+
+    def __init__(self, host, fragments=TUNING_START_FRAGMENTS, chunk_size=DEFAULT_CHUNK,
+                 ceiling=TUNING_MAX_FRAGMENTS, rates=None, throttled_at=0.0, downloads=0, throttles=0, errors=0):
+        self.host = host
+        self.fragments = fragments
+        self.chunk_size = chunk_size
+        self.ceiling = ceiling
+        self.rates = {int(k): v for k, v in (rates or {}).items()}
+        self.throttled_at = throttled_at
+        self.downloads = downloads
+        self.throttles = throttles
+        self.errors = errors
+
+    def to_dict(self):
+        return {
+            "fragments": self.fragments,
+            "chunk_size": self.chunk_size,
+            "ceiling": self.ceiling,
+            "rates": {str(k): round(v) for k, v in sorted(self.rates.items())},
+            "throttled_at": self.throttled_at,
+            "downloads": self.downloads,
+            "throttles": self.throttles,
+            "errors": self.errors,
+        }
+
+    def ydl_options(self):
+        """yt-dlp options for the next download from this host."""
+        options = {
+            "concurrent_fragment_downloads": self.fragments,
+            "http_chunk_size": self.chunk_size,
+        }
+        if DOWNLOAD_EXTERNAL == "aria2c" and shutil.which("aria2c"):
+            connections = str(self.fragments)
+            # Fragmented formats keep yt-dlp's own downloader and its per-fragment progress
+            options["external_downloader"] = {"http": "aria2c"}
+            options["external_downloader_args"] = {"aria2c": ["-x", connections, "-s", connections, "-k", "1M"]}
+        return options
+
+    def record(self, fragments, received, seconds, retries, throttled, failed):
+        now = time.time()
+        self.downloads += 1
+        self.errors += retries
+        if throttled:
+            self.throttles += 1
+            self.throttled_at = now
+            self.ceiling = max(TUNING_MIN_FRAGMENTS, fragments // 2)
+            self.rates = {k: v for k, v in self.rates.items() if k <= self.ceiling}
+            self.fragments = self.ceiling
+            self.chunk_size = CHUNK_SIZES[max(0, CHUNK_SIZES.index(self.chunk_size) - 1)] \
+                if self.chunk_size in CHUNK_SIZES else CHUNK_SIZES[0]
+            return
+        if self.ceiling < TUNING_MAX_FRAGMENTS and now - self.throttled_at > TUNING_RELAX:
+            self.ceiling = min(TUNING_MAX_FRAGMENTS, self.ceiling * 2)
+            self.throttled_at = now
+        if failed:
+            # Failures that aren't throttling say nothing about the right concurrency
+            return
+        if retries > fragments:
+            # More retried requests than connections: back off a step without a full halving
+            self.fragments = max(TUNING_MIN_FRAGMENTS, fragments - 1)
+            return
+        if received >= TUNING_MIN_BYTES and seconds >= 1:
+            rate = received / seconds
+            previous = self.rates.get(fragments)
+            self.rates[fragments] = rate if previous is None else previous + EWMA * (rate - previous)
+            if self.chunk_size in CHUNK_SIZES and self.chunk_size < DEFAULT_CHUNK:
+                self.chunk_size = CHUNK_SIZES[CHUNK_SIZES.index(self.chunk_size) + 1]
+        self._adapt()
+
+    def _adapt(self):
+        levels = sorted(k for k in self.rates if k <= self.ceiling)
+        if not levels:
+            self.fragments = min(self.fragments, self.ceiling)
+            return
+        top = max(self.rates[k] for k in levels)
+        best = min(k for k in levels if self.rates[k] * GAIN >= top)
+        if best == levels[-1] and best < self.ceiling:
+            # Still scaling with more connections: try more next time
+            self.fragments = min(self.ceiling, best * 2)
+        else:
+            self.fragments = best
+
+
+class TuningLogger:
+    """yt-dlp logger that counts retries and 429s while printing what yt-dlp would have."""
+
+    def __init__(self, session):
+        self.session = session
+
+    def _scan(self, msg, warning):
+        if warning and any(marker in msg for marker in THROTTLE_MARKERS):
+            self.session.throttled = True
+        if any(marker in msg for marker in RETRY_MARKERS):
+            self.session.retries += 1
+
+    def debug(self, msg):
+        self._scan(msg, warning=msg.startswith(RETRY_WARNING))
+        # Skip yt-dlp's verbose output and the carriage-return progress lines
+        if not msg.startswith(("[debug] ", "\r")) and not (msg.startswith("[download]") and "% of" in msg):
+            print(msg)
+
+    def info(self, msg):
+        self.debug(msg)
+
+    def warning(self, msg):
+        self._scan(msg, warning=True)
+        print(f"WARNING: {msg}")
+
+    def error(self, msg):
+        self._scan(msg, warning=True)
+        print(msg)
+
+
+class TuningSession:
+    """Measures one download: bytes received, time spent, retries and throttling."""
+
+    def __init__(self, profile):
+        self.host = profile.host
+        self.options = profile.ydl_options()
+        self.fragments = self.options["concurrent_fragment_downloads"]
+        self.retries = 0
+        self.throttled = False
+        self.logger = TuningLogger(self)
+        self._first_seen = {}
+        self._latest = {}
+        self._started = None
+        self._finished = None
+        self._lock = threading.Lock()
+
+    def hook(self, d):
+        """progress_hooks entry; bytes already on disk from a resumed .part don't count."""
+        if d["status"] not in ("downloading", "finished"):
+            return
+        name = d.get("filename") or d.get("tmpfilename") or ""
+        downloaded = d.get("downloaded_bytes") or d.get("total_bytes") or 0
+        now = time.perf_counter()
+        with self._lock:
+            if name not in self._first_seen:
+                self._first_seen[name] = downloaded if d["status"] == "downloading" else 0
+                self._started = self._started or now
+            self._latest[name] = downloaded
+            self._finished = now
+
+    def ydl_options(self):
+        return dict(self.options, logger=self.logger)
+
+    def measurement(self):
+        with self._lock:
+            received = sum(self._latest[n] - self._first_seen[n] for n in self._latest)
+            seconds = (self._finished - self._started) if self._started else 0.0
+        return max(0, received), seconds
+
+
+class DownloadTuner:
+    """Per-host yt-dlp download settings, adapted from how each download went."""
+
+    def __init__(self, db_path=TUNING_DB):
+        self.db_path = db_path
+        self._profiles = {}
+        self._lock = threading.Lock()
+        if db_path:
+            with self._connect() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS host_tuning ("
+                             "host TEXT PRIMARY KEY, profile TEXT NOT NULL, updated REAL NOT NULL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=5)
+
+    def profile(self, host):
+        with self._lock:
+            profile = self._profiles.get(host)
+        if profile is not None:
+            return profile
+        stored = None
+        if self.db_path:
+            try:
+                with self._connect() as conn:
+                    row = conn.execute("SELECT profile FROM host_tuning WHERE host = ?", (host,)).fetchone()
+                stored = json.loads(row[0]) if row else None
+            except (sqlite3.Error, ValueError) as e:
+                print(f"⚠️ Couldn't read tuning for {host}: {e}")
+        with self._lock:
+            return self._profiles.setdefault(host, HostProfile(host, **(stored or {})))
+
+    def _save(self, profile):
+        if not self.db_path:
+            return
+        try:
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO host_tuning (host, profile, updated) VALUES (?, ?, ?)",
+                             (profile.host, json.dumps(profile.to_dict()), time.time()))
+        except sqlite3.Error as e:
+            print(f"⚠️ Couldn't save tuning for {profile.host}: {e}")
+
+    @contextmanager
+    def session(self, url):
+        """Measure the yt-dlp download run inside this block and learn from it.
+
+        Merge session.ydl_options() into the YoutubeDL options and add
+        session.hook to its progress_hooks.
+        """
+        profile = self.profile(host_of(url))
+        with self._lock:
+            session = TuningSession(profile)
+        failed = False
+        try:
+            yield session
+        except Exception as e:
+            failed = True
+            if any(marker in str(e) for marker in THROTTLE_MARKERS):
+                session.throttled = True
+            # Cancelled downloads teach nothing
+            if "Cancel" in type(e).__name__:
+                raise
+            self._finish(profile, session, failed)
+            raise
+        self._finish(profile, session, failed)
+
+    def _finish(self, profile, session, failed):
+        received, seconds = session.measurement()
+        with self._lock:
+            before = (profile.fragments, profile.chunk_size)
+            profile.record(session.fragments, received, seconds, session.retries, session.throttled, failed)
+            after = (profile.fragments, profile.chunk_size)
+        rate = f"{received / seconds / 1e6:.2f} MB/s" if seconds else "n/a"
+        print(f"[TUNING] {profile.host}: {session.fragments} connections, {rate}, {session.retries} retries"
+              f"{', throttled' if session.throttled else ''}{', failed' if failed else ''}"
+              f"{f' -> {after[0]} connections, {after[1] >> 20} MiB chunks' if after != before else ''}")
+        self._save(profile)
+
+    def stats(self):
+        with self._lock:
+            return {host: profile.to_dict() for host, profile in sorted(self._profiles.items())}